@@ -0,0 +1,254 @@
+# Benchmarks for the 8086 decoder
+# Generates deterministic synthetic 8086 code, times decode_8086,
+# add_spacing and the length pre-pass on it, and compares runs saved as JSON
+import sys, os, time, json, random, argparse, platform, subprocess
+import decode_8086
+import length_8086
+from str_util import add_spacing
+
+# Relative weight of each instruction family in a generated program
+DEFAULT_MIX = \
+{
+    'modrm'     : 5,    # MOV/arithmetic register/memory <-> register
+    'immediate' : 3,    # Immediate to register, memory or accumulator
+    'jump'      : 2,    # Conditional jumps, loops, calls and jumps
+    'string'    : 1,    # String ops, with or without rep
+    'prefix'    : 1,    # Segment override and lock prefixes
+    'misc'      : 2,    # push/pop/inc/dec register and single byte ops
+}
+
+STR_OPCODES = [0b10100100, 0b10100110, 0b10101010, 0b10101100, 0b10101110]
+SINGLE_BYTE_OPCODES = sorted(decode_8086.SINGLE_BYTE_OPS)
+
+def _mod_rm(rng : random.Random, reg : int = None) -> bytes:
+    """A random mod reg r/m byte followed by its displacement"""
+    mod = rng.randrange(4)
+    rm = rng.randrange(8)
+    if reg is None:
+        reg = rng.randrange(8)
+    out = bytes([(mod << 6) | (reg << 3) | rm])
+    if mod == 0b01:
+        return out + rng.randbytes(1)
+    if mod == 0b10 or (mod == 0b00 and rm == 0b110):
+        return out + rng.randbytes(2)
+    return out
+
+def _gen_modrm(rng : random.Random) -> bytes:
+    # mov, or one of add/or/adc/sbb/and/sub/xor/cmp, in any direction and size
+    if rng.random() < 0.5:
+        opcode = 0b10001000 | rng.randrange(4)
+    else:
+        opcode = (rng.randrange(8) << 3) | rng.randrange(4)
+    return bytes([opcode]) + _mod_rm(rng)
+
+def _gen_immediate(rng : random.Random) -> bytes:
+    kind = rng.randrange(4)
+    if kind == 0: # MOV Immediate to Register
+        w = rng.randrange(2)
+        return bytes([0b10110000 | (w << 3) | rng.randrange(8)]) + rng.randbytes(w+1)
+    if kind == 1: # MOV Immediate to Register/Memory
+        w = rng.randrange(2)
+        return bytes([0b11000110 | w]) + _mod_rm(rng, 0) + rng.randbytes(w+1)
+    if kind == 2: # Immediate with register/memory
+        sw = rng.randrange(4)
+        data = 2 if sw == 0b01 else 1
+        return bytes([0b10000000 | sw]) + _mod_rm(rng) + rng.randbytes(data)
+    # Immediate to accumulator
+    w = rng.randrange(2)
+    return bytes([(rng.randrange(8) << 3) | 0b100 | w]) + rng.randbytes(w+1)
+
+def _gen_jump(rng : random.Random) -> bytes:
+    kind = rng.randrange(4)
+    if kind <= 1: # Conditional jumps and loops
+        return bytes([rng.choice(list(decode_8086.CTRL_TRNSFR_OPS))]) + rng.randbytes(1)
+    if kind == 2: # CALL/JMP Direct within segment
+        return bytes([rng.choice([0b11101000, 0b11101001])]) + rng.randbytes(2)
+    # CALL/JMP Direct Intersegment
+    return bytes([rng.choice([0b10011010, 0b11101010])]) + rng.randbytes(4)
+
+def _gen_string(rng : random.Random) -> bytes:
+    op = bytes([rng.choice(STR_OPCODES) | rng.randrange(2)])
+    if rng.random() < 0.5:
+        return bytes([rng.choice([0b11110010, 0b11110011])]) + op
+    return op
+
+def _gen_prefix(rng : random.Random) -> bytes:
+    if rng.random() < 0.25:
+        # lock xchg register/memory with register
+        return bytes([0b11110000, 0b10000110 | rng.randrange(2)]) + _mod_rm(rng)
+    return bytes([0b00100110 | (rng.randrange(4) << 3)]) + _gen_modrm(rng)
+
+def _gen_misc(rng : random.Random) -> bytes:
+    if rng.random() < 0.6:
+        # INC/DEC/PUSH/POP Register
+        return bytes([0b01000000 | rng.randrange(32)])
+    opcode = rng.choice(SINGLE_BYTE_OPCODES)
+    # AAM/AAD, second byte is always 0b00001010
+    if opcode in (0b11010100, 0b11010101):
+        return bytes([opcode, 0b00001010])
+    return bytes([opcode])
+
+GENERATORS = \
+{
+    'modrm'     : _gen_modrm,
+    'immediate' : _gen_immediate,
+    'jump'      : _gen_jump,
+    'string'    : _gen_string,
+    'prefix'    : _gen_prefix,
+    'misc'      : _gen_misc,
+}
+
+def generate_program(size : int, mix : dict[str, int] = None, seed : int = 0) -> bytes:
+    """
+    Generates deterministic 8086 machine code that decodes from start to end
+
+    :param int size: Minimum size in bytes, the last instruction may run past it
+    :param dict[str, int] mix: Relative weight of each family in GENERATORS
+    :param int seed: Seed for the random fields
+    :return: The machine code
+    :rtype: bytes
+    """
+    mix = DEFAULT_MIX if mix is None else mix
+    rng = random.Random(seed)
+    families = [GENERATORS[name] for name in mix]
+    weights = list(mix.values())
+    out = bytearray()
+    while len(out) < size:
+        # Pick families in batches to keep rng.choices() calls down
+        for generator in rng.choices(families, weights, k=1024):
+            out += generator(rng)
+    return bytes(out)
+
+def time_best(func, repeat : int, setup = None) -> float:
+    """Best time of repeat calls to func, each after an untimed call to setup"""
+    best = float('inf')
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def run_benchmarks(size : int, mix : dict[str, int] = None, seed : int = 0, repeat : int = 5) -> dict:
+    """
+    Times decode_8086_bytes(), add_spacing() and instruction_boundaries()
+    separately on a generated program
+
+    decode_8086 starts each run with an empty memo of formatted
+    instructions, decode_8086_warm with the memo left by the run before.
+
+    :return: Results ready to be written as JSON
+    :rtype: dict
+    """
+    program = generate_program(size, mix, seed)
+    instructions = sum(1 for _ in decode_8086.decode_instructions(program))
+    text = decode_8086.decode_8086_bytes(program)
+    lines = text.count('\n') + 1
+
+    decode_s = time_best(lambda: decode_8086.decode_8086_bytes(program), repeat, decode_8086._format_bytes.cache_clear)
+    warm_s = time_best(lambda: decode_8086.decode_8086_bytes(program), repeat)
+    spacing_s = time_best(lambda: add_spacing(text), repeat)
+    boundaries_s = time_best(lambda: length_8086.instruction_boundaries(program), repeat)
+    return \
+    {
+        'commit'    : _git_commit(),
+        'python'    : platform.python_version(),
+        'size'      : len(program),
+        'seed'      : seed,
+        'mix'       : DEFAULT_MIX if mix is None else mix,
+        'repeat'    : repeat,
+        'results'   :
+        {
+            'decode_8086' :
+            {
+                'seconds'               : decode_s,
+                'mb_per_s'              : len(program) / decode_s / 1e6,
+                'instructions_per_s'    : instructions / decode_s,
+            },
+            'decode_8086_warm' :
+            {
+                'seconds'               : warm_s,
+                'mb_per_s'              : len(program) / warm_s / 1e6,
+                'instructions_per_s'    : instructions / warm_s,
+            },
+            'add_spacing' :
+            {
+                'seconds'               : spacing_s,
+                'mb_per_s'              : len(text) / spacing_s / 1e6,
+                'instructions_per_s'    : lines / spacing_s,
+            },
+            'instruction_boundaries' :
+            {
+                'seconds'               : boundaries_s,
+                'mb_per_s'              : len(program) / boundaries_s / 1e6,
+                'instructions_per_s'    : instructions / boundaries_s,
+            },
+        },
+    }
+
+def compare(current : dict, baseline : dict, threshold : float) -> list[str]:
+    """
+    Finds benchmarks whose throughput dropped by more than threshold
+
+    :param float threshold: Allowed slowdown, 0.1 allows 10%
+    :return: A message per regression
+    :rtype: list[str]
+    """
+    regressions = []
+    for name, result in current['results'].items():
+        if name not in baseline['results']:
+            continue
+        old = baseline['results'][name]['mb_per_s']
+        new = result['mb_per_s']
+        if new < old * (1 - threshold):
+            regressions.append(f'{name}: {new:.3f} MB/s vs {old:.3f} MB/s ({(new / old - 1) * 100:+.1f}%)')
+    return regressions
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def _parse_mix(value : str) -> dict[str, int]:
+    mix = {}
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        if name not in GENERATORS:
+            raise argparse.ArgumentTypeError(f'unknown family {name!r}, expected one of {", ".join(GENERATORS)}')
+        mix[name] = int(weight or 1)
+    return mix
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures decoder throughput on synthetic 8086 code')
+    parser.add_argument('--size', type=int, default=1_000_000, help='bytes of code to generate (default: 1000000)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mix', type=_parse_mix, help='family weights, e.g. modrm=5,jump=2,string=1')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per benchmark, the best is kept (default: 5)')
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='allowed slowdown against --compare (default: 0.1)')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.size, args.mix, args.seed, args.repeat)
+    for name, result in results['results'].items():
+        print(f'{name.ljust(22)} {result['mb_per_s']:8.3f} MB/s {result['instructions_per_s']:12.0f} instructions/s')
+    if args.output:
+        with open(args.output,'w') as file:
+            json.dump(results, file, indent=4)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if any(baseline.get(key) != results[key] for key in ('size', 'seed', 'mix')):
+            print('Warning: comparing against a run on a different program')
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+# Columnar output for decoded instructions
+# Writes the fields of every Instruction as packed arrays, one column per
+# field, so other tools can load them without parsing the text. Columns are
+# aligned to 8 bytes and can be used straight from a memory-mapped file, or
+# wrapped with numpy.frombuffer() for vectorized scans.
+import sys, mmap, array, struct, argparse
+from collections.abc import Iterable, Iterator
+from decode_8086 import MNEMONICS, ByteBuffer, Instruction, decode_instructions
+
+# Column name (an Instruction field) and array typecode. Fields that are None
+# are written as -1 in the signed byte columns and NONE_VALUE in disp and imm
+COLUMNS = \
+[
+    ('offset',  'I'),
+    ('length',  'B'),
+    ('opcode',  'B'),
+    ('op',      'B'),
+    ('w',       'b'),
+    ('d',       'b'),
+    ('s',       'b'),
+    ('mod',     'b'),
+    ('reg',     'b'),
+    ('rm',      'b'),
+    ('disp',    'i'),
+    ('imm',     'i'),
+    ('seg',     'b'),
+    ('lock',    'B'),
+]
+NONE_VALUE = -1 << 31
+# Magic, version, number of columns, number of instructions and the length
+# of the mnemonic names that op indexes, stored after the header
+COLUMNS_HEADER = struct.Struct('<4sHHQQ')
+COLUMNS_MAGIC = b'8COL'
+COLUMNS_VERSION = 1
+COLUMNS_EXTENSION = '.cols'
+ALIGNMENT = 8
+
+def _padding(size : int) -> bytes:
+    return bytes(-size % ALIGNMENT)
+
+def write_columns(instructions : Iterable[Instruction], file_path : str) -> int:
+    """
+    Writes instructions to a columnar file
+
+    :param Iterable instructions: Records from decode_instructions()
+    :param str file_path: The file to write
+    :return: Number of instructions written
+    :rtype: int
+    """
+    arrays = [array.array(typecode) for _, typecode in COLUMNS]
+    fields = [(name, values.append, NONE_VALUE if typecode == 'i' else -1)
+              for (name, typecode), values in zip(COLUMNS, arrays)]
+    for ins in instructions:
+        for name, append, none in fields:
+            value = getattr(ins, name)
+            append(none if value is None else value)
+
+    names = '\n'.join(MNEMONICS).encode()
+    with open(file_path,'wb') as file:
+        header = COLUMNS_HEADER.pack(COLUMNS_MAGIC, COLUMNS_VERSION, len(COLUMNS), len(arrays[0]), len(names))
+        file.write(header + names + _padding(len(header) + len(names)))
+        for values in arrays:
+            # Files are always little endian
+            if sys.byteorder == 'big':
+                values.byteswap()
+            values.tofile(file)
+            file.write(_padding(len(values) * values.itemsize))
+    return len(arrays[0])
+
+def export_columns(source : str | ByteBuffer, file_path : str) -> int:
+    """Decodes a binary or buffer straight into a columnar file"""
+    return write_columns(decode_instructions(source), file_path)
+
+class Columns:
+    """
+    Instructions loaded from a columnar file
+
+    Each column is an attribute named after its Instruction field. On a
+    little endian machine the columns are memoryviews of the mapped file and
+    nothing is copied, close() (or a with block) releases them. Wrap a
+    column with numpy.frombuffer() for vectorized scans, and delete the
+    arrays before closing.
+
+    :ivar list[str] mnemonics: Names the op column indexes
+    """
+    def __init__(self, file_path : str):
+        with open(file_path,'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._load()
+        except Exception:
+            self._mmap.close()
+            raise
+
+    def _load(self):
+        buf = self._mmap
+        if len(buf) < COLUMNS_HEADER.size:
+            raise ValueError('not a columns file')
+        magic, version, n_columns, count, names_size = COLUMNS_HEADER.unpack_from(buf)
+        if magic != COLUMNS_MAGIC or version != COLUMNS_VERSION or n_columns != len(COLUMNS):
+            raise ValueError(f'not a version {COLUMNS_VERSION} columns file')
+        pos = COLUMNS_HEADER.size
+        self.mnemonics = bytes(buf[pos:pos+names_size]).decode().split('\n')
+        pos += names_size
+        pos += -pos % ALIGNMENT
+        self._views = []
+        self.count = count
+        for name, typecode in COLUMNS:
+            size = count * array.array(typecode).itemsize
+            if pos + size > len(buf):
+                raise ValueError('columns file is truncated')
+            view = memoryview(buf)[pos:pos+size]
+            self._views.append(view)
+            if sys.byteorder == 'big':
+                values = array.array(typecode)
+                values.frombytes(view)
+                values.byteswap()
+            else:
+                values = view.cast(typecode)
+                self._views.append(values)
+            setattr(self, name, values)
+            pos += size + (-size % ALIGNMENT)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def instruction(self, i : int) -> Instruction:
+        """Rebuilds the record of instruction i, its text is the same as when it was decoded"""
+        ins = Instruction(self.offset[i], self.opcode[i])
+        ins.length = self.length[i]
+        ins.op = self.op[i]
+        for name, typecode in COLUMNS[4:]:
+            value = getattr(self, name)[i]
+            none = NONE_VALUE if typecode == 'i' else -1
+            setattr(ins, name, None if value == none else value)
+        ins.lock = bool(ins.lock)
+        return ins
+
+    def __iter__(self) -> Iterator[Instruction]:
+        return map(self.instruction, range(self.count))
+
+    def close(self):
+        """
+        Releases the columns and unmaps the file
+
+        :raises BufferError: A column is still in use, by a numpy array for
+            example. The file stays mapped until close() is called again
+            once it is gone
+        """
+        while self._views:
+            self._views[-1].release()
+            self._views.pop()
+        self._mmap.close()
+
+    def __enter__(self) -> 'Columns':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def load_columns(file_path : str) -> Columns:
+    """
+    Maps a file written by write_columns()
+
+    :raises ValueError: The file isn't a columns file of this version
+    :rtype: Columns
+    """
+    return Columns(file_path)
+
+def main():
+    parser = argparse.ArgumentParser(description='Decodes an 8086 binary into a columnar file of instruction fields')
+    parser.add_argument('path', help='the binary to decode')
+    parser.add_argument('-o', '--output', help=f'the file to write (default: path + {COLUMNS_EXTENSION})')
+    args = parser.parse_args()
+    output = args.output or args.path + COLUMNS_EXTENSION
+    count = export_columns(args.path, output)
+    print(f'{count} instructions written to -> {output}')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,340 @@
+# Clock estimates for decoded instructions
+# Annotates Instruction records with their 8086 and 8088 clocks, from the
+# timings in the Intel 8086 family user's manual. Estimates come from the
+# decoded fields (mnemonic, mod, r/m, w, seg), the text is never parsed.
+# Only execution unit clocks are counted, the effect of the prefetch queue
+# and of bus contention isn't.
+import bisect, argparse
+from collections.abc import Iterable, Iterator
+from typing import NamedTuple
+import decode_8086
+from decode_8086 import MNEMONICS, LOCK_PREFIX, STR_OPS, Instruction, decode_instructions
+
+CPUS = ('8086', '8088')
+
+# Effective address clocks, by mod (00, then 01 and 10) and r/m
+EA_CLOCKS = \
+[
+    [7, 8, 8, 7, 5, 5, 6, 5],       # bx + si, bx + di, bp + si, bp + di, si, di, direct, bx
+    [11, 12, 12, 11, 9, 9, 9, 9],   # The same + displacement
+]
+SEG_OVERRIDE_CLOCKS = 2
+LOCK_CLOCKS = 2
+# Each word transferred at an odd address on the 8086, or at any address on
+# the 8088, takes another bus cycle
+WORD_PENALTY = 4
+
+class Clocks(NamedTuple):
+    """Timing of one form of an instruction"""
+    base : int              # Clocks without EA, the branch not taken or the fastest case
+    worst : int = None      # Branch taken or the slowest case, base if None
+    transfers : int = 0     # Memory (or port) transfers of the operand size
+    per_count : int = 0     # Clocks for each repetition (rep) or bit shifted (cl)
+    count_transfers : int = 0   # Transfers for each repetition
+
+# Forms of operands
+# rr  register, register        rm  register <- memory      mr  memory <- register
+# ri  register, immediate       mi  memory, immediate       ai  accumulator, immediate
+# r   register                  m   memory                  -   no operands
+# r1/m1 shift by 1, rc/mc shift by cl, rep for repeated string ops
+# A pair is the timing for bytes then for words
+ARITH = {'rr' : Clocks(3), 'rm' : Clocks(9, transfers=1), 'mr' : Clocks(16, transfers=2),
+         'ri' : Clocks(4), 'mi' : Clocks(17, transfers=2), 'ai' : Clocks(4)}
+SHIFT = {'r1' : Clocks(2), 'rc' : Clocks(8, per_count=4), 'm1' : Clocks(15, transfers=2),
+         'mc' : Clocks(20, transfers=2, per_count=4)}
+CONDITIONAL = Clocks(4, 16)
+CLOCKS = \
+{
+    'mov'   : {'rr' : Clocks(2), 'rm' : Clocks(8, transfers=1), 'mr' : Clocks(9, transfers=1),
+               'ri' : Clocks(4), 'mi' : Clocks(10, transfers=1), 'acc' : Clocks(10, transfers=1)},
+    **{op : ARITH for op in ('add', 'or', 'adc', 'sbb', 'and', 'sub', 'xor')},
+    'cmp'   : {**ARITH, 'mr' : Clocks(9, transfers=1), 'mi' : Clocks(10, transfers=1)},
+    'test'  : {'rr' : Clocks(3), 'rm' : Clocks(9, transfers=1), 'mr' : Clocks(9, transfers=1),
+               'ri' : Clocks(5), 'mi' : Clocks(11, transfers=1), 'ai' : Clocks(4)},
+    'xchg'  : {'rr' : Clocks(4), 'rm' : Clocks(17, transfers=2), 'mr' : Clocks(17, transfers=2),
+               'acc' : Clocks(3)},
+    **{op : SHIFT for op in ('rol', 'ror', 'rcl', 'rcr', 'shl', 'shr', 'sar')},
+    'inc'   : {'r' : (Clocks(3), Clocks(2)), 'm' : Clocks(15, transfers=2)},
+    'dec'   : {'r' : (Clocks(3), Clocks(2)), 'm' : Clocks(15, transfers=2)},
+    'not'   : {'r' : Clocks(3), 'm' : Clocks(16, transfers=2)},
+    'neg'   : {'r' : Clocks(3), 'm' : Clocks(16, transfers=2)},
+    'mul'   : {'r' : (Clocks(70, 77), Clocks(118, 133)), 'm' : (Clocks(76, 83, 1), Clocks(124, 139, 1))},
+    'imul'  : {'r' : (Clocks(80, 98), Clocks(128, 154)), 'm' : (Clocks(86, 104, 1), Clocks(134, 160, 1))},
+    'div'   : {'r' : (Clocks(80, 90), Clocks(144, 162)), 'm' : (Clocks(86, 96, 1), Clocks(150, 168, 1))},
+    'idiv'  : {'r' : (Clocks(101, 112), Clocks(165, 184)), 'm' : (Clocks(107, 118, 1), Clocks(171, 190, 1))},
+    'push'  : {'r' : Clocks(11, transfers=1), 'm' : Clocks(16, transfers=2), 'sr' : Clocks(10, transfers=1)},
+    'pop'   : {'r' : Clocks(8, transfers=1), 'm' : Clocks(17, transfers=2), 'sr' : Clocks(8, transfers=1)},
+    'pushf' : {'-' : Clocks(10, transfers=1)},
+    'popf'  : {'-' : Clocks(8, transfers=1)},
+    'call'  : {'near' : Clocks(19, transfers=1), 'r' : Clocks(16, transfers=1), 'm' : Clocks(21, transfers=2),
+               'far' : Clocks(28, transfers=2), 'far_m' : Clocks(37, transfers=4)},
+    'jmp'   : {'near' : Clocks(15), 'r' : Clocks(11), 'm' : Clocks(18, transfers=1),
+               'far' : Clocks(15), 'far_m' : Clocks(24, transfers=2)},
+    'ret'   : {'-' : Clocks(8, transfers=1), 'imm' : Clocks(12, transfers=1)},
+    'retf'  : {'-' : Clocks(18, transfers=2), 'imm' : Clocks(17, transfers=2)},
+    **{op : {'-' : CONDITIONAL} for op in ('jo', 'jno', 'jb', 'jnb', 'je', 'jnz', 'jbe', 'ja',
+                                           'js', 'jns', 'jp', 'jnp', 'jl', 'jnl', 'jle', 'jg')},
+    'loop'  : {'-' : Clocks(5, 17)},
+    'loopz' : {'-' : Clocks(6, 18)},
+    'loopnz': {'-' : Clocks(5, 19)},
+    'jcxz'  : {'-' : Clocks(6, 18)},
+    'movs'  : {'-' : Clocks(18, transfers=2), 'rep' : Clocks(9, per_count=17, count_transfers=2)},
+    'cmps'  : {'-' : Clocks(22, transfers=2), 'rep' : Clocks(9, per_count=22, count_transfers=2)},
+    'scas'  : {'-' : Clocks(15, transfers=1), 'rep' : Clocks(9, per_count=15, count_transfers=1)},
+    'lods'  : {'-' : Clocks(12, transfers=1), 'rep' : Clocks(9, per_count=13, count_transfers=1)},
+    'stos'  : {'-' : Clocks(11, transfers=1), 'rep' : Clocks(9, per_count=10, count_transfers=1)},
+    'lea'   : {'m' : Clocks(2)},
+    'lds'   : {'m' : Clocks(16, transfers=2)},
+    'les'   : {'m' : Clocks(16, transfers=2)},
+    'in'    : {'imm' : Clocks(10, transfers=1), 'dx' : Clocks(8, transfers=1)},
+    'out'   : {'imm' : Clocks(10, transfers=1), 'dx' : Clocks(8, transfers=1)},
+    'int'   : {'imm' : Clocks(51, transfers=5)},
+    'int3'  : {'-' : Clocks(52, transfers=5)},
+    'into'  : {'-' : Clocks(4, 53, transfers=5)},
+    'iret'  : {'-' : Clocks(24, transfers=3)},
+    'xlat'  : {'-' : Clocks(11, transfers=1)},
+    'aam'   : {'-' : Clocks(83)},
+    'aad'   : {'-' : Clocks(60)},
+    'nop'   : {'-' : Clocks(3)},
+    'wait'  : {'-' : Clocks(3)},
+    'cwd'   : {'-' : Clocks(5)},
+    **{op : {'-' : Clocks(4)} for op in ('lahf', 'sahf', 'aaa', 'daa', 'aas', 'das')},
+    **{op : {'-' : Clocks(2)} for op in ('cbw', 'clc', 'stc', 'cmc', 'cli', 'sti', 'cld', 'std', 'hlt')},
+}
+# Transfers of these are always words, whatever w is
+WORD_OPS = {'push', 'pop', 'pushf', 'popf', 'call', 'jmp', 'ret', 'retf', 'int', 'int3', 'into', 'iret',
+            'lds', 'les'}
+# Stack and string transfers, their addresses are never known
+UNKNOWN_ADDRESS_OPS = WORD_OPS - {'jmp', 'lds', 'les'} | {'movs', 'cmps', 'scas', 'lods', 'stos'}
+
+class Timing(NamedTuple):
+    """
+    Estimated clocks of one instruction
+
+    An instruction executes in cycles clocks, or max_cycles when a branch
+    is taken or the operands are the slowest. Repeated string ops and shifts
+    by cl take another per_count clocks for each repetition or bit.
+    """
+    cycles : int
+    max_cycles : int
+    per_count : int
+    ea : int        # Effective address clocks, included in cycles
+    penalty : int   # Word transfer clocks, included in cycles
+
+    def __str__(self) -> str:
+        parts = [str(self.cycles - self.ea - self.penalty)]
+        if self.ea:
+            parts.append(f'{self.ea}ea')
+        if self.penalty:
+            parts.append(f'{self.penalty}p')
+        text = str(self.cycles) if len(parts) == 1 else f'{self.cycles} ({' + '.join(parts)})'
+        if self.max_cycles != self.cycles:
+            text += f'..{self.max_cycles}'
+        if self.per_count:
+            text += f' + {self.per_count}/count'
+        return text
+
+def _form(ins : Instruction, name : str) -> tuple[str, bool, int]:
+    """
+    Operand form of an instruction for CLOCKS, whether its transfers are
+    words and the address of its memory operand when it is known
+    """
+    decoder = decode_8086.DECODE_TABLE[ins.opcode]
+    word = ins.w == 1 or name in WORD_OPS
+    mod = ins.mod
+    address = None
+    if mod == 0b00 and ins.rm == 0b110:
+        address = ins.disp & 0xFFFF
+    if decoder in (decode_8086._decode_mov_rm_reg, decode_8086._decode_arith_rm_reg):
+        form = 'rr' if mod == 0b11 else 'rm' if ins.d else 'mr'
+    elif decoder is decode_8086._decode_mov_sr:
+        form = 'rr' if mod == 0b11 else 'rm' if ins.d else 'mr'
+        word = True
+    elif decoder in (decode_8086._decode_mov_imm_rm, decode_8086._decode_immed_rm):
+        form = 'ri' if mod == 0b11 else 'mi'
+    elif decoder is decode_8086._decode_mov_imm_reg:
+        form = 'ri'
+    elif decoder in (decode_8086._decode_test_acc, decode_8086._decode_arith_imm_acc):
+        form = 'ai'
+    elif decoder is decode_8086._decode_mov_mem_acc:
+        form = 'acc'
+        address = ins.disp
+    elif decoder is decode_8086._decode_xchg_acc:
+        form = 'acc'
+    elif decoder is decode_8086._decode_shift:
+        form = ('r' if mod == 0b11 else 'm') + ('c' if ins.d else '1')
+    elif decoder is decode_8086._decode_group_rm:
+        form = 'r' if mod == 0b11 else 'm'
+        if name == 'test':
+            form += 'i'
+        elif name in ('call', 'jmp') and ins.reg & 0b1:
+            form = 'far_m'
+    elif decoder is decode_8086._decode_inc_dec_push_pop_reg:
+        form = 'r'
+    elif decoder is decode_8086._decode_far_direct:
+        form = 'far'
+    elif decoder is decode_8086._decode_near_direct:
+        form = 'near'
+    elif decoder is decode_8086._decode_ret_imm or decoder is decode_8086._decode_int_imm:
+        form = 'imm'
+    elif decoder is decode_8086._decode_in_out:
+        form = 'dx' if ins.imm is None else 'imm'
+        address = ins.imm
+    elif decoder is decode_8086._decode_load:
+        form = 'm'
+    elif decoder is decode_8086._decode_str_op:
+        form = 'rep' if STR_OPS[ins.opcode >> 1] == 'rep' else '-'
+    elif name in ('push', 'pop'):
+        form = 'sr' # push cs, pop ds
+    else:
+        form = '-'
+    return form, word, address
+
+def estimate(ins : Instruction, cpu : str = '8086', odd : bool = False) -> Timing:
+    """
+    Estimates the clocks of a decoded instruction
+
+    Word transfers take 4 more clocks each on the 8088, and on the 8086 when
+    the address is odd. Addresses are known for direct addresses and ports,
+    the others are taken to be even unless odd is set.
+
+    :param Instruction ins: A record from decode_instructions()
+    :param str cpu: '8086' or '8088'
+    :param bool odd: Take unknown addresses to be odd
+    :return: The timing, None for an instruction the CPU doesn't have
+    :rtype: Timing
+    """
+    if cpu not in CPUS:
+        raise ValueError(f'cpu must be one of {', '.join(CPUS)}')
+    if ins.opcode == LOCK_PREFIX:
+        return Timing(LOCK_CLOCKS, LOCK_CLOCKS, 0, 0, 0)
+    name = MNEMONICS[ins.op]
+    form, word, address = _form(ins, name)
+    clocks = CLOCKS.get(name, {}).get(form)
+    if clocks is None:
+        return None
+    if not isinstance(clocks, Clocks):
+        clocks = clocks[ins.w]
+
+    memory = ins.mod is not None and ins.mod != 0b11
+    ea = EA_CLOCKS[ins.mod != 0b00][ins.rm] if memory else 0
+    extra = ea
+    if ins.seg is not None and (memory or form == 'acc' and address is not None or name in STR_OPS.values()):
+        extra += SEG_OVERRIDE_CLOCKS
+    if ins.lock:
+        extra += LOCK_CLOCKS
+
+    penalty = per_count_penalty = 0
+    if word:
+        if cpu == '8088':
+            slow = True
+        elif address is not None and name not in UNKNOWN_ADDRESS_OPS:
+            slow = address & 1 == 1
+        else:
+            slow = odd
+        if slow:
+            penalty = WORD_PENALTY * clocks.transfers
+            per_count_penalty = WORD_PENALTY * clocks.count_transfers
+    base = clocks.base + extra + penalty
+    worst = (clocks.base if clocks.worst is None else clocks.worst) + extra + penalty
+    return Timing(base, worst, clocks.per_count + per_count_penalty, ea, penalty)
+
+def annotate(instructions : Iterable[Instruction], cpu : str = '8086', odd : bool = False) -> Iterator[tuple[Instruction, Timing]]:
+    """Pairs every instruction with estimate() of its clocks"""
+    for ins in instructions:
+        yield ins, estimate(ins, cpu, odd)
+
+class CycleTotals(NamedTuple):
+    """Clocks of the instructions in [start, end)"""
+    name : str
+    start : int
+    end : int
+    count : int         # Instructions
+    cycles : int        # Each instruction once, branches not taken
+    max_cycles : int    # Each instruction once, branches taken
+    variable : int      # Instructions with clocks for each count (rep, shifts by cl)
+    unknown : int       # Instructions with no estimate
+
+def function_starts(instructions : Iterable[Instruction]) -> list[int]:
+    """Offset 0 and the targets of direct near calls, sorted"""
+    call = decode_8086.MNEMONIC_ID['call']
+    starts = {0}
+    for ins in instructions:
+        if ins.op == call and ins.opcode == 0b11101000:
+            starts.add((ins.offset + ins.length + ins.disp) & 0xFFFF)
+    return sorted(starts)
+
+def totals(annotated : Iterable[tuple[Instruction, Timing]], ranges : list[tuple[int, int]] = None) -> list[CycleTotals]:
+    """
+    Adds up clocks for each range of offsets
+
+    :param Iterable annotated: Pairs from annotate(), in offset order
+    :param list ranges: (start, end) offsets. If None, each function found
+        by function_starts() runs up to the next one
+    :return: Totals for every range, in the order given
+    :rtype: list[CycleTotals]
+    """
+    annotated = list(annotated)
+    if ranges is None:
+        starts = function_starts(ins for ins, _ in annotated)
+        end = max((ins.offset + ins.length for ins, _ in annotated), default=0)
+        ranges = list(zip(starts, [*starts[1:], max(end, starts[-1])]))
+        names = ['start' if start == 0 else f'sub_{start:04x}' for start, _ in ranges]
+    else:
+        names = [f'{start:#x}-{end:#x}' for start, end in ranges]
+
+    # Records are in offset order, so each range is a slice found by bisect
+    offsets = [ins.offset for ins, _ in annotated]
+    result = []
+    for name, (start, end) in zip(names, ranges):
+        first = bisect.bisect_left(offsets, start)
+        stop = bisect.bisect_left(offsets, end, first) if end > start else first
+        count = stop - first
+        cycles = max_cycles = variable = unknown = 0
+        for _, timing in annotated[first:stop]:
+            if timing is None:
+                unknown += 1
+                continue
+            cycles += timing.cycles
+            max_cycles += timing.max_cycles
+            variable += timing.per_count != 0
+        result.append(CycleTotals(name, start, end, count, cycles, max_cycles, variable, unknown))
+    return result
+
+def _parse_range(text : str) -> tuple[int, int]:
+    start, _, end = text.partition(':')
+    return int(start, 0), int(end, 0)
+
+def main():
+    parser = argparse.ArgumentParser(description='Estimates the 8086 and 8088 clocks of every instruction in a binary')
+    parser.add_argument('path', help='the binary to decode')
+    parser.add_argument('--cpu', choices=[*CPUS, 'both'], default='both', help='the CPU to estimate for (default: both)')
+    parser.add_argument('--range', dest='ranges', action='append', type=_parse_range, metavar='START:END',
+                        help='add up clocks from START up to END, can be repeated (default: each function)')
+    parser.add_argument('--odd', action='store_true', help='take unknown word addresses to be odd')
+    parser.add_argument('-q', '--quiet', action='store_true', help='only print the totals')
+    args = parser.parse_args()
+
+    cpus = CPUS if args.cpu == 'both' else (args.cpu,)
+    instructions = list(decode_instructions(args.path))
+    timings = {cpu : list(annotate(instructions, cpu, args.odd)) for cpu in cpus}
+    if not args.quiet:
+        width = max((len(ins.text) for ins in instructions), default=0)
+        for i, ins in enumerate(instructions):
+            estimates = ' | '.join(f'{cpu}: {timings[cpu][i][1] or '?'}' for cpu in cpus)
+            print(f'{ins.offset:04x}  {ins.text.ljust(width)}  ; {estimates}')
+        print()
+    for cpu in cpus:
+        print(f'{cpu} clocks:')
+        for total in totals(timings[cpu], args.ranges):
+            line = f'  {total.name:<14} {total.count:>6} instructions  {total.cycles:>8}'
+            if total.max_cycles != total.cycles:
+                line += f'..{total.max_cycles}'
+            if total.variable:
+                line += f'  ({total.variable} with clocks per count)'
+            if total.unknown:
+                line += f'  ({total.unknown} unknown)'
+            print(line)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+# Decode daemon
+# Keeps the decoder loaded in one process that serves decodes over a Unix
+# domain socket, so each decode doesn't pay for starting Python, importing
+# decode_8086 and building its tables. The client side only imports the
+# standard library modules it needs, decode_8086 is imported by serve().
+#
+# Protocol: the client sends one line of JSON, then the raw bytes to decode
+# if it gave a size instead of a path:
+#   {"path": str} or {"size": int}, with optional "spacing" and "strict":
+#   bool (default true), "start" and "end": byte offsets of the instructions
+#   to decode
+# The daemon answers with one line of JSON, {"ok": true} or {"ok": false,
+# "error": str}, followed by the disassembly as it is decoded, and closes
+# the connection.
+import os, sys, json, socket, tempfile, argparse
+from collections.abc import Iterator
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), f'decode_8086-{os.getuid()}.sock')
+# Largest request line and raw buffer the daemon accepts
+MAX_HEADER_SIZE = 1 << 16
+MAX_DATA_SIZE = 1 << 26
+# Disassembly is sent in chunks of about this many bytes
+CHUNK_SIZE = 1 << 16
+
+class DaemonError(Exception):
+    """The daemon refused a request"""
+
+def _lines(request : dict, data : bytes) -> Iterator[str]:
+    """Lines of disassembly for a request, each ending with '\\n'"""
+    import itertools
+    from decode_8086 import iter_instructions
+    from str_util import iter_spacing
+    start = request.get('start') or 0
+    end = request.get('end')
+    texts = (text for offset, _, text in
+             itertools.takewhile(lambda item: end is None or item[0] < end,
+                                 iter_instructions(data if data is not None else request['path'],
+                                                   request.get('strict', True)))
+             if offset >= start)
+    lines = itertools.chain(['bits 16'], texts)
+    if request.get('spacing', True):
+        return iter_spacing(lines)
+    return (line + '\n' for line in lines)
+
+def _check_request(request : dict) -> str:
+    """Returns why a request can't be served, None if it can"""
+    if not isinstance(request, dict):
+        return 'request must be a JSON object'
+    if ('path' in request) == ('size' in request):
+        return 'request needs either path or size'
+    if 'path' in request and not isinstance(request['path'], str):
+        return 'path must be a string'
+    if 'size' in request and not (isinstance(request['size'], int) and 0 <= request['size'] <= MAX_DATA_SIZE):
+        return f'size must be an int from 0 to {MAX_DATA_SIZE}'
+    for name in ('spacing', 'strict'):
+        if not isinstance(request.get(name, True), bool):
+            return f'{name} must be a bool'
+    for name in ('start', 'end'):
+        if request.get(name) is not None and not isinstance(request[name], int):
+            return f'{name} must be an int'
+    return None
+
+async def _handle(reader, writer):
+    import asyncio
+    try:
+        try:
+            header = await reader.readuntil(b'\n')
+            request = json.loads(header)
+            error = _check_request(request)
+            data = None
+            if error is None and 'size' in request:
+                data = await reader.readexactly(request['size'])
+            if error is None and 'path' in request and not os.path.isfile(request['path']):
+                error = f'no such file: {request['path']}'
+        except (asyncio.LimitOverrunError, asyncio.IncompleteReadError, ValueError) as e:
+            error = f'bad request: {e}'
+        if error is not None:
+            writer.write(json.dumps({'ok' : False, 'error' : error}).encode() + b'\n')
+            return
+        writer.write(b'{"ok": true}\n')
+        chunk = []
+        size = 0
+        for line in _lines(request, data):
+            chunk.append(line)
+            size += len(line)
+            if size >= CHUNK_SIZE:
+                writer.write(''.join(chunk).encode())
+                chunk.clear()
+                size = 0
+                await writer.drain()
+                # drain() only waits while the socket's buffer is full, so
+                # give other requests a turn between chunks
+                await asyncio.sleep(0)
+        writer.write(''.join(chunk).encode())
+        await writer.drain()
+    except (ConnectionError, OSError):
+        pass
+    finally:
+        writer.close()
+
+async def serve(socket_path : str = DEFAULT_SOCKET, ready = None):
+    """
+    Serves decodes on a Unix domain socket until cancelled
+
+    :param str socket_path: Path of the socket, replaced if it already exists
+    :param asyncio.Event ready: Set once the socket accepts connections
+    """
+    import asyncio
+    import decode_8086 # Loaded once, before the first request
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = await asyncio.start_unix_server(_handle, socket_path, limit=MAX_HEADER_SIZE)
+    try:
+        async with server:
+            if ready is not None:
+                ready.set()
+            await server.serve_forever()
+    finally:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+def decode(path : str = None, data : bytes = None, spacing : bool = True, start : int = None, end : int = None,
+           socket_path : str = DEFAULT_SOCKET, strict : bool = True) -> Iterator[str]:
+    """
+    Asks the daemon for the disassembly of a file or of bytes
+
+    :param str path: File for the daemon to decode, made absolute
+    :param bytes data: Bytes to decode, sent to the daemon, if path is None
+    :param bool spacing: Group lines like add_spacing()
+    :param int start: First byte offset of the instructions to decode
+    :param int end: Byte offset after the instructions to decode
+    :param str socket_path: Socket the daemon listens on
+    :param bool strict: Stop at the first byte that can't be decoded, or
+        write it as db and carry on
+    :return: Generator of str chunks of disassembly, as they arrive
+    :rtype: Iterator[str]
+    :raises DaemonError: The daemon refused the request
+    :raises OSError: No daemon is listening on socket_path
+    """
+    request = {'spacing' : spacing, 'strict' : strict, 'start' : start, 'end' : end}
+    if path is not None:
+        request['path'] = os.path.abspath(path)
+    else:
+        request['size'] = len(data)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        if path is None:
+            sock.sendall(data)
+        with sock.makefile('rb') as file:
+            status = json.loads(file.readline() or b'{"ok": false, "error": "no answer"}')
+            if not status['ok']:
+                raise DaemonError(status['error'])
+            while chunk := file.read1(CHUNK_SIZE):
+                yield chunk.decode()
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs a daemon that keeps the 8086 decoder loaded, or decodes with it')
+    parser.add_argument('-s', '--socket', default=DEFAULT_SOCKET, help=f'the socket to use (default: {DEFAULT_SOCKET})')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('serve', help='run the daemon')
+    client = commands.add_parser('decode', help='decode with the daemon and print the disassembly')
+    client.add_argument('path', help="the binary to decode, or '-' to send stdin")
+    client.add_argument('--no-spacing', action='store_true', help="don't group lines by their first word")
+    client.add_argument('--start', type=lambda x: int(x, 0), help='decode only instructions from this byte offset')
+    client.add_argument('--end', type=lambda x: int(x, 0), help='decode only instructions before this byte offset')
+    client.add_argument('--no-strict', action='store_true', help="write bytes that can't be decoded as db and carry on")
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        import signal, asyncio
+
+        async def run():
+            # Stop on SIGTERM like on ^C, so the socket is removed
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+            await serve(args.socket)
+
+        print(f'Listening on {args.socket}')
+        try:
+            asyncio.run(run())
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            pass
+        return
+
+    path = data = None
+    if args.path == '-':
+        data = sys.stdin.buffer.read()
+    else:
+        path = args.path
+    try:
+        for chunk in decode(path, data, not args.no_spacing, args.start, args.end, args.socket, not args.no_strict):
+            sys.stdout.write(chunk)
+    except DaemonError as e:
+        sys.exit(f'error: {e}')
+    except OSError as e:
+        sys.exit(f'error: no daemon on {args.socket} ({e.strerror})')
+
+if __name__ == "__main__":
+    main()
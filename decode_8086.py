@@ -4,8 +4,11 @@
 # Creates binary matching disassemblies
 # HW Assignments and Challenges
 # from Performance-Aware-Programming Course by Casey Muratori
-import sys, os, io
-from str_util import add_spacing
+import sys, os, io, copy, json, mmap, time, glob, array, struct, bisect, pickle, hashlib, argparse, functools, itertools, contextlib, collections
+import concurrent.futures
+from collections.abc import Iterator, Generator
+from typing import NamedTuple
+from str_util import add_spacing, iter_spacing
 
 OP_GROUP_IMMED = \
 [
@@ -124,6 +127,9 @@ REG_MASK    =   BIT_2 | BIT_1 | BIT_0
 RM_MASK     =   BIT_2 | BIT_1 | BIT_0
 IMMREG_MASK =   BIT_2 | BIT_1 | BIT_0
 
+# Anything decode_8086_bytes() can index into
+ByteBuffer = bytes | bytearray | memoryview | mmap.mmap
+
 # Returns signed int from a two's complement notated int
 def from_twos_complement(tc_int,num_bits) -> int:
     # Number is positive
@@ -134,458 +140,1876 @@ def from_twos_complement(tc_int,num_bits) -> int:
     # Then subtract max value of (num_bits - 1) bits 
     return (tc_int & ((2**(num_bits)-1)>>1)) - 2**(num_bits-1)
 
-def mod_rm_schema(mod : int, rm  : int, file_handle : io.BufferedReader, reg_table : list[str] = None) -> str:
+def read_u16(buf : ByteBuffer, pos : int) -> int:
+    """Reads a little endian word, raises IndexError past the end of buf"""
+    return buf[pos] | (buf[pos+1] << 8)
+
+SEG_PREFIX = [f'{sr}:' for sr in SEG_REG]
+
+class Instruction:
+    """
+    A decoded instruction
+
+    Only numeric fields are kept, the text is formatted when it is asked for.
+    Fields an instruction doesn't encode are None.
+
+    :ivar int offset: Byte offset of the instruction, including any prefixes
+    :ivar int length: Length in bytes, including any prefixes
+    :ivar int opcode: First byte after the prefixes, selects the formatter
+    :ivar int op: Index of the mnemonic in MNEMONICS
+    :ivar int w: Word or byte
+    :ivar int d: Direction of operands (v, the shift count source, for shifts)
+    :ivar int s: Sign extension of immediate data
+    :ivar int mod: The value of mod [0b00 -> 0b11]
+    :ivar int reg: The value of reg [0b000 -> 0b111]
+    :ivar int rm: The value of rm [0b000 -> 0b111]
+    :ivar int disp: Signed displacement, the address for direct addresses,
+        the segment for direct intersegment calls and jumps
+    :ivar int imm: Immediate data as encoded (unsigned)
+    :ivar int seg: Index in SEG_REG of the segment override in effect
+    :ivar bool lock: Instruction has a lock prefix
+    :ivar bytes prefixes: The lock and segment override prefixes in the order
+        they were read, None if there are none. All the bytes of a lock on
+        its own
+    """
+    __slots__ = ('offset', 'length', 'opcode', 'op', 'w', 'd', 's', 'mod', 'reg', 'rm', 'disp', 'imm', 'seg', 'lock',
+                 'prefixes')
+
+    def __init__(self, offset : int, opcode : int, seg : int = None, lock : bool = False):
+        self.offset = offset
+        self.length = 0
+        self.opcode = opcode
+        self.op = None
+        self.w = None
+        self.d = None
+        self.s = None
+        self.mod = None
+        self.reg = None
+        self.rm = None
+        self.disp = None
+        self.imm = None
+        self.seg = seg
+        self.lock = lock
+        self.prefixes = None
+
+    @property
+    def mnemonic(self) -> str:
+        return MNEMONICS[self.op]
+
+    @property
+    def text(self) -> str:
+        if self.op == DATA_OP:
+            return _format_data(self)
+        if self.lock:
+            return 'lock ' + FORMAT_TABLE[self.opcode](self)
+        return FORMAT_TABLE[self.opcode](self)
+
+    def __str__(self) -> str:
+        return self.text
+
+    def __repr__(self) -> str:
+        return f'Instruction(offset={self.offset}, length={self.length}, text={self.text!r})'
+
+class DecodeState:
+    """
+    Prefix state carried from one byte to the next during a decode
+
+    Every decode has its own state, so decodes running at the same time
+    don't see each other's prefixes.
+
+    :ivar int seg: Index in SEG_REG of the pending segment override, used up
+        by the next instruction with a mod reg r/m byte
+    :ivar bool lock: A lock prefix is waiting for its instruction
+    :ivar mod_rm: Called by the decoders to read a mod reg r/m byte,
+        mod_rm_schema() unless the decode is being profiled
+    """
+    __slots__ = ('seg', 'lock', 'mod_rm')
+
+    def __init__(self, seg : int = None, lock : bool = False, mod_rm = None):
+        self.seg = seg
+        self.lock = lock
+        self.mod_rm = mod_rm_schema if mod_rm is None else mod_rm
+
+    def copy(self) -> 'DecodeState':
+        return DecodeState(self.seg, self.lock, self.mod_rm)
+
+def mod_rm_schema(ins : Instruction, buf : ByteBuffer, pos : int, state : DecodeState) -> int:
     """
     Handles instructions that use mod and r/m
 
-    :param int mod: The value of mod [0b00 -> 0b11]
-    :param int rm: The value of rm [0b000 -> 0b111]
-    :param io.BufferedReader file_handle: The handle of the file
-    :param list[str] reg_table: Table of registers used, can be None if 
-        operation never takes code path (TODO: further investigation)
-    :return: A str operand
-    :rtype: str
+    Reads the mod reg r/m byte and any displacement into ins, and uses up
+    the segment override prefix.
+
+    :param Instruction ins: The instruction being decoded
+    :param ByteBuffer buf: The buffer being decoded
+    :param int pos: Position in buf of the mod reg r/m byte
+    :param DecodeState state: Prefix state of the decode
+    :return: The position after the displacement
+    :rtype: int
     """
-    global g_seg_override_prefix
-    operand : str = ''
+    byte2 = buf[pos]
+    mod = (byte2 >> 6) & MOD_MASK
+    rm = byte2 & RM_MASK
+    ins.mod = mod
+    ins.reg = (byte2 >> 3) & REG_MASK
+    ins.rm = rm
+    pos += 1
     # Memory Mode, no displacement follows*
-    if mod == 0b00: 
+    if mod == 0b00:
         if rm == 0b110: # Direct address
-            disp_bytes = int.from_bytes(file_handle.read(2),'little')
-            operand = f'{g_seg_override_prefix}[{disp_bytes}]'
-        else:
-            operand = f'{g_seg_override_prefix}[{EFFECTIVE_ADDR[rm]}]'
+            ins.disp = read_u16(buf,pos)
+            pos += 2
 
     # Memory Mode, 8-bit displacement follows
-    elif mod == 0b01: 
-        disp = from_twos_complement(int.from_bytes(file_handle.read(1)),8)
-        operand = f'{g_seg_override_prefix}[{EFFECTIVE_ADDR[rm]} {'+'if disp >= 0 else '-'} {abs(disp)}]'
+    elif mod == 0b01:
+        ins.disp = from_twos_complement(buf[pos],8)
+        pos += 1
 
     # Memory Mode, 16-bit displacement follows
-    elif mod == 0b10: 
-        disp = from_twos_complement(int.from_bytes(file_handle.read(2),'little'),16)
-        operand = f'{g_seg_override_prefix}[{EFFECTIVE_ADDR[rm]} {'+'if disp >= 0 else '-'} {abs(disp)}]'
+    elif mod == 0b10:
+        ins.disp = from_twos_complement(read_u16(buf,pos),16)
+        pos += 2
 
     # Register Mode (no displacement)
-    elif mod == 0b11: 
-        operand = reg_table[rm]
-    g_seg_override_prefix = ''
-    return operand
+    state.seg = None
+    return pos
 
-g_seg_override_prefix = ''
-def decode_8086(file_path) -> str:
+# Memory operands for every segment override (None when there is none),
+# built once so formatting only has to add the displacement
+_SEG_OVERRIDES = {None : '', **{i : prefix for i, prefix in enumerate(SEG_PREFIX)}}
+# mod = 00, no displacement
+EA_OPERANDS = {seg : [f'{prefix}[{ea}]' for ea in EFFECTIVE_ADDR] for seg, prefix in _SEG_OVERRIDES.items()}
+# mod = 01 or 10, displacement and ']' still to come
+EA_DISP_BASES = {seg : [f'{prefix}[{ea}' for ea in EFFECTIVE_ADDR] for seg, prefix in _SEG_OVERRIDES.items()}
+# mod = 00 and r/m = 110, address and ']' still to come
+DIRECT_ADDR_BASES = {seg : f'{prefix}[' for seg, prefix in _SEG_OVERRIDES.items()}
 
-    global g_seg_override_prefix
-    with open(file_path,'rb') as file:
-        is_locked = False
-        out_str = 'bits 16'
-        operands : list[str] = ['','']
+def rm_operand(ins : Instruction, reg_table : list[str], keep_zero_disp : bool = False) -> str:
+    """
+    Formats the operand selected by mod and r/m
 
-        while True:
-            byte1 = file.read(1)
-            if byte1 == b'':
+    :param Instruction ins: An instruction decoded by mod_rm_schema()
+    :param list[str] reg_table: Table of registers used in register mode
+    :param bool keep_zero_disp: Write a displacement of 0 as ' + 0' instead
+        of leaving it out, so the binary keeps its displacement byte(s)
+    :return: A str operand
+    :rtype: str
+    """
+    mod = ins.mod
+    # Register Mode (no displacement)
+    if mod == 0b11:
+        return reg_table[ins.rm]
+    # Memory Mode, no displacement follows*
+    if mod == 0b00:
+        if ins.rm == 0b110: # Direct address
+            return f'{DIRECT_ADDR_BASES[ins.seg]}{ins.disp}]'
+        return EA_OPERANDS[ins.seg][ins.rm]
+    # Memory Mode, 8 or 16-bit displacement follows
+    disp = ins.disp
+    base = EA_DISP_BASES[ins.seg][ins.rm]
+    if disp > 0:
+        return f'{base} + {disp}]'
+    if disp < 0:
+        return f'{base} - {-disp}]'
+    if keep_zero_disp:
+        return base + ' + 0]'
+    return base + ']'
+
+# Instruction decoders
+# Each decoder is called with an Instruction holding the first byte, the
+# buffer, the position just after that byte and the prefix state. It fills in the fields of the
+# instruction and returns the position of the next instruction (None if
+# decoding can't continue).
+# Each formatter takes a decoded Instruction and returns its text.
+
+# TEST/XCHG/MOV Register/Memory <-> Register
+def _decode_mov_rm_reg(ins : Instruction, byte1 : int, buf : ByteBuffer, pos : int, state : DecodeState) -> int:
+    ins.d = (byte1 >> 1) & BIT_0 # Determines direction of operands
+    ins.w = byte1 & BIT_0 # Word or byte
+    if ((byte1 >> 2) & BIT_0) == 0b1:
+        if byte1 >> 1 & BIT_0 == 0b1:
+            ins.op = MNEMONIC_ID['xchg']
+        else:
+            ins.op = MNEMONIC_ID['test']
+    else:
+        ins.op = MNEMONIC_ID['mov']
+    return state.mod_rm(ins,buf,pos,state)
+
+def _format_mov_rm_reg(ins : Instruction) -> str:
+    d = ins.d
+    if ins.op == MNEMONIC_ID['xchg']:
+        d = 0 # Direction fixed for matching binaries
+    reg_table = REG_TABLE[ins.w]
+    operands = [reg_table[ins.reg], rm_operand(ins,reg_table)]
+    operands = operands[::DIRECTION[d]]
+    return f'{MNEMONICS[ins.op]} {operands[0]}, {operands[1]}'
+
+# MOV Immediate to Register
+def _decode_mov_imm_reg(ins : Instruction, byte1 : int, buf : ByteBuffer, pos : int, state : DecodeState) -> int:
+    w = (byte1 >> 3) & BIT_0
+    ins.op = MNEMONIC_ID['mov']
+    ins.w = w
+    ins.reg = byte1 & IMMREG_MASK
+    if w == 0:
+        ins.imm = buf[pos]
+    else:
+        ins.imm = read_u16(buf,pos)
+    return pos+w+1
+
+def _format_mov_imm_reg(ins : Instruction) -> str:
+    return f'mov {REG_TABLE[ins.w][ins.reg]}, {ins.imm}'
+
+# MOV Immediate to Register/Memory
+def _decode_mov_imm_rm(ins : Instruction, byte1 : int, buf : ByteBuffer, pos : int, state : DecodeState) -> int:
+    w = byte1 & BIT_0
+    ins.op = MNEMONIC_ID['mov']
+    ins.w = w
+    pos = state.mod_rm(ins,buf,pos,state)
+    if w == 0:
+        ins.imm = buf[pos]
+        return pos+1
+    ins.imm = read_u16(buf,pos)
+    return pos+2
+
+def _format_mov_imm_rm(ins : Instruction) -> str:
+    prefixes = ['byte ','word ']
+    return f'mov {rm_operand(ins,REG_TABLE[ins.w],True)}, {prefixes[ins.w]}{ins.imm}'
+
+# MOV SR<->REG/MEM
+def _decode_mov_sr(ins : Instruction, byte1 : int, buf : ByteBuffer, pos : int, state : DecodeState) -> int:
+    ins.op = MNEMONIC_ID['mov']
+    ins.d = (byte1 >> 1) & BIT_0
+    ins.w = byte1 & BIT_0
+    return state.mod_rm(ins,buf,pos,state)
+
+def _format_mov_sr(ins : Instruction) -> str:
+    sr = ins.reg & (BIT_1 | BIT_0)
+    operands = [rm_operand(ins,REG_TABLE[ins.w],True),SEG_REG[sr]]
+    operands = operands[::-DIRECTION[ins.d]]
+    return f'mov {operands[0]}, {operands[1]}'
+
+# TEST Accumulator
+def _decode_test_acc(ins : Instruction, byte1 : int, buf : ByteBuffer, pos : int, state : DecodeState) -> int:
+    w = byte1 & BIT_0
+    ins.op = MNEMONIC_ID['test']
+    ins.w = w
+    if w == 0:
+        ins.imm = buf[pos]
+        return pos+1
+    ins.imm = read_u16(buf,pos)
+    return pos+2
+
+def _format_test_acc(ins : Instruction) -> str:
+    accs = ['al','ax']
+    return f'test {accs[ins.w]}, {ins.imm}'
+
+# Memory to Accumulator / Accumulator to Memory
+def _decode_mov_mem_acc(ins : Instruction, byte1 : int, buf : ByteBuffer, pos : int, state : DecodeState) -> int:
+    ins.op = MNEMONIC_ID['mov']
+    ins.d = (byte1 >> 1) & BIT_0
+    ins.w = byte1 & BIT_0
+    ins.disp = read_u16(buf,pos)
+    return pos+2
+
+def _format_mov_mem_acc(ins : Instruction) -> str:
+    accs = ['al','ax'] # low portion of AX?
+    if ins.d == 0:
+        return f'mov {accs[ins.w]}, [{ins.disp}]'
+    return f'mov [{ins.disp}], {accs[ins.w]}'
+
+# Immediate with register/memory
+# 0b100000sw [mod000r/m -> mod111r/m]
+def _decode_immed_rm(ins : Instruction, byte1 : int, buf : ByteBuffer, pos : int, state : DecodeState) -> int:
+    w = byte1 & BIT_0
+    s = (byte1 >> 1) & BIT_0
+    ins.w = w
+    ins.s = s
+    pos = state.mod_rm(ins,buf,pos,state)
+    ins.op = MNEMONIC_ID[OP_GROUP_IMMED[ins.reg]]
+    # Sign extend 8-bit immediate data to 16 bits if w == 1
+    if w == 1 and s == 0:
+        ins.imm = read_u16(buf,pos)
+        return pos+2
+    ins.imm = buf[pos]
+    return pos+1
+
+def _format_immed_rm(ins : Instruction) -> str:
+    prefixes = ['byte ','word ']
+    src = prefixes[ins.w]
+    if ins.mod == 0b11:
+        src = ''
+    if ins.w == 1 and ins.s == 1 and ins.mod == 0b00 and ins.rm == 0b110:
+        src += 'word '
+    return f'{MNEMONICS[ins.op]} {rm_operand(ins,REG_TABLE[ins.w],True)}, {src}{ins.imm}'
+
+# Handle OP_GROUP_IMMED (REG_MEM <-> REG_MEM)
+# [0b000000dw -> 0b001110dw]
+def _decode_arith_rm_reg(ins : Instruction, byte1 : int, buf : ByteBuffer, pos : int, state : DecodeState) -> int:
+    ins.d = (byte1 >> 1) & BIT_0 # Determines direction of operands
+    ins.w = byte1 & BIT_0 # Word or byte
+    ins.op = MNEMONIC_ID[OP_GROUP_IMMED[(byte1 & (BIT_5 | BIT_4 | BIT_3))>>3]]
+    return state.mod_rm(ins,buf,pos,state)
+
+def _format_arith_rm_reg(ins : Instruction) -> str:
+    reg_table = REG_TABLE[ins.w]
+    operands = [reg_table[ins.reg], rm_operand(ins,reg_table)]
+
+    # Swap operands
+    operands = operands[::DIRECTION[ins.d]]
+    return f'{MNEMONICS[ins.op]} {operands[0]}, {operands[1]}'
+
+# Handle OP_GROUP_IMMED IMM_ACC
+def _decode_arith_imm_acc(ins : Instruction, byte1 : int, buf : ByteBuffer, pos : int, state : DecodeState) -> int:
+    w = byte1 & BIT_0 # Word or byte
+    ins.w = w
+    ins.op = MNEMONIC_ID[OP_GROUP_IMMED[(byte1 & (BIT_5 | BIT_4 | BIT_3))>>3]]
+    if w == 0: # low portion of AX?
+        ins.imm = buf[pos]
+        return pos+1
+    ins.imm = read_u16(buf,pos)
+    return pos+2
+
+def _format_arith_imm_acc(ins : Instruction) -> str:
+    if ins.w == 0:
+        return f'{MNEMONICS[ins.op]} al, {from_twos_complement(ins.imm,8)}'
+    return f'{MNEMONICS[ins.op]} ax, {from_twos_complement(ins.imm,16)}'
+
+# Handle OP_GROUP_SHIFT
+def _decode_shift(ins : Instruction, byte1 : int, buf : ByteBuffer, pos : int, state : DecodeState) -> int:
+    ins.d = (byte1 >> 1) & BIT_0 # v, shift by 1 or by cl
+    ins.w = byte1 & BIT_0
+    pos = state.mod_rm(ins,buf,pos,state)
+    ins.op = MNEMONIC_ID[OP_GROUP_SHIFT[ins.reg]]
+    return pos
+
+def _format_shift(ins : Instruction) -> str:
+    shift_count = ['1','cl']
+    prefixes = ['byte ','word ']
+    operand = rm_operand(ins,REG_TABLE[ins.w])
+    if ins.mod == 0b11:
+        return f'{MNEMONICS[ins.op]} {operand}, {shift_count[ins.d]}'
+    return f'{MNEMONICS[ins.op]} {prefixes[ins.w]}{operand}, {shift_count[ins.d]}'
+
+# Handle CONTROL TRANSFER
+def _decode_ctrl_transfer(ins : Instruction, byte1 : int, buf : ByteBuffer, pos : int, state : DecodeState) -> int:
+    ins.op = MNEMONIC_ID[CTRL_TRNSFR_OPS[byte1]]
+    ins.disp = from_twos_complement(buf[pos],8)
+    return pos+1
+
+def _format_ctrl_transfer(ins : Instruction) -> str:
+    disp = ins.disp + 2
+    return f'{MNEMONICS[ins.op]} ${'+'if disp >= 0 else '-'}{abs(disp)}'
+
+# Handle string ops
+def _decode_str_op(ins : Instruction, byte1 : int, buf : ByteBuffer, pos : int, state : DecodeState) -> int:
+    if STR_OPS[byte1 >> 1] == 'rep':
+        byte2 = buf[pos]
+        if byte2 >> 1 not in STR_OPS:
+            return None
+        ins.op = MNEMONIC_ID[STR_OPS[byte2 >> 1]]
+        ins.w = byte2 & BIT_0
+        return pos+1
+    ins.op = MNEMONIC_ID[STR_OPS[byte1 >> 1]]
+    ins.w = byte1 & BIT_0 # z not used?
+    return pos
+
+def _format_str_op(ins : Instruction) -> str:
+    suffix = ['b','w']
+    if STR_OPS[ins.opcode >> 1] == 'rep':
+        return f'rep {MNEMONICS[ins.op]}{suffix[ins.w]}'
+    return f'{MNEMONICS[ins.op]}{suffix[ins.w]}'
+
+# Handle OP_GROUP_1 and OP_GROUP_2 + pop
+# Register/memory
+def _decode_group_rm(ins : Instruction, byte1 : int, buf : ByteBuffer, pos : int, state : DecodeState) -> int:
+    w = byte1 & BIT_0
+    ins.w = w
+    pos = state.mod_rm(ins,buf,pos,state)
+    op = OP_GROUP[(byte1>>3) & 0b1][ins.reg]
+    # Pop works the same but doesn't have share the op code pattern
+    if byte1 == 0b10001111:
+        ins.op = MNEMONIC_ID['pop']
+    else:
+        ins.op = MNEMONIC_ID[op]
+
+    # Handle Special cases
+    if op == 'test': # special case for test
+        if w == 0:
+            ins.imm = buf[pos]
+        else:
+            ins.imm = read_u16(buf,pos)
+        pos += w+1
+    return pos
+
+def _format_group_rm(ins : Instruction) -> str:
+    op = OP_GROUP[(ins.opcode>>3) & 0b1][ins.reg]
+    prefixes = ['byte ','word ']
+    operands = [rm_operand(ins,REG_TABLE[ins.w]),'']
+
+    if op == 'call' or op == 'jmp':
+        if ins.reg & 0b1: # far
+            operands[0] = 'far ' + operands[0]
+        prefixes = ['','']
+    if ins.imm is not None:
+        operands[1] = f', {ins.imm}'
+    if ins.mod == 0b11:
+        return f'{MNEMONICS[ins.op]} {operands[0]}{operands[1]}'
+    return f'{MNEMONICS[ins.op]} {prefixes[ins.w]}{operands[0]}{operands[1]}'
+
+# INC/DEC/PUSH/POP Register
+def _decode_inc_dec_push_pop_reg(ins : Instruction, byte1 : int, buf : ByteBuffer, pos : int, state : DecodeState) -> int:
+    ops = ['inc','dec','push','pop']
+    ins.op = MNEMONIC_ID[ops[(byte1 >> 3)-8]]
+    ins.w = 1
+    ins.reg = byte1 & REG_MASK
+    return pos
+
+def _format_reg16(ins : Instruction) -> str:
+    return f'{MNEMONICS[ins.op]} {REG_TABLE_W1[ins.reg]}'
+
+# CALL/JMP Direct Intersegment
+def _decode_far_direct(ins : Instruction, byte1 : int, buf : ByteBuffer, pos : int, state : DecodeState) -> int:
+    ops = {0b10011010 : 'call', 0b11101010 : 'jmp'}
+    ins.op = MNEMONIC_ID[ops[byte1]]
+    ins.imm = read_u16(buf,pos)
+    ins.disp = read_u16(buf,pos+2)
+    return pos+4
+
+def _format_far_direct(ins : Instruction) -> str:
+    return f'{MNEMONICS[ins.op]} {ins.disp}:{ins.imm}'
+
+# CALL/JMP Direct within segment
+def _decode_near_direct(ins : Instruction, byte1 : int, buf : ByteBuffer, pos : int, state : DecodeState) -> int:
+    ops = {0b11101000 : 'call', 0b11101001 : 'jmp'}
+    ins.op = MNEMONIC_ID[ops[byte1]]
+    ins.disp = from_twos_complement(read_u16(buf,pos),16)
+    return pos+2
+
+def _format_near_direct(ins : Instruction) -> str:
+    disp = ins.disp + 3
+    return f'{MNEMONICS[ins.op]} ${'+'if disp >= 0 else '-'}{abs(disp)}'
+
+# RET adding immediate to SP
+def _decode_ret_imm(ins : Instruction, byte1 : int, buf : ByteBuffer, pos : int, state : DecodeState) -> int:
+    ops = {0b11000010 : 'ret', 0b11001010 : 'retf'}
+    ins.op = MNEMONIC_ID[ops[byte1]]
+    ins.imm = read_u16(buf,pos)
+    return pos+2
+
+def _format_ret_imm(ins : Instruction) -> str:
+    # RET IMMED16(intraseg)
+    if ins.opcode == 0b11000010:
+        return f'ret {from_twos_complement(ins.imm,16)}'
+    # RET Intersegment adding immediate to SP
+    return f'retf {ins.imm}'
+
+# XCHG Register with accumulator
+def _decode_xchg_acc(ins : Instruction, byte1 : int, buf : ByteBuffer, pos : int, state : DecodeState) -> int:
+    ins.op = MNEMONIC_ID['xchg']
+    ins.w = 1
+    ins.reg = byte1 & 0b111
+    return pos
+
+def _format_xchg_acc(ins : Instruction) -> str:
+    return f'xchg ax, {REG_TABLE_W1[ins.reg]}'
+
+# IN/OUT IMMED8 and IN/OUT DX
+def _decode_in_out(ins : Instruction, byte1 : int, buf : ByteBuffer, pos : int, state : DecodeState) -> int:
+    in_out = ['in','out']
+    ins.d = (byte1 >> 1) & BIT_0
+    ins.w = byte1 & BIT_0
+    ins.op = MNEMONIC_ID[in_out[ins.d]]
+    # Port is in dx
+    if byte1 & BIT_3:
+        return pos
+    ins.imm = buf[pos]
+    return pos+1
+
+def _format_in_out(ins : Instruction) -> str:
+    al_ax = ['al','ax']
+    port = 'dx' if ins.imm is None else ins.imm
+    operands = [al_ax[ins.w], port]
+    operands = operands[::-DIRECTION[ins.d]]
+    return f'{MNEMONICS[ins.op]} {operands[0]}, {operands[1]}'
+
+# LOAD_OPS
+def _decode_load(ins : Instruction, byte1 : int, buf : ByteBuffer, pos : int, state : DecodeState) -> int:
+    ins.op = MNEMONIC_ID[LOAD_OPS[byte1]]
+    ins.w = 1
+    return state.mod_rm(ins,buf,pos,state)
+
+def _format_load(ins : Instruction) -> str:
+    return f'{MNEMONICS[ins.op]} {REG_TABLE_W1[ins.reg]}, {rm_operand(ins,REG_TABLE_W1)}'
+
+# AAM/AAD, second byte is always 0b00001010
+def _decode_ascii_adjust(ins : Instruction, byte1 : int, buf : ByteBuffer, pos : int, state : DecodeState) -> int:
+    ins.op = SINGLE_BYTE_OP_IDS[byte1]
+    ins.imm = buf[pos] # Not used?
+    return pos+1
+
+# INT IMMED
+def _decode_int_imm(ins : Instruction, byte1 : int, buf : ByteBuffer, pos : int, state : DecodeState) -> int:
+    ins.op = MNEMONIC_ID['int']
+    ins.imm = buf[pos]
+    return pos+1
+
+def _format_int_imm(ins : Instruction) -> str:
+    return f'int {ins.imm}'
+
+# Instructions made of a single opcode byte
+def _decode_single_byte(ins : Instruction, byte1 : int, buf : ByteBuffer, pos : int, state : DecodeState) -> int:
+    ins.op = SINGLE_BYTE_OP_IDS[byte1]
+    return pos
+
+def _format_single_byte(ins : Instruction) -> str:
+    return SINGLE_BYTE_OPS[ins.opcode]
+
+# A lock prefix with no instruction after it
+def _format_lock(ins : Instruction) -> str:
+    return 'lock '
+
+# A byte that couldn't be decoded, from a decode that isn't strict
+def _format_data(ins : Instruction) -> str:
+    return f'db {ins.imm:#04x}'
+
+SINGLE_BYTE_OPS = {}
+SINGLE_BYTE_OPS[0b00001110] = 'push cs'
+SINGLE_BYTE_OPS[0b00011111] = 'pop ds'
+SINGLE_BYTE_OPS[0b10010000] = 'nop ;== xchg ax, ax'
+SINGLE_BYTE_OPS[0b11010111] = 'xlat'
+SINGLE_BYTE_OPS[0b11000011] = 'ret'     # RET (intrasegment)
+SINGLE_BYTE_OPS[0b11001011] = 'retf'    # RET (intersegment)
+SINGLE_BYTE_OPS[0b10011111] = 'lahf'
+SINGLE_BYTE_OPS[0b10011110] = 'sahf'
+SINGLE_BYTE_OPS[0b10011100] = 'pushf'
+SINGLE_BYTE_OPS[0b10011101] = 'popf'
+SINGLE_BYTE_OPS[0b00110111] = 'aaa'
+SINGLE_BYTE_OPS[0b00100111] = 'daa'
+SINGLE_BYTE_OPS[0b00111111] = 'aas'
+SINGLE_BYTE_OPS[0b00101111] = 'das'
+SINGLE_BYTE_OPS[0b11010100] = 'aam'
+SINGLE_BYTE_OPS[0b11010101] = 'aad'
+SINGLE_BYTE_OPS[0b10011000] = 'cbw'
+SINGLE_BYTE_OPS[0b10011001] = 'cwd'
+SINGLE_BYTE_OPS[0b11001100] = 'int3'
+SINGLE_BYTE_OPS[0b11001110] = 'into'
+SINGLE_BYTE_OPS[0b11001111] = 'iret'
+SINGLE_BYTE_OPS[0b10011011] = 'wait'
+SINGLE_BYTE_OPS[0b11111000] = 'clc'
+SINGLE_BYTE_OPS[0b11110100] = 'hlt'
+SINGLE_BYTE_OPS[0b11110101] = 'cmc'
+SINGLE_BYTE_OPS[0b11111010] = 'cli'
+SINGLE_BYTE_OPS[0b11111001] = 'stc'
+SINGLE_BYTE_OPS[0b11111011] = 'sti'
+SINGLE_BYTE_OPS[0b11111100] = 'cld'
+SINGLE_BYTE_OPS[0b11111101] = 'std'
+
+LOCK_PREFIX = 0b11110000
+
+# Every mnemonic the decoder can produce, Instruction.op indexes this list
+MNEMONICS = []
+for _name in [*OP_GROUP_IMMED, *OP_GROUP_SHIFT, *OP_GROUP_1, *OP_GROUP_2,
+              *STR_OPS.values(), *LOAD_OPS.values(), *CTRL_TRNSFR_OPS.values(),
+              'mov', 'xchg', 'pop', 'in', 'out', 'int', 'ret', 'retf', 'lock',
+              *(text.split(' ')[0] for text in SINGLE_BYTE_OPS.values()), 'db']:
+    if _name not in MNEMONICS:
+        MNEMONICS.append(_name)
+MNEMONIC_ID = {name : i for i, name in enumerate(MNEMONICS)}
+# Op of the records holding a byte that couldn't be decoded
+DATA_OP = MNEMONIC_ID['db']
+SINGLE_BYTE_OP_IDS = {byte : MNEMONIC_ID[text.split(' ')[0]] for byte, text in SINGLE_BYTE_OPS.items()}
+
+# Opcode patterns, checked in order. The first pattern matching a byte
+# decides the decoder and formatter for that byte.
+DECODE_PATTERNS = \
+[
+    (lambda b: b in range(0b10000100,0b10001011+1),         _decode_mov_rm_reg,     _format_mov_rm_reg),
+    (lambda b: (b >> 4) == 0b1011,                          _decode_mov_imm_reg,    _format_mov_imm_reg),
+    (lambda b: (b >> 1) == 0b1100011,                       _decode_mov_imm_rm,     _format_mov_imm_rm),
+    (lambda b: b & 0b11111101 == 0b10001100,                _decode_mov_sr,         _format_mov_sr),
+    (lambda b: b & 0b11111110 == 0b10101000,                _decode_test_acc,       _format_test_acc),
+    (lambda b: (b >> 2) == 0b101000,                        _decode_mov_mem_acc,    _format_mov_mem_acc),
+    (lambda b: (b >> 2) == 0b100000,                        _decode_immed_rm,       _format_immed_rm),
+    (lambda b: (b & 0b11000100) == 0b0,                     _decode_arith_rm_reg,   _format_arith_rm_reg),
+    (lambda b: (b & 0b11000110) == 0b00000100,              _decode_arith_imm_acc,  _format_arith_imm_acc),
+    (lambda b: (b & 0b11111100) == 0b11010000,              _decode_shift,          _format_shift),
+    (lambda b: b in CTRL_TRNSFR_OPS,                        _decode_ctrl_transfer,  _format_ctrl_transfer),
+    (lambda b: b >> 1 in STR_OPS,                           _decode_str_op,         _format_str_op),
+    (lambda b: (b & 0b11110110) == 0b11110110 or b == 0b10001111, _decode_group_rm, _format_group_rm),
+    (lambda b: (b >> 3) in range(8,12),                     _decode_inc_dec_push_pop_reg, _format_reg16),
+    (lambda b: b in (0b10011010, 0b11101010),               _decode_far_direct,     _format_far_direct),
+    (lambda b: b in (0b11101000, 0b11101001),               _decode_near_direct,    _format_near_direct),
+    (lambda b: b in (0b11000010, 0b11001010),               _decode_ret_imm,        _format_ret_imm),
+    (lambda b: b in range(0b10010001,0b10010111+1),         _decode_xchg_acc,       _format_xchg_acc),
+    (lambda b: b in range(0b11100100,0b11100111+1),         _decode_in_out,         _format_in_out),
+    (lambda b: b in range(0b11101100,0b11101111+1),         _decode_in_out,         _format_in_out),
+    (lambda b: b in LOAD_OPS,                               _decode_load,           _format_load),
+    (lambda b: b in (0b11010100, 0b11010101),               _decode_ascii_adjust,   _format_single_byte),
+    (lambda b: b == 0b11001101,                             _decode_int_imm,        _format_int_imm),
+    (lambda b: b in SINGLE_BYTE_OPS,                        _decode_single_byte,    _format_single_byte),
+]
+
+# Decoder and formatter for every possible first byte, None if not recognized
+DECODE_TABLE = [None] * 256
+FORMAT_TABLE = [None] * 256
+for _byte in range(256):
+    for _matches, _decoder, _formatter in DECODE_PATTERNS:
+        if _matches(_byte):
+            DECODE_TABLE[_byte] = _decoder
+            FORMAT_TABLE[_byte] = _formatter
+            break
+FORMAT_TABLE[LOCK_PREFIX] = _format_lock
+
+# Codes in length_table() besides lengths
+LENGTH_STOP = 0             # Not recognized, decoding stops
+LENGTH_SEG_PREFIX = 0x80    # Segment override prefix
+LENGTH_LOCK = 0x81          # Lock prefix
+
+def _probe_length(byte1 : int, byte2 : int) -> int:
+    """Length of an instruction starting with byte1 byte2, found by decoding it"""
+    if byte1 == LOCK_PREFIX:
+        return LENGTH_LOCK
+    if byte1 & 0b11100111 == 0b00100110:
+        return LENGTH_SEG_PREFIX
+    decoder = DECODE_TABLE[byte1]
+    if decoder is None:
+        return LENGTH_STOP
+    # Only the first two bytes decide the length, the rest are padding
+    next_pos = decoder(Instruction(0, byte1), byte1, bytes([byte1, byte2, 0, 0, 0, 0]), 1, DecodeState())
+    return LENGTH_STOP if next_pos is None else next_pos
+
+@functools.cache
+def length_table() -> bytes:
+    """
+    Length (or code) of an instruction by (first byte << 8) | second byte
+
+    Probing every pair of bytes takes about 100 ms, so the table is built on
+    first use rather than when the module is imported. Decoders that read
+    only the first byte repeat the same length 256 times.
+
+    :rtype: bytes
+    """
+    return bytes(_probe_length(byte1, byte2) for byte1 in range(256) for byte2 in range(256))
+
+class Coverage:
+    """
+    Bytes that a decode which isn't strict wrote as data
+
+    :ivar collections.Counter opcodes: Times each first byte couldn't be
+        decoded, as an unrecognized opcode, a rep before a non-string op or
+        an instruction cut off by the end of the input
+    :ivar int data_bytes: Bytes written as db, including prefixes
+    """
+    __slots__ = ('opcodes', 'data_bytes')
+
+    def __init__(self):
+        self.opcodes = collections.Counter()
+        self.data_bytes = 0
+
+    def decoded_percent(self, size : int) -> float:
+        """Percentage of size bytes decoded as instructions"""
+        return 100.0 if size == 0 else 100.0 * (size - self.data_bytes) / size
+
+    def histogram(self) -> str:
+        """The opcodes that couldn't be decoded, most frequent first"""
+        return ', '.join(f'{opcode:#04x} x{count}' for opcode, count in self.opcodes.most_common())
+
+def _data(offset : int, byte : int) -> Instruction:
+    """Record of a byte that couldn't be decoded"""
+    ins = Instruction(offset, byte)
+    ins.op = DATA_OP
+    ins.imm = byte
+    ins.length = 1
+    return ins
+
+def _iter_buffer(buf : ByteBuffer, state : DecodeState, pos : int = 0, base : int = 0, final : bool = True,
+                 decoders : list = DECODE_TABLE, strict : bool = True, coverage : Coverage = None) -> Generator[Instruction, None, int]:
+    """
+    Decodes instructions from buf[pos:]
+
+    :param ByteBuffer buf: The buffer being decoded
+    :param DecodeState state: Prefix state, updated as bytes are decoded
+    :param int pos: Position in buf to start at
+    :param int base: Added to positions in buf to give Instruction.offset
+    :param bool final: No more bytes follow buf. If False, an instruction
+        cut off by the end of buf is held back for the next call
+    :param list decoders: Decoder for every first byte, DECODE_TABLE unless
+        profiling
+    :param bool strict: Stop at the first instruction that can't be decoded.
+        If False, its bytes up to the opcode are written as db, one per
+        record, and decoding carries on after them
+    :param Coverage coverage: Counts the bytes written as db
+    :return: Generator of Instruction, returning the position to carry on
+        from or None if decoding can't continue
+    :rtype: Generator[Instruction, None, int]
+    """
+    start = pos
+    end = len(buf)
+
+    while pos < end:
+        byte1 = buf[pos]
+        pos += 1
+
+        # Set lock
+        if (byte1 == LOCK_PREFIX):
+            # A repeated lock is kept on its own line
+            if state.lock:
+                ins = Instruction(base + start, LOCK_PREFIX, state.seg)
+                ins.op = MNEMONIC_ID['lock']
+                ins.length = pos - 1 - start
+                ins.prefixes = bytes(buf[start:pos - 1])
+                yield ins
+                start = pos - 1
+            state.lock = True
+            continue
+
+        # Check if special prefix byte
+        if (byte1 & 0b11100111 == 0b00100110):
+            state.seg = (byte1 >> 3) & (BIT_1 | BIT_0)
+            continue
+
+        decoder = decoders[byte1]
+        # Catch unimplemented instructions
+        if decoder is None:
+            if strict:
+                print('Instruction not recognized:')
+                print(f'\t-> {bin(byte1)}')
+                pos -= 1
                 break
-            
-            # Set lock
-            if (byte1[0] == 0b11110000):
-                out_str += '\nlock '
-                is_locked = True
-                continue
+            next_pos = None
+        else:
+            ins = Instruction(base + start, byte1, state.seg, state.lock)
+            if pos - 1 > start:
+                ins.prefixes = bytes(buf[start:pos - 1])
+            # Catch instructions cut off by the end of the buffer
+            try:
+                next_pos = decoder(ins, byte1, buf, pos, state)
+            except IndexError:
+                if not final:
+                    # Prefixes are read again from start, so the override can
+                    # only be the one the instruction saw
+                    state.seg = ins.seg
+                    state.lock = False
+                    return start
+                if strict:
+                    print('Instruction truncated:')
+                    print(f'\t-> {bin(byte1)}')
+                    pos -= 1
+                    break
+                next_pos = None
+            # Only rep with a non-string op returns None
+            if next_pos is None and strict:
+                print("Tried to use rep with non-string op")
+                pos -= 1
+                break
+        if next_pos is None:
+            # Not strict, the prefixes and opcode become data and decoding
+            # resynchronizes on the next byte
+            if coverage is not None:
+                coverage.opcodes[byte1] += 1
+                coverage.data_bytes += pos - start
+            for offset in range(start, pos):
+                yield _data(base + offset, buf[offset])
+            state.seg = None
+            state.lock = False
+            start = pos
+            continue
+        pos = next_pos
+        ins.length = pos - start
+        yield ins
+        state.lock = False
+        start = pos
+    else:
+        # Prefixes at the end wait for their instruction
+        if not final:
+            state.lock = False
+            return start
+        # Not strict, segment prefixes with nothing after them become data
+        if not strict and state.seg is not None:
+            if coverage is not None:
+                coverage.opcodes[buf[pos - 1]] += 1
+                coverage.data_bytes += pos - start
+            for offset in range(start, pos):
+                yield _data(base + offset, buf[offset])
+            state.seg = None
+            state.lock = False
+
+    # A lock with nothing after it
+    if state.lock:
+        ins = Instruction(base + start, LOCK_PREFIX, state.seg)
+        ins.op = MNEMONIC_ID['lock']
+        ins.length = pos - start
+        ins.prefixes = bytes(buf[start:pos])
+        yield ins
+        state.lock = False
+    return pos if pos == end else None
+
+# Most instructions kept formatted by _format_bytes()
+MEMO_SIZE = 1 << 16
+# Instructions between checks of the memo's hit rate
+MEMO_WINDOW = 4096
+# Below this hit rate the memo is skipped for MEMO_RETRY_WINDOWS windows
+MEMO_MIN_HIT_RATE = 0.75
+MEMO_RETRY_WINDOWS = 8
+
+@functools.lru_cache(maxsize=MEMO_SIZE)
+def _format_bytes(data : bytes, seg : int) -> tuple[str, int]:
+    """
+    Formats one instruction with no prefixes
+
+    Code repeats the same encodings all the time, so the text is memoized by
+    the instruction bytes and the pending segment override.
+
+    :return: The text, and the segment override pending after the instruction
+    :rtype: tuple[str, int]
+    """
+    state = DecodeState(seg)
+    ins = Instruction(0, data[0], seg)
+    DECODE_TABLE[data[0]](ins, data[0], data, 1, state)
+    return ins.text, state.seg
+
+def memo_info() -> functools._CacheInfo:
+    """Hits, misses and size of the memo of formatted instructions"""
+    return _format_bytes.cache_info()
+
+def _iter_texts(buf : bytes | mmap.mmap, state : DecodeState, strict : bool = True,
+                coverage : Coverage = None) -> Iterator[tuple[int, int, str]]:
+    """
+    Decodes buf into (offset, length, text), like _iter_buffer() but with
+    the text of unprefixed instructions memoized by _format_bytes()
+
+    Looking up code that rarely repeats costs more than it saves, so the
+    memo is skipped for a while when too few lookups hit.
+    """
+    lengths = length_table()
+    decoders = DECODE_TABLE
+    memo = _format_bytes
+    use_memo = True
+    pos = 0
+    end = len(buf)
+    # Past here the second byte or the instruction may be missing
+    safe_end = end - 6
+    count = skipped = 0
+    last_hits, last_misses = memo.cache_info()[:2]
 
-            # Check if special prefix byte
-            if (byte1[0] & 0b11100111 == 0b00100110):
-                g_seg_override_prefix = f'{SEG_REG[(byte1[0] >> 3) & (BIT_1 | BIT_0)]}:'
+    while pos < end:
+        byte1 = buf[pos]
+        if pos < safe_end:
+            n = lengths[(byte1 << 8) | buf[pos+1]]
+            # Lengths are below the prefix codes, LENGTH_STOP is 0
+            usable = 0 < n < 0x80
+        else:
+            n = lengths[(byte1 << 8) | buf[pos+1]] if pos + 1 < end else lengths[byte1 << 8]
+            usable = 0 < n < 0x80 and pos + n <= end
+        if usable:
+            if use_memo:
+                text, state.seg = memo(buf[pos:pos+n], state.seg)
+            else:
+                ins = Instruction(pos, byte1, state.seg)
+                decoders[byte1](ins, byte1, buf, pos+1, state)
+                text = ins.text
+            yield pos, n, text
+            pos += n
+            count += 1
+            if count < MEMO_WINDOW:
                 continue
-            
-            if not is_locked:
-                out_str += '\n'
-            is_locked = False
-
-            # TEST/XCHG/MOV Register/Memory <-> Register
-            if (byte1[0] in range(0b10000100,0b10001011+1)):
-                byte2 = file.read(1)
-                d = (byte1[0] >> 1) & BIT_0 # Determines direction of operands
-                w = byte1[0] & BIT_0 # Word or byte
-                mod = (byte2[0] >> 6) & MOD_MASK
-                reg = (byte2[0] >> 3) & REG_MASK
-                if ((byte1[0] >> 2) & BIT_0) == 0b1:
-                    if byte1[0] >> 1 & BIT_0 == 0b1:
-                        op = 'xchg'
-                        d = 0 # Direction fixed for matching binaries
-                    else:
-                        op = 'test'
-                else:
-                    op = 'mov'
-                rm = byte2[0] & RM_MASK
-                reg_table = REG_TABLE[w]
-                operands = [reg_table[reg], mod_rm_schema(mod,rm,file,reg_table)]
-                operands = operands[::DIRECTION[d]]
-                # Remove displacements of 0
-                instruction = f'{op} {operands[0]}, {operands[1]}'.replace(' + 0','')
-                out_str += instruction
-            
-            # MOV Immediate to Register
-            elif (byte1[0] >> 4) == 0b1011:
-                w = (byte1[0] >> 3) & BIT_0
-                reg = byte1[0] & IMMREG_MASK
-                reg_table = REG_TABLE[w]
-                data = int.from_bytes(file.read(w+1),'little')
-                operands = [reg_table[reg], data]
-                out_str += f'mov {operands[0]}, {operands[1]}'
-
-            # MOV Immediate to Register/Memory
-            elif (byte1[0] >> 1) == 0b1100011:
-                byte2 = file.read(1)
-                w = byte1[0] & BIT_0
-                mod = (byte2[0] >> 6) & MOD_MASK
-                rm = byte2[0] & RM_MASK
-                operands[0] = mod_rm_schema(mod,rm,file)
-                if w == 0:
-                    operands[1] = f'byte {int.from_bytes(file.read(1))}'
-                else:
-                    operands[1] = f'word {int.from_bytes(file.read(2),'little')}'
-                out_str += f'mov {operands[0]}, {operands[1]}'
-
-            # MOV SR<->REG/MEM
-            elif (byte1[0] & 0b11111101 == 0b10001100):
-                d = (byte1[0] >> 1) & BIT_0
-                byte2 = file.read(1)
-                mod = (byte2[0] >> 6) & MOD_MASK
-                sr = (byte2[0] >> 3) & (BIT_1 | BIT_0)
-                rm = byte2[0] & RM_MASK
-                reg_table = REG_TABLE[0]
-                operands = [mod_rm_schema(mod,rm,file,reg_table),SEG_REG[sr]]
-                operands = operands[::-DIRECTION[d]]
-                out_str += f'mov {operands[0]}, {operands[1]}'
-
-            # TEST Accumulator
-            elif (byte1[0] & 0b11111110 == 0b10101000):
-                w = byte1[0] & BIT_0
-                accs = ['al','ax']
-                operands = [accs[w],int.from_bytes(file.read(w+1),'little')]
-                out_str += f'test {operands[0]}, {operands[1]}'
-
-            # Memory to Accumulator
-            elif (byte1[0] >> 1) == 0b1010000:
-                w = byte1[0] & BIT_0
-                addr = int.from_bytes(file.read(2),'little')
-                res = [f'mov al, [{addr}]',f'mov ax, [{addr}]']
-                out_str += res[w]
-
-            # Accumulator to Memory
-            elif (byte1[0] >> 1) == 0b1010001:
-                w = byte1[0] & BIT_0
-                addr = int.from_bytes(file.read(2),'little')
-                if w == 0: # low portion of AX?
-                    operands = [f'[{addr}]','al']
-                else:
-                    operands = [f'[{addr}]','ax']
-                out_str += f'mov {operands[0]}, {operands[1]}'
-
-            # Immediate with register/memory 
-            # 0b100000sw [mod000r/m -> mod111r/m]
-            elif (byte1[0] >> 2) == 0b100000:
-                byte2 = file.read(1)
-                w = byte1[0] & BIT_0
-                s = byte1[0] & BIT_1
-                mod = (byte2[0] >> 6) & MOD_MASK
-                op = OP_GROUP_IMMED[(byte2[0] & (BIT_5 | BIT_4 | BIT_3))>>3]
-                rm = byte2[0] & RM_MASK
-                reg_table = REG_TABLE[w]
-                prefixes = ['byte ','word ']
-                operands[0] = mod_rm_schema(mod,rm,file,reg_table)
-                operands[1] = prefixes[w]
-                if mod == 0b11:
-                    operands[1] = ''
-                if w == 0:
-                    operands[1] += f'{int.from_bytes(file.read(1))}'
-                else: # w == 1
-                    if s == 0:
-                        operands[1] += f'{int.from_bytes(file.read(2),'little')}'
-                    else: # s == 1  
-                        # Sign extend 8-bit immediate data to 16 bits if w == 1
-                        if (mod == 0b00 and rm == 0b110):
-                            operands[1] += f'word {int.from_bytes(file.read(1))}'
-                        else:
-                            operands[1] += f'{int.from_bytes(file.read(1))}'
-
-                out_str += f'{op} {operands[0]}, {operands[1]}'
-            
-            # Handle OP_GROUP_IMMED (REG_MEM <-> REG_MEM)
-            # [0b000000dw -> 0b001110dw]
-            elif (byte1[0] & 0b11000100) == 0b0:
-                byte2 = file.read(1)
-                d = (byte1[0] >> 1) & BIT_0 # Determines direction of operands
-                w = byte1[0] & BIT_0 # Word or byte
-                op = OP_GROUP_IMMED[(byte1[0] & (BIT_5 | BIT_4 | BIT_3))>>3]
-                mod = (byte2[0] >> 6) & MOD_MASK
-                reg = (byte2[0] >> 3) & REG_MASK
-                rm = byte2[0] & RM_MASK
-                reg_table = REG_TABLE[w]
-                operands[0] = reg_table[reg]
-                operands[1] = mod_rm_schema(mod,rm,file,reg_table)
-    
-                # Swap operands
-                operands = operands[::DIRECTION[d]]
-
-                instruction = f'{op} {operands[0]}, {operands[1]}'.replace(' + 0','')
-                out_str += instruction
-
-            # Handle OP_GROUP_IMMED IMM_ACC
-            elif (byte1[0] & 0b11000110) == 0b00000100:
-                w = byte1[0] & BIT_0 # Word or byte
-                op = OP_GROUP_IMMED[(byte1[0] & (BIT_5 | BIT_4 | BIT_3))>>3]
-                if w == 0: # low portion of AX?
-                    operands = ['al',f'{from_twos_complement(int.from_bytes(file.read(1)),8)}']
-                else:
-                    operands = ['ax',f'{from_twos_complement(int.from_bytes(file.read(2),'little'),16)}']
-                out_str += f'{op} {operands[0]}, {operands[1]}'
-            
-            # Handle OP_GROUP_SHIFT
-            elif (byte1[0] & 0b11111100) == 0b11010000:
-                byte2 = file.read(1)
-                shift_count = ['1','cl']
-                v = (byte1[0] >> 1) & BIT_0
-                w = byte1[0] & BIT_0
-                mod = (byte2[0] >> 6) & MOD_MASK
-                rm = byte2[0] & RM_MASK
-                reg_table = REG_TABLE[w]
-                op = OP_GROUP_SHIFT[(byte2[0] & (BIT_5 | BIT_4 | BIT_3))>>3]
-                operands = [mod_rm_schema(mod,rm,file,reg_table),shift_count[v]]
-                prefixes = ['byte ','word ']
-                
-                if mod == 0b11:
-                    out_str += f'{op} {operands[0]}, {operands[1]}'
-                else:
-                    out_str += f'{op} {prefixes[w]}{operands[0]}, {operands[1]}'.replace(' + 0','')
-
-            # Handle CONTROL TRANSFER
-            elif byte1[0] in CTRL_TRNSFR_OPS:
-                byte2 = file.read(1)
-                disp = from_twos_complement(byte2[0],8)
-                disp += 2
-                out_str += f'{CTRL_TRNSFR_OPS[byte1[0]]} ${'+'if disp >= 0 else '-'}{abs(disp)}'
-
-            # Handle string ops
-            elif byte1[0] >> 1 in STR_OPS:
-                wz = byte1[0] & BIT_0 # z not used?
-                op = STR_OPS[byte1[0] >> 1]
-                suffix = ['b','w']
-                if op == 'rep':
-                    byte2 = file.read(1)
-                    if byte2[0] >> 1 in STR_OPS:
-                        op2 = STR_OPS[byte2[0] >> 1]
-                        w = byte2[0] & BIT_0 
-                        out_str += f'rep {op2}{suffix[w]}'
-                    else:
-                        print("Tried to use rep with non-string op")
+            # Check how the memo did over the last window
+            count = 0
+            if use_memo:
+                hits, misses = memo.cache_info()[:2]
+                if hits - last_hits < MEMO_MIN_HIT_RATE * (hits - last_hits + misses - last_misses):
+                    use_memo = False
+                    skipped = 0
+            else:
+                skipped += 1
+                if skipped == MEMO_RETRY_WINDOWS:
+                    use_memo = True
+                    last_hits, last_misses = memo.cache_info()[:2]
+            continue
+
+        # Prefixes and stops take the full decoder, up to the first instruction
+        # that isn't a lock on its own or data
+        for ins in _iter_buffer(buf, state, pos, strict=strict, coverage=coverage):
+            yield ins.offset, ins.length, ins.text
+            pos = ins.offset + ins.length
+            if ins.opcode != LOCK_PREFIX and ins.op != DATA_OP:
+                break
+        else:
+            # Decoding stopped or reached the end
+            break
+        state.lock = False
+
+def decode_instructions(source : str | os.PathLike | ByteBuffer, strict : bool = True,
+                        coverage : Coverage = None) -> Iterator[Instruction]:
+    """
+    Decodes one instruction at a time into Instruction records
+
+    Prefix bytes belong to the instruction they precede, so the offset of
+    a prefixed instruction is the offset of its first prefix.
+
+    :param source: Path of a file to decode, or a buffer already in memory
+    :param bool strict: Stop at the first byte that can't be decoded. If
+        False, such bytes are records of op DATA_OP, formatted as db
+    :param Coverage coverage: Counts the bytes written as db
+    :return: Generator of Instruction
+    :rtype: Iterator[Instruction]
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source,'rb') as file:
+            # mmap can't map an empty file
+            if os.fstat(file.fileno()).st_size == 0:
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                yield from _iter_buffer(buf, DecodeState(), strict=strict, coverage=coverage)
+    else:
+        yield from _iter_buffer(source, DecodeState(), strict=strict, coverage=coverage)
+
+class StreamDecoder:
+    """
+    Decodes machine code that arrives in chunks, such as from a pipe or socket
+
+    Bytes are passed to feed() as they arrive, and each call returns the
+    instructions they complete. An instruction cut off by the end of a chunk,
+    along with any prefixes before it, is held back until the rest arrives.
+    close() decodes whatever is left once the input has ended.
+
+    :param bool strict: Stop at the first byte that can't be decoded, or
+        write it as db and carry on
+    :param Coverage coverage: Counts the bytes written as db
+    """
+    def __init__(self, strict : bool = True, coverage : Coverage = None):
+        self._buf = bytearray()
+        self._state = DecodeState()
+        self._base = 0          # Offset of _buf[0] in the whole input
+        self._strict = strict
+        self._coverage = coverage
+        self.size = 0           # Bytes fed so far
+        self.stopped = False    # Set once an instruction can't be decoded
+
+    def feed(self, data : ByteBuffer) -> list[Instruction]:
+        """
+        Adds bytes to the input
+
+        :param ByteBuffer data: The next chunk of input
+        :return: Instructions completed by data, in order
+        :rtype: list[Instruction]
+        """
+        self.size += len(data)
+        if self.stopped:
+            return []
+        self._buf += data
+        return self._decode(False)
+
+    def close(self) -> list[Instruction]:
+        """
+        Ends the input and decodes what was held back
+
+        :return: The remaining instructions
+        :rtype: list[Instruction]
+        """
+        if self.stopped:
+            return []
+        return self._decode(True)
+
+    def _decode(self, final : bool) -> list[Instruction]:
+        out = []
+        decoder = _iter_buffer(self._buf, self._state, 0, self._base, final, strict=self._strict, coverage=self._coverage)
+        while True:
+            try:
+                out.append(next(decoder))
+            except StopIteration as stop:
+                resume = stop.value
+                break
+        if resume is None:
+            self.stopped = True
+            resume = len(self._buf)
+        # Keep only the bytes held back
+        del self._buf[:resume]
+        self._base += resume
+        return out
+
+def decode_stream(stream, chunk_size : int = 1 << 16, decoder : StreamDecoder = None) -> Iterator[Instruction]:
+    """
+    Decodes a binary file object as it is read, without waiting for the end
+
+    :param stream: Binary file object, such as sys.stdin.buffer or a socket's makefile('rb')
+    :param int chunk_size: Most bytes to read at a time
+    :param StreamDecoder decoder: Decoder to feed, for reading its size afterwards
+    :return: Generator of Instruction
+    :rtype: Iterator[Instruction]
+    """
+    if decoder is None:
+        decoder = StreamDecoder()
+    # read1() returns what is available instead of waiting for a full chunk
+    read = getattr(stream, 'read1', stream.read)
+    while data := read(chunk_size):
+        yield from decoder.feed(data)
+    yield from decoder.close()
+
+def iter_instructions(source : str | os.PathLike | ByteBuffer, strict : bool = True,
+                      coverage : Coverage = None) -> Iterator[tuple[int, int, str]]:
+    """
+    Decodes one instruction at a time
+
+    :param source: Path of a file to decode, or a buffer already in memory
+    :param bool strict: Stop at the first byte that can't be decoded, or
+        write it as db and carry on
+    :param Coverage coverage: Counts the bytes written as db
+    :return: Generator of (byte offset, length in bytes, text) per instruction
+    :rtype: Iterator[tuple[int, int, str]]
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source,'rb') as file:
+            # mmap can't map an empty file
+            if os.fstat(file.fileno()).st_size == 0:
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                yield from _iter_texts(buf, DecodeState(), strict, coverage)
+    else:
+        # Memo keys are slices of the buffer, which have to be hashable
+        if not isinstance(source, (bytes, mmap.mmap)):
+            source = bytes(source)
+        yield from _iter_texts(source, DecodeState(), strict, coverage)
+
+def decode_8086_bytes(buf : ByteBuffer, strict : bool = True) -> str:
+    """
+    Decodes 8086 machine code held in memory
+
+    :param ByteBuffer buf: bytes, bytearray, memoryview or mmap to decode
+    :param bool strict: Stop at the first byte that can't be decoded, or
+        write it as db and carry on
+    :return: The disassembly, starting with 'bits 16'
+    :rtype: str
+    """
+    return '\n'.join(['bits 16', *(text for _, _, text in iter_instructions(buf, strict))])
+
+def decode_8086(file_path, strict : bool = True) -> str:
+    return '\n'.join(['bits 16', *(text for _, _, text in iter_instructions(file_path, strict))])
+
+# Offsets after a chunk start that are decoded speculatively, an instruction
+# is at most 6 bytes so one of them is where the real stream enters
+SPECULATIVE_CANDIDATES = 6
+# Files smaller than this aren't worth splitting across processes
+PARALLEL_MIN_SIZE = 1 << 22
+
+class Speculation(NamedTuple):
+    """Instructions decoded from a guessed start offset, with no prefix pending"""
+    offsets : list[int]
+    lengths : list[int]
+    texts : list[str]
+    segs : list[int]        # DecodeState.seg after each instruction
+    end : int               # Offset after the last instruction
+    finished : bool         # Decoding ended (stopped or end of file) before the chunk did
+
+class ChunkResult(NamedTuple):
+    """Speculative decodes of one chunk by _decode_chunk()"""
+    end : int
+    decode : Speculation                    # Decode from the chunk start
+    candidates : dict[int, Speculation]     # Decodes from the next offsets, up to where they join decode
+
+def _speculate(buf : ByteBuffer, start : int, end : int, joins : set[int] = None) -> Speculation:
+    state = DecodeState()
+    offsets, lengths, texts, segs = [], [], [], []
+    pos = start
+    finished = True
+    for ins in _iter_buffer(buf, state, start):
+        if ins.offset >= end or (joins is not None and ins.offset in joins):
+            finished = False
+            break
+        offsets.append(ins.offset)
+        lengths.append(ins.length)
+        texts.append(ins.text)
+        segs.append(state.seg)
+        pos = ins.offset + ins.length
+    return Speculation(offsets, lengths, texts, segs, pos, finished)
+
+def _decode_chunk(file_path : str, start : int, end : int) -> ChunkResult:
+    """Decodes buf[start:end] from each candidate start offset, run in a worker process"""
+    with open(file_path,'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        # Messages for the real stream are printed when it is stitched together
+        with contextlib.redirect_stdout(io.StringIO()):
+            decode = _speculate(buf, start, end)
+            joins = set(decode.offsets)
+            candidates = {}
+            if start > 0:
+                for candidate in range(start + 1, min(start + SPECULATIVE_CANDIDATES, end)):
+                    speculation = _speculate(buf, candidate, end, joins)
+                    if speculation.offsets:
+                        candidates[candidate] = speculation
+    return ChunkResult(end, decode, candidates)
+
+def iter_instructions_parallel(file_path : str, jobs : int = None, chunk_size : int = None) -> Iterator[tuple[int, int, str]]:
+    """
+    Decodes one file across a pool of worker processes
+
+    Each chunk of the file is decoded speculatively from its first few
+    offsets, since where an instruction starts depends on every byte before
+    it. The chunks are then stitched together in order: the real stream is
+    decoded again only until it meets an instruction boundary of the chunk's
+    decode with the same pending segment override, after which the decodes
+    agree. The result is the same as iter_instructions().
+
+    :param str file_path: The binary to decode
+    :param int jobs: Worker processes, one per CPU if None
+    :param int chunk_size: Bytes per chunk, by default each worker gets 4 chunks
+    :return: Generator of (byte offset, length in bytes, text) per instruction
+    :rtype: Iterator[tuple[int, int, str]]
+    """
+    size = os.path.getsize(file_path)
+    if size == 0:
+        return
+    jobs = jobs or os.cpu_count()
+    if chunk_size is None:
+        chunk_size = max(1 << 16, -(-size // (jobs * 4)))
+
+    with open(file_path,'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf, \
+         concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(_decode_chunk, file_path, start, min(start + chunk_size, size))
+                   for start in range(0, size, chunk_size)]
+        try:
+            pos = 0         # Where the real stream is
+            seg = None      # Its pending segment override
+            decoder = None  # Decodes the real stream until it meets a chunk's decode
+            for future in futures:
+                chunk = future.result()
+                decode = chunk.decode
+                while pos < chunk.end:
+                    i = bisect.bisect_left(decode.offsets, pos)
+                    if i < len(decode.offsets) and decode.offsets[i] == pos and seg == (decode.segs[i-1] if i else None):
+                        # Converged, the rest of the chunk is already decoded
+                        yield from zip(decode.offsets[i:], decode.lengths[i:], decode.texts[i:])
+                        pos, seg = decode.end, decode.segs[-1]
+                        decoder = None
                         break
-                else:
-                    out_str += f'{op}{suffix[wz]}'
-
-            # Handle OP_GROUP_1 and OP_GROUP_2 + pop
-            # Register/memory
-            elif ((byte1[0] & 0b11110110) == 0b11110110) or byte1[0] == 0b10001111:
-                byte2 = file.read(1)
-                w = byte1[0] & BIT_0
-                mod = (byte2[0] >> 6) & MOD_MASK
-                rm = byte2[0] & RM_MASK
-                reg_table = REG_TABLE[w]
-                op = OP_GROUP[(byte1[0]>>3) & 0b1][(byte2[0] & (BIT_5 | BIT_4 | BIT_3))>>3]
-                prefixes = ['byte ','word ']
-                operands = [mod_rm_schema(mod,rm,file,reg_table),'']
-
-                if op == 'call' or op == 'jmp':
-                    if byte2[0] >> 3 & 0b1: # far
-                        operands[0] = 'far ' + operands[0]
-                    prefixes = ['','']
-
-                # Handle Special cases
-                if op == 'test': # special case for test
-                    operands[1] = f', {int.from_bytes(file.read(w+1),'little')}'
-
-                # Pop works the same but doesn't have share the op code pattern
-                if byte1[0] == 0b10001111:
-                    op = 'pop'
-                if mod == 0b11:
-                    out_str += f'{op} {operands[0]}{operands[1]}'
-                else:
-                    out_str += f'{op} {prefixes[w]}{operands[0]}{operands[1]}'.replace(' + 0','')
-
-            # INC/DEC/PUSH/POP Register
-            elif (byte1[0] >> 3) in range(8,12):
-                ops = ['inc','dec','push','pop']
-                op = ops[(byte1[0] >> 3)-8]
-                out_str += f'{op} {REG_TABLE_W1[byte1[0] & REG_MASK]}'
-
-            # CALL Direct Intersegment
-            elif (byte1[0] == 0b10011010):
-                operands = [int.from_bytes(file.read(2),'little'),int.from_bytes(file.read(2),'little')]
-                out_str += f'call {operands[1]}:{operands[0]}'
-
-            # JMP Direct Intersegment
-            elif (byte1[0] == 0b11101010):
-                operands = [int.from_bytes(file.read(2),'little'),int.from_bytes(file.read(2),'little')]
-                out_str += f'jmp {operands[1]}:{operands[0]}'
-
-            # JMP Direct within segment
-            elif (byte1[0] == 0b11101001):
-                inc_16 = int.from_bytes(file.read(2),'little')
-                disp = from_twos_complement(inc_16,16)
-                disp += 3
-                out_str += f'jmp ${'+'if disp >= 0 else '-'}{abs(disp)}'
-
-            # CALL Direct within segment
-            elif (byte1[0] == 0b11101000):
-                inc_16 = int.from_bytes(file.read(2),'little')
-                disp = from_twos_complement(inc_16,16)
-                disp += 3
-                out_str += f'call ${'+'if disp >= 0 else '-'}{abs(disp)}'
-
-            # RET Intersegment adding immediate to SP
-            elif (byte1[0] == 0b11001010):
-                out_str += f'retf {int.from_bytes(file.read(2),'little')}'
-            
-            # push cs
-            elif (byte1[0] == 0b00001110):
-                out_str += f'push cs'
-
-            # pop ds
-            elif (byte1[0] == 0b00011111):
-                out_str += f'pop ds'
-          
-            # NOP
-            elif byte1[0] == 0b10010000:
-                out_str += f'nop ;== xchg ax, ax'
-
-            # XCHG Register with accumulator
-            elif byte1[0] in range(0b10010001,0b10010111+1):
-                out_str += f'xchg ax, {REG_TABLE_W1[byte1[0]& 0b111]}'
-
-            # IN/OUT IMMED8
-            elif byte1[0] in range(0b11100100,0b11100111+1):
-                al_ax = ['al','ax']
-                in_out = ['in','out']
-                operands = [al_ax[byte1[0] & 0b1], int.from_bytes(file.read(1))]
-                op = in_out[(byte1[0] >> 1) & BIT_0]
-                operands = operands[::-DIRECTION[(byte1[0]>>1) & BIT_0]]
-                out_str += f'{op} {operands[0]}, {operands[1]}'
-            
-            # IN/OUT DX
-            elif byte1[0] in range(0b11101100,0b11101111+1):
-                al_ax = ['al','ax']
-                in_out = ['in','out']
-                operands = [al_ax[byte1[0] & 0b1], 'dx']
-                op = in_out[(byte1[0] >> 1) & BIT_0]
-                operands = operands[::-DIRECTION[(byte1[0]>>1) & BIT_0]]
-                out_str += f'{op} {operands[0]}, {operands[1]}'
-            
-            # XLAT
-            elif byte1[0] == 0b11010111:
-                out_str += f'xlat'
-
-            # LOAD_OPS
-            elif byte1[0] in LOAD_OPS:
-                byte2 = file.read(1)
-                mod = (byte2[0] >> 6) & MOD_MASK
-                reg = (byte2[0] >> 3) & REG_MASK
-                rm = byte2[0] & RM_MASK
-                op = LOAD_OPS[byte1[0]]
-                operands[0] = REG_TABLE_W1[reg]
-                operands[1] = mod_rm_schema(mod,rm,file,reg_table)
-                # Remove displacements of 0
-                instruction = f'{LOAD_OPS[byte1[0]]} {operands[0]}, {operands[1]}'.replace(' + 0','')
-                out_str += instruction
-
-            elif byte1[0] == 0b11000010: # RET IMMED16(intraseg)
-                imm = from_twos_complement(int.from_bytes(file.read(2),'little'),16)
-                out_str += f'ret {imm}'
-            elif byte1[0] == 0b11000011: # RET (intrasegment)
-                out_str += f'ret'
-            elif byte1[0] == 0b11001011: # RET (intersegment)
-                out_str += f'retf'
-            elif byte1[0] == 0b10011111: # LAHF
-                out_str += f'lahf'
-            elif byte1[0] == 0b10011110: # SAHF
-                out_str += f'sahf'
-            elif byte1[0] == 0b10011100: # PUSHF
-                out_str += f'pushf'
-            elif byte1[0] == 0b10011101: # POPF
-                out_str += f'popf'
-            elif byte1[0] == 0b00110111: # AAA
-                out_str += f'aaa'
-            elif byte1[0] == 0b00100111: # DAA
-                out_str += f'daa'
-            elif byte1[0] == 0b00111111: # AAS
-                out_str += f'aas'
-            elif byte1[0] == 0b00101111: # DAS
-                out_str += f'das'
-            elif byte1[0] == 0b11010100: # AAM
-                byte2 = file.read(1) # Not used?
-                out_str += f'aam'
-            elif byte1[0] == 0b11010101: # AAD
-                byte2 = file.read(1) # Not used?
-                out_str += f'aad'
-            elif byte1[0] == 0b10011000: # CBW
-                out_str += f'cbw'
-            elif byte1[0] == 0b10011001: # CWD
-                out_str += f'cwd'
-            elif byte1[0] == 0b11001100: # INT 3
-                out_str += f'int3'
-            elif byte1[0] == 0b11001101: # INT IMMED
-                out_str += f'int {int.from_bytes(file.read(1))}'
-            elif byte1[0] == 0b11001110: # INTO
-                out_str += f'into'
-            elif byte1[0] == 0b11001111: # IRET
-                out_str += f'iret'
-            elif byte1[0] == 0b10011011: # WAIT
-                out_str += f'wait'
-            elif byte1[0] == 0b11111000: # CLC
-                out_str += f'clc'
-            elif byte1[0] == 0b11110100: # HLT
-                out_str += f'hlt'
-            elif byte1[0] == 0b11110101: # CMC
-                out_str += f'cmc'
-            elif byte1[0] == 0b11111010: # CLI
-                out_str += f'cli'
-            elif byte1[0] == 0b11111001: # STC
-                out_str += f'stc'
-            elif byte1[0] == 0b11111011: # STI
-                out_str += f'sti'
-            elif byte1[0] == 0b11111100: # CLD
-                out_str += f'cld'
-            elif byte1[0] == 0b11111101: # STD
-                out_str += f'std'
-            # Catch unimplemented instructions
+                    candidate = chunk.candidates.get(pos)
+                    if decoder is None and seg is None and candidate is not None and not candidate.finished:
+                        # Already decoded up to where it joins the chunk's decode
+                        yield from zip(candidate.offsets, candidate.lengths, candidate.texts)
+                        pos, seg = candidate.end, candidate.segs[-1]
+                        continue
+                    if decoder is None:
+                        state = DecodeState(seg)
+                        decoder = _iter_buffer(buf, state, pos)
+                    ins = next(decoder, None)
+                    if ins is None:
+                        return
+                    yield ins.offset, ins.length, ins.text
+                    pos, seg = ins.offset + ins.length, state.seg
+                if decoder is None and decode.finished:
+                    break
+
+            # Decode the end of the file, or where the chunk's decode stopped,
+            # with the real stream so messages are printed
+            if decoder is None:
+                decoder = _iter_buffer(buf, DecodeState(seg), pos)
+            for ins in decoder:
+                yield ins.offset, ins.length, ins.text
+        finally:
+            for future in futures:
+                future.cancel()
+
+def decode_8086_parallel(file_path : str, jobs : int = None, chunk_size : int = None) -> str:
+    """
+    Decodes a file like decode_8086(), using several processes
+
+    :return: The disassembly, starting with 'bits 16'
+    :rtype: str
+    """
+    return '\n'.join(['bits 16', *(text for _, _, text in iter_instructions_parallel(file_path, jobs, chunk_size))])
+
+# Bytes compared at a time when looking for patched bytes
+DIFF_BLOCK_SIZE = 4096
+
+def changed_ranges(old_buf : ByteBuffer, new_buf : ByteBuffer) -> list[tuple[int, int, int]]:
+    """
+    Finds the bytes that differ between two versions of a buffer
+
+    :param ByteBuffer old_buf: The buffer before patching
+    :param ByteBuffer new_buf: The buffer after patching
+    :return: (start, stop, delta) per changed range of new_buf, in order.
+        delta is the shift of the bytes after the range from where they were
+        in old_buf, only a single range is found if the size changed
+    :rtype: list[tuple[int, int, int]]
+    """
+    old_view, new_view = memoryview(old_buf), memoryview(new_buf)
+    size = min(len(old_view), len(new_view))
+    ranges = []
+    for block in range(0, size, DIFF_BLOCK_SIZE):
+        stop = min(block + DIFF_BLOCK_SIZE, size)
+        # Slices compare in C, only differing blocks are searched byte by byte
+        if old_view[block:stop] == new_view[block:stop]:
+            continue
+        for pos in range(block, stop):
+            if old_view[pos] == new_view[pos]:
+                continue
+            if ranges and ranges[-1][1] == pos:
+                ranges[-1][1] = pos + 1
             else:
-                print('Instruction not recognized:')
-                print(f'\t-> {bin(byte1[0])}')
+                ranges.append([pos, pos + 1])
+        if len(old_view) != len(new_view):
+            break
+    if len(old_view) == len(new_view):
+        return [(start, stop, 0) for start, stop in ranges]
+
+    # Bytes were inserted or removed, everything from the first difference to
+    # the common tail has changed
+    start = ranges[0][0] if ranges else size
+    old_size, new_size = len(old_view), len(new_view)
+    tail = 0
+    # Whole blocks of the tail first, then the bytes of the block that differs
+    while tail + DIFF_BLOCK_SIZE <= size - start and \
+            old_view[old_size - tail - DIFF_BLOCK_SIZE:old_size - tail] == new_view[new_size - tail - DIFF_BLOCK_SIZE:new_size - tail]:
+        tail += DIFF_BLOCK_SIZE
+    while tail < size - start and old_view[old_size - tail - 1] == new_view[new_size - tail - 1]:
+        tail += 1
+    return [(start, new_size - tail, new_size - old_size)]
+
+def _seg_after(ins : Instruction) -> int:
+    """The segment override left pending after ins, a mod reg r/m byte uses it up"""
+    return None if ins.mod is not None else ins.seg
+
+class _Run(NamedTuple):
+    """Records reused from one decode, records[first:stop] moved by shift bytes"""
+    records : list[Instruction]
+    offsets : array.array       # ins.offset of each record, as decoded
+    first : int
+    stop : int
+    shift : int
+
+class PatchedDecode:
+    """
+    The instructions found by redecode(), as runs of records reused from the
+    decodes before it
+
+    Records keep the offset they were decoded at, and each run has the shift
+    from there to where its records are now, so bytes inserted or removed
+    don't rewrite the records after them. Iterating gives the records with
+    their current offsets, shifted ones are copied.
+    """
+    def __init__(self, runs : list[_Run]):
+        self.runs = [run for run in runs if run.first < run.stop]
+        # Offset now of the first record and index of the first record of each run
+        self.starts = [run.offsets[run.first] + run.shift for run in self.runs]
+        self.firsts = list(itertools.accumulate((run.stop - run.first for run in self.runs), initial=0))
+
+    def __len__(self) -> int:
+        return self.firsts[-1]
+
+    def __iter__(self) -> Iterator[Instruction]:
+        for records, _, first, stop, shift in self.runs:
+            if shift == 0:
+                yield from records[first:stop]
+                continue
+            for ins in records[first:stop]:
+                ins = copy.copy(ins)
+                ins.offset += shift
+                yield ins
+
+    def _run_of(self, i : int) -> tuple[_Run, int]:
+        """The run holding record i and the index of the record in it"""
+        r = bisect.bisect_right(self.firsts, i) - 1
+        run = self.runs[r]
+        return run, run.first + i - self.firsts[r]
+
+    def _record(self, i : int) -> Instruction:
+        """Record i, with the offset it was decoded at"""
+        run, k = self._run_of(i)
+        return run.records[k]
+
+    def _offset(self, i : int) -> int:
+        run, k = self._run_of(i)
+        return run.offsets[k] + run.shift
+
+    def _find(self, pos : int) -> int:
+        """Index of the last record starting at or before pos, -1 if none does"""
+        r = bisect.bisect_right(self.starts, pos) - 1
+        if r < 0:
+            return -1
+        run = self.runs[r]
+        return self.firsts[r] + bisect.bisect_right(run.offsets, pos - run.shift, run.first, run.stop) - 1 - run.first
+
+    def _runs_between(self, start : int, stop : int, shift : int) -> list[_Run]:
+        """Runs holding records start to stop, moved by shift more bytes"""
+        runs = []
+        r = bisect.bisect_right(self.firsts, start) - 1
+        while start < stop:
+            run = self.runs[r]
+            first = run.first + start - self.firsts[r]
+            count = min(stop, self.firsts[r+1]) - start
+            runs.append(run._replace(first=first, stop=first + count, shift=run.shift + shift))
+            start += count
+            r += 1
+        return runs
+
+def redecode(old : list[Instruction] | PatchedDecode, old_buf : ByteBuffer, new_buf : ByteBuffer,
+             offsets : array.array = None) -> PatchedDecode:
+    """
+    Updates a decode after some bytes were patched
+
+    Decoding starts again from the last instruction before each changed
+    range and carries on until an instruction ends on an old instruction
+    boundary with the same pending segment override. From there the old
+    instructions are reused without being copied, so the work depends on
+    the size of the patches rather than the size of the buffer.
+
+    :param old: Every instruction decode_instructions() found in old_buf,
+        or the result of an earlier redecode() of old_buf
+    :param ByteBuffer old_buf: The buffer before patching
+    :param ByteBuffer new_buf: The buffer after patching
+    :param array.array offsets: The offsets of the instructions in old if
+        the caller has them already, such as instruction_boundaries()
+        offsets or OffsetIndex.offsets. Found from old if None
+    :return: The instructions of new_buf, as decode_instructions() finds
+        them. Pass it to the next redecode() of new_buf
+    :rtype: PatchedDecode
+    """
+    if not isinstance(old, PatchedDecode):
+        if offsets is None:
+            offsets = array.array('L', [ins.offset for ins in old])
+        old = PatchedDecode([_Run(old, offsets, 0, len(old), 0)])
+    if not len(old):
+        records = list(decode_instructions(new_buf))
+        return PatchedDecode([_Run(records, array.array('L', [ins.offset for ins in records]), 0, len(records), 0)])
+    ranges = changed_ranges(old_buf, new_buf)
+    runs = []
+    copied = 0  # Old instructions before this one are in runs or replaced
+    delta = 0   # Shift of the old instructions still to reuse
+
+    r = 0
+    while r < len(ranges):
+        start = ranges[r][0]
+        # Start from the instruction holding the first changed byte
+        i = max(old._find(start - delta), copied)
+        runs += old._runs_between(copied, i, delta)
+        state = DecodeState(_seg_after(old._record(i-1)) if i else None)
+        records, new_offsets = [], array.array('L')
+        first = r
+        for ins in _iter_buffer(new_buf, state, old._offset(i) + delta):
+            records.append(ins)
+            new_offsets.append(ins.offset)
+            end = ins.offset + ins.length
+            # Changed ranges the new instructions reach are decoded in one go
+            while r < len(ranges) and ranges[r][0] < end:
+                r += 1
+            if r == first or end < ranges[r-1][1]:
+                continue
+            delta = ranges[r-1][2]
+            j = old._find(end - delta)
+            if j >= 0 and old._offset(j) == end - delta and (_seg_after(old._record(j-1)) if j else None) == state.seg:
+                copied = j
+                break
+        else:
+            # Decoding stopped before meeting the old instructions again
+            runs.append(_Run(records, new_offsets, 0, len(records), 0))
+            return PatchedDecode(runs)
+        runs.append(_Run(records, new_offsets, 0, len(records), 0))
+    runs += old._runs_between(copied, len(old), delta)
+    return PatchedDecode(runs)
+
+# Bytes between checkpoints in an offset index
+CHECKPOINT_INTERVAL = 4096
+# Sidecar offset index: magic, version, checkpoint interval, then the size and
+# mtime of the indexed file, where decoding stopped and the array lengths
+INDEX_HEADER = struct.Struct('<4sHQQQQQQ')
+INDEX_MAGIC = b'8086'
+INDEX_VERSION = 3
+INDEX_EXTENSION = '.idx'
+
+class OffsetIndex(NamedTuple):
+    """
+    Where every instruction of a file starts, with the prefix state to
+    resume decoding at regular checkpoints
+    """
+    size : int                  # Size of the indexed file
+    mtime_ns : int              # Modification time of the indexed file
+    interval : int              # Bytes between checkpoints
+    end : int                   # Offset after the last instruction
+    offsets : array.array       # Offset of each instruction
+    checkpoints : array.array   # Offset of the first instruction after each interval
+    segs : array.array          # DecodeState.seg before each checkpoint, -1 for None
+
+    def state_before(self, offset : int) -> tuple[int, DecodeState]:
+        """
+        Finds the last checkpoint at or before offset
+
+        :return: The checkpoint and the state to resume decoding there with
+        :rtype: tuple[int, DecodeState]
+        """
+        i = bisect.bisect_right(self.checkpoints, offset) - 1
+        if i < 0:
+            return 0, DecodeState()
+        seg = self.segs[i]
+        # A lock is never pending between instructions, only an override can be
+        return self.checkpoints[i], DecodeState(None if seg < 0 else seg)
+
+def build_index(file_path : str, interval : int = CHECKPOINT_INTERVAL) -> OffsetIndex:
+    """
+    Decodes a file once to index its instructions
+
+    :param str file_path: The binary to index
+    :param int interval: Bytes between checkpoints
+    :return: The index
+    :rtype: OffsetIndex
+    :raises ValueError: interval isn't positive
+    """
+    if interval <= 0:
+        raise ValueError(f'checkpoint interval must be positive, not {interval}')
+    stat = os.stat(file_path)
+    offsets, checkpoints = array.array('Q'), array.array('Q')
+    segs = array.array('b')
+    end = 0
+    if stat.st_size:
+        with open(file_path,'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            state = DecodeState()
+            next_checkpoint = 0
+            seg = None
+            for ins in _iter_buffer(buf, state):
+                if ins.offset >= next_checkpoint:
+                    # The state an instruction starts with is the state left by
+                    # the one before it
+                    checkpoints.append(ins.offset)
+                    segs.append(-1 if seg is None else seg)
+                    next_checkpoint = ins.offset - ins.offset % interval + interval
+                offsets.append(ins.offset)
+                end = ins.offset + ins.length
+                seg = state.seg
+    return OffsetIndex(stat.st_size, stat.st_mtime_ns, interval, end, offsets, checkpoints, segs)
+
+def save_index(index : OffsetIndex, index_path : str):
+    with open(index_path,'wb') as file:
+        file.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, index.interval, index.size, index.mtime_ns,
+                                     index.end, len(index.offsets), len(index.checkpoints)))
+        for values in index[4:]:
+            values.tofile(file)
+
+def load_index(index_path : str) -> OffsetIndex:
+    """
+    Reads an index written by save_index()
+
+    :return: The index, or None if the file isn't an index of this version
+    :rtype: OffsetIndex
+    """
+    with open(index_path,'rb') as file:
+        header = file.read(INDEX_HEADER.size)
+        if len(header) < INDEX_HEADER.size:
+            return None
+        magic, version, interval, size, mtime_ns, end, n_offsets, n_checkpoints = INDEX_HEADER.unpack(header)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            return None
+        arrays = []
+        for typecode, count in (('Q', n_offsets), ('Q', n_checkpoints), ('b', n_checkpoints)):
+            values = array.array(typecode)
+            try:
+                values.fromfile(file, count)
+            except EOFError:
+                return None
+            arrays.append(values)
+    return OffsetIndex(size, mtime_ns, interval, end, *arrays)
+
+def load_or_build_index(file_path : str) -> OffsetIndex:
+    """
+    Loads the sidecar index of a file, building and saving it if it is
+    missing or the file has changed since
+
+    :param str file_path: The indexed binary, its index is file_path + '.idx'
+    :return: The index
+    :rtype: OffsetIndex
+    """
+    index_path = file_path + INDEX_EXTENSION
+    stat = os.stat(file_path)
+    index = None
+    if os.path.exists(index_path):
+        index = load_index(index_path)
+    if index is None or index.size != stat.st_size or index.mtime_ns != stat.st_mtime_ns:
+        index = build_index(file_path)
+        save_index(index, index_path)
+    return index
+
+def decode_range(file_path : str, start : int, end : int = None, index : OffsetIndex = None) -> Iterator[Instruction]:
+    """
+    Decodes the instructions that start in a range of a file
+
+    Decoding resumes from the checkpoint of the index before start, so only
+    up to a checkpoint interval of bytes is decoded ahead of the range.
+
+    :param str file_path: The binary to decode
+    :param int start: First byte offset of the range
+    :param int end: Byte offset after the range, the end of the file if None
+    :param OffsetIndex index: Index of the file, without one decoding starts at byte 0
+    :return: Generator of Instruction
+    :rtype: Iterator[Instruction]
+    """
+    pos, state = (0, DecodeState()) if index is None else index.state_before(start)
+    if os.path.getsize(file_path) == 0:
+        return
+    with open(file_path,'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        for ins in _iter_buffer(buf, state, pos):
+            if end is not None and ins.offset >= end:
                 break
-        return out_str
-                
+            if ins.offset >= start:
+                yield ins
+
 def write_to_file(str,file_path):
     with open(file_path,'w+') as file:
         file.write(str)      
 
+# Bumped whenever the output or the Instruction fields change, so results
+# cached by an older decoder are never used
+DECODER_VERSION = 2
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'decode_8086')
+DEFAULT_CACHE_SIZE = 512 << 20
+
+class DecodeCache:
+    """
+    On-disk cache of decode results, keyed by a hash of the input bytes and
+    DECODER_VERSION
+
+    Each result is a pickle in cache_dir. Once the cache is bigger than
+    max_size, the least recently used entries are deleted. Every hit
+    updates the mtime of its entry, which orders the eviction.
+    """
+    def __init__(self, cache_dir : str = DEFAULT_CACHE_DIR, max_size : int = DEFAULT_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._size = None   # Bytes in cache_dir, counted on the first put()
+
+    def key(self, data : ByteBuffer) -> str:
+        digest = hashlib.sha256(f'decode_8086 {DECODER_VERSION}\n'.encode())
+        digest.update(data)
+        return digest.hexdigest()
+
+    def file_key(self, file_path : str) -> str:
+        with open(file_path,'rb') as file:
+            # mmap can't map an empty file
+            if os.fstat(file.fileno()).st_size == 0:
+                return self.key(b'')
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                return self.key(buf)
+
+    def _path(self, key : str, kind : str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f'{key}.{kind}')
+
+    def get(self, key : str, kind : str):
+        """
+        Looks up a result
+
+        :param str key: From key() or file_key()
+        :param str kind: Which result of the input, such as 'text' or 'records'
+        :return: The result, None if it isn't cached
+        """
+        path = self._path(key, kind)
+        try:
+            with open(path,'rb') as file:
+                value = pickle.load(file)
+            os.utime(path)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, key : str, kind : str, value):
+        path = self._path(key, kind)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        # Written under another name first, so a reader never sees half an entry
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path,'wb') as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._entries())
+        else:
+            self._size += len(data)
+        if self._size > self.max_size:
+            self.evict()
+
+    def lookup(self, key : str, kind : str, compute):
+        """Returns the cached result, or calls compute() and caches what it returns"""
+        value = self.get(key, kind)
+        if value is None:
+            value = compute()
+            self.put(key, kind, value)
+        return value
+
+    def _entries(self) -> list[tuple[int, int, str]]:
+        entries = []
+        for root, dirs, names in os.walk(self.cache_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        """Deletes the least recently used entries until the cache is 10% below max_size"""
+        entries = sorted(self._entries())
+        size = sum(size for _, size, _ in entries)
+        for _, entry_size, path in entries:
+            if size <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+        self._size = size
+
+def decode_8086_cached(file_path : str, cache : DecodeCache) -> str:
+    """decode_8086(), with the result kept in cache"""
+    return cache.lookup(cache.file_key(file_path), 'text', lambda: decode_8086(file_path))
+
+def decode_instructions_cached(file_path : str, cache : DecodeCache) -> list[Instruction]:
+    """decode_instructions() of a file, with the records kept in cache"""
+    return cache.lookup(cache.file_key(file_path), 'records', lambda: list(decode_instructions(file_path)))
+
+def add_spacing_cached(text : str, cache : DecodeCache) -> str:
+    """add_spacing(), with the result kept in cache"""
+    return cache.lookup(cache.key(text.encode()), 'spaced', lambda: add_spacing(text))
+
+# Path given on the command line to decode stdin
+STDIN_PATH = '-'
+
+class FileResult(NamedTuple):
+    """Outcome of decoding one file with decode_file()"""
+    file_path : str
+    out_path : str
+    size : int              # Bytes in the input file
+    instructions : int      # Instructions decoded
+    decoded : int           # Bytes covered by the decoded instructions
+    seconds : float
+    error : str             # None if the file was decoded
+    text : str              # Spaced disassembly, None if not kept
+    coverage : Coverage = None  # Bytes written as db, if the decode wasn't strict
+
+def output_names(file_paths : list[str]) -> list[str]:
+    """
+    Names of the .asm files for a batch of inputs, relative to the output
+    directory
+
+    Each file keeps its path relative to the deepest directory holding all
+    of them, with the extension replaced by .asm, so a/foo.bin and b/foo.bin
+    become a/foo.asm and b/foo.asm. Names that would still be the same keep
+    their extension, foo.bin and foo.com become foo.bin.asm and foo.com.asm.
+    """
+    if not file_paths:
+        return []
+    if file_paths == [STDIN_PATH]:
+        return ['stdin.asm']
+    paths = [os.path.abspath(path) for path in file_paths]
+    root = os.path.commonpath([os.path.dirname(path) for path in paths])
+    names = [os.path.relpath(path, root) for path in paths]
+    stems = [os.path.splitext(name)[0] for name in names]
+    counts = collections.Counter(stems)
+    return [f'{stem if counts[stem] == 1 else name}.asm' for name, stem in zip(names, stems)]
+
+def decode_file(file_path : str, out_dir : str = 'out', keep_text : bool = True, jobs : int = 1, cache : DecodeCache = None,
+                strict : bool = True, out_name : str = None) -> FileResult:
+    """
+    Decodes a file and writes the spaced disassembly to out_dir
+
+    :param str file_path: The binary to decode, '-' decodes stdin as it is read
+    :param str out_dir: Directory the .asm file is written to
+    :param bool keep_text: Return the disassembly in the result
+    :param int jobs: Worker processes to split a large file across
+    :param DecodeCache cache: Cache of spaced disassemblies, stdin isn't cached
+    :param bool strict: Stop at the first byte that can't be decoded. If
+        False, such bytes are written as db and the result has their Coverage
+    :param str out_name: Path of the .asm file in out_dir, from
+        output_names() for a batch. The file's name with .asm by default
+    :return: What was decoded, with the error message if decoding failed
+    :rtype: FileResult
+    """
+    if out_name is None:
+        out_name = output_names([file_path])[0]
+    out_path = os.path.join(out_dir, out_name)
+    start = time.perf_counter()
+    size = decoded = count = 0
+
+    def counted(instructions : Iterator[tuple[int, int, str]]) -> Iterator[str]:
+        nonlocal decoded, count
+        for _, length, text in instructions:
+            decoded += length
+            count += 1
+            yield text
+
+    result = key = cached = None
+    coverage = None if strict else Coverage()
+    # Disassemblies with db are cached apart from strict ones
+    kind = 'file' if strict else 'file_data'
+    try:
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        if file_path == STDIN_PATH:
+            stream = StreamDecoder(strict, coverage)
+            instructions = ((ins.offset, ins.length, ins.text) for ins in decode_stream(sys.stdin.buffer, decoder=stream))
+        else:
+            size = os.path.getsize(file_path)
+            if cache is not None:
+                key = cache.file_key(file_path)
+                cached = cache.get(key, kind)
+            if cached is not None:
+                instructions = None
+            elif jobs > 1 and size >= PARALLEL_MIN_SIZE and strict:
+                instructions = iter_instructions_parallel(file_path, jobs)
+            else:
+                instructions = iter_instructions(file_path, strict, coverage)
+        if cached is not None:
+            count, decoded, result = cached[:3]
+            if not strict:
+                coverage = cached[3]
+            write_to_file(result, out_path)
+        else:
+            spaced = iter_spacing(itertools.chain(['bits 16'], counted(instructions)))
+            with open(out_path,'w') as file:
+                if keep_text or key is not None:
+                    result = ''.join(spaced)
+                    file.write(result)
+                else:
+                    file.writelines(spaced)
+            if key is not None:
+                cache.put(key, kind, (count, decoded, result) if strict else (count, decoded, result, coverage))
+    except OSError as e:
+        return FileResult(file_path, None, size, count, decoded, time.perf_counter() - start, str(e), None, coverage)
+    if file_path == STDIN_PATH:
+        size = stream.size
+    if not keep_text:
+        result = None
+    error = None
+    if coverage is not None:
+        # Every byte is written, but the data isn't decoded
+        decoded = size - coverage.data_bytes
+    elif decoded < size:
+        error = f'stopped at byte {decoded}'
+    return FileResult(file_path, out_path, size, count, decoded, time.perf_counter() - start, error, result, coverage)
+
+def expand_paths(paths : list[str]) -> list[str]:
+    """
+    Turns files, directories (searched recursively) and globs into a list of
+    files
+
+    Offset indexes saved next to the binaries are left out of directories
+    and globs, only a file named on its own is kept whatever its name.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files.extend(os.path.join(root, name) for name in sorted(names) if not name.endswith(INDEX_EXTENSION))
+        elif glob.has_magic(path):
+            files.extend(match for match in sorted(glob.glob(path, recursive=True))
+                         if os.path.isfile(match) and not match.endswith(INDEX_EXTENSION))
+        else:
+            files.append(path)
+    # Overlapping arguments shouldn't decode a file twice
+    return list(dict.fromkeys(files))
+
+def print_summary(results : list[FileResult]):
+    width = max(len(result.file_path) for result in results)
+    print(f'{'file'.ljust(width)}  {'bytes':>10}  {'instrs':>9}  {'time (s)':>9}  status')
+    for result in results:
+        status = 'OK' if result.error is None else f'FAILED: {result.error}'
+        print(f'{result.file_path.ljust(width)}  {result.size:>10}  {result.instructions:>9}  {result.seconds:>9.4f}  {status}')
+    failures = sum(result.error is not None for result in results)
+    print(f'{len(results)} files, {sum(r.size for r in results)} bytes, '
+          f'{sum(r.instructions for r in results)} instructions, {failures} failed')
+    print_coverage(results)
+
+def print_coverage(results : list[FileResult]):
+    """Prints how much of each file a decode that wasn't strict decoded"""
+    for result in results:
+        coverage = result.coverage
+        if coverage is not None and result.error is None:
+            line = f'{result.file_path}: {coverage.decoded_percent(result.size):.2f}% decoded'
+            if coverage.data_bytes:
+                line += f', {coverage.data_bytes} bytes as db, unknown opcodes: {coverage.histogram()}'
+            print(line)
+
 def main():
-    if len(sys.argv) > 1:
-        # get file name with no extension or path
-        name = sys.argv[1].split('.')[0]
-        name = name.split('/')
-        name = name[-1] if len(name) > 1 else name[0]
-        file_path = sys.argv[1]
-        print(f'-> "{file_path}"')
-        result = decode_8086(file_path)
-        result = add_spacing(result)
-        if not os.path.exists('out'):
-            os.makedirs('out')
-        write_to_file(result,os.path.join('out/'f'{name}.asm'))
-        print('------------------')
-        print(result)
-        print('------------------')
-        print(f'Output written to -> {'out/'f'{name}.asm'}')
+    parser = argparse.ArgumentParser(description='Decodes 8086 binaries into nasm compatible assembly')
+    parser.add_argument('paths', nargs='+', help=f"files, directories or globs to decode, or '{STDIN_PATH}' for stdin")
+    parser.add_argument('-o', '--out-dir', default='out', help='directory for the .asm files (default: out)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='worker processes for several files or one large file (default: one per CPU)')
+    parser.add_argument('-q', '--quiet', action='store_true', help="don't print the disassembly")
+    parser.add_argument('--cache-dir', nargs='?', const=DEFAULT_CACHE_DIR, help=f'reuse results for unchanged files from this directory (default: {DEFAULT_CACHE_DIR})')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE >> 20, help='MB the cache may use (default: %(default)s)')
+    parser.add_argument('--start', type=lambda x: int(x, 0), help='print only instructions from this byte offset, using a sidecar index')
+    parser.add_argument('--end', type=lambda x: int(x, 0), help='print only instructions before this byte offset, using a sidecar index')
+    parser.add_argument('--profile', action='store_true', help='decode one file at a time and print where the time went by instruction family')
+    parser.add_argument('--profile-json', help='also write the profile to this JSON file')
+    parser.add_argument('--strict', action=argparse.BooleanOptionalAction, default=True,
+                        help="stop at the first byte that can't be decoded, --no-strict writes such bytes as db and carries on (default: strict)")
+    args = parser.parse_args()
+
+    if not args.strict and (args.start is not None or args.end is not None or args.profile or args.profile_json):
+        parser.error("--no-strict can't be used with --start, --end or --profile")
+    if args.start is not None or args.end is not None:
+        if len(args.paths) != 1 or args.paths == [STDIN_PATH] or not os.path.isfile(args.paths[0]):
+            parser.error('--start and --end need a single file')
+        index = load_or_build_index(args.paths[0])
+        print('bits 16')
+        for ins in decode_range(args.paths[0], args.start or 0, args.end, index):
+            print(ins.text)
+        sys.exit(0)
+
+    if STDIN_PATH in args.paths and len(args.paths) > 1:
+        parser.error(f"'{STDIN_PATH}' can't be combined with other paths")
+    file_paths = [STDIN_PATH] if args.paths == [STDIN_PATH] else expand_paths(args.paths)
+    if not file_paths:
+        parser.error('no files to decode')
+
+    if args.profile or args.profile_json:
+        if file_paths == [STDIN_PATH]:
+            parser.error("--profile can't be used with stdin")
+        import profile_8086
+        profile = profile_8086.DecodeProfile()
+        for file_path, out_name in zip(file_paths, output_names(file_paths)):
+            out_path = os.path.join(args.out_dir, out_name)
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            text, _ = profile_8086.profile_decode(file_path, out_path, profile)
+            if not args.quiet:
+                print(f'-> "{file_path}"')
+                print(text)
+        print(profile.table())
+        if args.profile_json:
+            with open(args.profile_json, 'w') as file:
+                json.dump(profile.to_dict(), file, indent=4)
+        sys.exit(0)
+
+    cache = None
+    if args.cache_dir is not None:
+        cache = DecodeCache(args.cache_dir, args.cache_size << 20)
+
+    results = []
+    out_names = output_names(file_paths)
+    if len(file_paths) == 1 or args.jobs <= 1:
+        for file_path, out_name in zip(file_paths, out_names):
+            results.append(decode_file(file_path, args.out_dir, not args.quiet, args.jobs, cache, args.strict, out_name))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            futures = [pool.submit(decode_file, file_path, args.out_dir, not args.quiet, 1, cache, args.strict, out_name)
+                       for file_path, out_name in zip(file_paths, out_names)]
+            results = [future.result() for future in futures]
+
+    if not args.quiet:
+        for result in results:
+            print(f'-> "{result.file_path}"')
+            if result.text is None:
+                continue
+            print('------------------')
+            print(result.text)
+            print('------------------')
+            print(f'Output written to -> {result.out_path}')
+    if len(results) > 1 or args.quiet:
+        print_summary(results)
     else:
-        print('\n-> USAGE: python decode_8086.py <FILE_NAME>') 
+        print_coverage(results)
+    sys.exit(1 if any(result.error is not None for result in results) else 0)
 
 if __name__ == "__main__":
-    main()        
\ No newline at end of file
+    main()
@@ -0,0 +1,388 @@
+# 8086 encoder
+# Assembles the decoder's output back into machine code in memory, so
+# disassemblies can be checked without running nasm
+import itertools
+from collections.abc import Iterable
+from decode_8086 import (OP_GROUP_IMMED, OP_GROUP_SHIFT, STR_OPS, LOAD_OPS, CTRL_TRNSFR_OPS, SINGLE_BYTE_OPS,
+                         REG_TABLE_W0, REG_TABLE_W1, SEG_REG, EFFECTIVE_ADDR, LOCK_PREFIX, length_table,
+                         MNEMONICS, DATA_OP, ByteBuffer, Instruction, decode_instructions, from_twos_complement)
+
+REP_PREFIX = 0b11110011
+SEG_PREFIX_BYTES = [0b00100110 | (sr << 3) for sr in range(4)]
+FAR_DIRECT = (0b10011010, 0b11101010)
+
+def _u16(value : int) -> bytes:
+    return (value & 0xFFFF).to_bytes(2, 'little')
+
+def encode_instruction(ins : Instruction) -> bytes:
+    """
+    Encodes a record from decode_instructions() back into its bytes
+
+    Every field of the encoding is kept in the record, so the bytes are the
+    ones decoded. A record without prefixes bytes, such as one rebuilt from
+    columns, has its prefixes written lock first, with the override in
+    effect repeated for every segment override prefix.
+
+    :param Instruction ins: A decoded instruction
+    :return: ins.length bytes of machine code
+    :rtype: bytes
+    """
+    if ins.op == DATA_OP:
+        return bytes([ins.imm])
+    if ins.opcode == LOCK_PREFIX:
+        if ins.prefixes is not None:
+            return ins.prefixes
+        # A lock on its own, with any overrides after it
+        out = bytearray([LOCK_PREFIX])
+    else:
+        out = bytearray([ins.opcode])
+        second = 0
+        if ins.mod is not None:
+            second = (ins.mod << 6) | (ins.reg << 3) | ins.rm
+            out.append(second)
+            if ins.mod == 0b01:
+                out.append(ins.disp & 0xFF)
+            elif ins.mod == 0b10 or (ins.mod == 0b00 and ins.rm == 0b110):
+                out += _u16(ins.disp)
+        elif STR_OPS.get(ins.opcode >> 1) == 'rep':
+            # rep is followed by the string op
+            op = MNEMONICS[ins.op]
+            second = next(code for code, name in STR_OPS.items() if name == op) << 1 | ins.w
+            out.append(second)
+        length = length_table()[(ins.opcode << 8) | second]
+        if ins.opcode in FAR_DIRECT:
+            out += _u16(ins.imm) + _u16(ins.disp)
+        else:
+            if ins.mod is None and ins.disp is not None:
+                size = length - len(out) - (0 if ins.imm is None else 1)
+                out += (ins.disp & ((1 << (8 * size)) - 1)).to_bytes(size, 'little')
+            if ins.imm is not None:
+                out += ins.imm.to_bytes(length - len(out), 'little')
+        if ins.prefixes is not None:
+            return ins.prefixes + out
+        if ins.lock:
+            out.insert(0, LOCK_PREFIX)
+    # Whatever is left of the length was segment override prefixes
+    prefixes = ins.length - len(out)
+    if prefixes > 0:
+        position = 1 if out[0] == LOCK_PREFIX else 0
+        out[position:position] = bytes([SEG_PREFIX_BYTES[ins.seg or 0]]) * prefixes
+    return bytes(out)
+
+def encode_instructions(instructions : Iterable[Instruction]) -> bytes:
+    """Encodes records from decode_instructions() back into machine code"""
+    return b''.join(encode_instruction(ins) for ins in instructions)
+
+# Operands parsed from text
+class Reg:
+    def __init__(self, index : int, w : int):
+        self.index = index
+        self.w = w
+
+class SegReg:
+    def __init__(self, index : int):
+        self.index = index
+
+class Mem:
+    def __init__(self, seg : int, rm : int, disp : int, explicit_disp : bool):
+        self.seg = seg
+        self.rm = rm                        # None for a direct address
+        self.disp = disp
+        self.explicit_disp = explicit_disp  # A displacement was written, even if 0
+
+class Imm:
+    def __init__(self, value : int):
+        self.value = value
+
+class Rel:
+    def __init__(self, value : int):
+        self.value = value                  # Offset from $, the start of the instruction
+
+class FarAddr:
+    def __init__(self, seg : int, offset : int):
+        self.seg = seg
+        self.offset = offset
+
+REGISTERS = {**{name : Reg(i, 0) for i, name in enumerate(REG_TABLE_W0)},
+             **{name : Reg(i, 1) for i, name in enumerate(REG_TABLE_W1)}}
+SEG_REGISTERS = {name : SegReg(i) for i, name in enumerate(SEG_REG)}
+EA_RM = {frozenset(ea.split(' + ')) : rm for rm, ea in enumerate(EFFECTIVE_ADDR)}
+SIZES = {'byte' : 0, 'word' : 1}
+
+def _parse_operand(text : str) -> tuple[object, int, bool]:
+    """
+    Parses one operand
+
+    :return: The operand, the size written before it (None if there isn't
+        one) and whether it was marked far
+    :rtype: tuple[object, int, bool]
+    """
+    words = text.split(' ')
+    size = None
+    far = False
+    # Size specifiers can repeat, as in 'word word 5'
+    while len(words) > 1 and (words[0] in SIZES or words[0] == 'far'):
+        if words[0] == 'far':
+            far = True
+        else:
+            size = SIZES[words[0]]
+        words = words[1:]
+    text = ' '.join(words)
+
+    if text.endswith(']'):
+        seg = None
+        prefix, _, inner = text[:-1].partition('[')
+        if prefix:
+            seg = SEG_REG.index(prefix.rstrip(':'))
+        regs, disp, explicit = [], 0, False
+        sign = 1
+        for term in inner.split(' '):
+            if term in ('+', '-'):
+                sign = 1 if term == '+' else -1
+            elif term in REGISTERS:
+                regs.append(term)
+            else:
+                disp += sign * int(term)
+                explicit = True
+        if not regs:
+            return Mem(seg, None, disp, True), size, far
+        return Mem(seg, EA_RM[frozenset(regs)], disp, explicit), size, far
+    if text in REGISTERS:
+        return REGISTERS[text], size, far
+    if text in SEG_REGISTERS:
+        return SEG_REGISTERS[text], size, far
+    if text.startswith('$'):
+        return Rel(int(text[1:])), size, far
+    if ':' in text:
+        seg, _, offset = text.partition(':')
+        return FarAddr(int(seg), int(offset)), size, far
+    return Imm(int(text)), size, far
+
+def _mod_rm(reg : int, operand : Reg | Mem) -> bytes:
+    """The mod reg r/m byte and displacement for an operand, with nasm's choice of displacement size"""
+    if isinstance(operand, Reg):
+        return bytes([0b11000000 | (reg << 3) | operand.index])
+    if operand.rm is None:
+        return bytes([(reg << 3) | 0b110]) + _u16(operand.disp)
+    disp = operand.disp
+    # [bp] has no mod 00 form, it is [bp + 0]
+    if disp == 0 and not operand.explicit_disp and operand.rm != 0b110:
+        return bytes([(reg << 3) | operand.rm])
+    if -128 <= disp <= 127:
+        return bytes([0b01000000 | (reg << 3) | operand.rm, disp & 0xFF])
+    return bytes([0b10000000 | (reg << 3) | operand.rm]) + _u16(disp)
+
+def _imm(value : int, w : int) -> bytes:
+    return _u16(value) if w else bytes([value & 0xFF])
+
+def _fits_imm8(value : int) -> bool:
+    """A word immediate that can be sign extended from a byte"""
+    return -128 <= from_twos_complement(value & 0xFFFF, 16) <= 127
+
+def _size_of(operands : list, sizes : list[int]) -> int:
+    """w of an instruction, from a register operand or a size specifier"""
+    for operand in operands:
+        if isinstance(operand, Reg):
+            return operand.w
+    for size in sizes:
+        if size is not None:
+            return size
+    raise ValueError('operation size not specified')
+
+def _is_rm(operand) -> bool:
+    return isinstance(operand, (Reg, Mem))
+
+STR_OPCODES = {name : code << 1 for code, name in STR_OPS.items()}
+CTRL_OPCODES = {name : opcode for opcode, name in CTRL_TRNSFR_OPS.items()}
+LOAD_OPCODES = {name : opcode for opcode, name in LOAD_OPS.items()}
+SINGLE_BYTE_OPCODES = {text.split(' ')[0] : opcode for opcode, text in SINGLE_BYTE_OPS.items()}
+GROUP_1 = {'not' : 2, 'neg' : 3, 'mul' : 4, 'imul' : 5, 'div' : 6, 'idiv' : 7}
+
+def _encode(mnemonic : str, operands : list, sizes : list[int], fars : list[bool]) -> bytes:
+    """Encodes one instruction with nasm's choice of encoding where there are several"""
+    a = operands[0] if operands else None
+    b = operands[1] if len(operands) > 1 else None
+
+    if mnemonic in SINGLE_BYTE_OPCODES and not operands:
+        opcode = SINGLE_BYTE_OPCODES[mnemonic]
+        # AAM/AAD, second byte is always 0b00001010
+        if mnemonic in ('aam', 'aad'):
+            return bytes([opcode, 0b00001010])
+        return bytes([opcode])
+
+    if mnemonic[:-1] in STR_OPCODES and mnemonic[-1] in 'bw' and not operands:
+        return bytes([STR_OPCODES[mnemonic[:-1]] | (mnemonic[-1] == 'w')])
+
+    if mnemonic == 'mov':
+        if isinstance(b, SegReg) and _is_rm(a):
+            return bytes([0b10001100]) + _mod_rm(b.index, a)
+        if isinstance(a, SegReg) and _is_rm(b):
+            return bytes([0b10001110]) + _mod_rm(a.index, b)
+        # Accumulator to or from a direct address
+        if isinstance(a, Reg) and a.index == 0 and isinstance(b, Mem) and b.rm is None:
+            return bytes([0b10100000 | a.w]) + _u16(b.disp)
+        if isinstance(b, Reg) and b.index == 0 and isinstance(a, Mem) and a.rm is None:
+            return bytes([0b10100010 | b.w]) + _u16(a.disp)
+        if isinstance(b, Imm):
+            w = _size_of(operands, sizes)
+            if isinstance(a, Reg):
+                return bytes([0b10110000 | (w << 3) | a.index]) + _imm(b.value, w)
+            return bytes([0b11000110 | w]) + _mod_rm(0, a) + _imm(b.value, w)
+        if isinstance(b, Reg):
+            return bytes([0b10001000 | b.w]) + _mod_rm(b.index, a)
+        return bytes([0b10001010 | a.w]) + _mod_rm(a.index, b)
+
+    if mnemonic in OP_GROUP_IMMED:
+        k = OP_GROUP_IMMED.index(mnemonic)
+        if isinstance(b, Imm):
+            w = _size_of(operands, sizes)
+            if isinstance(a, Reg) and a.index == 0 and not (w and _fits_imm8(b.value)):
+                return bytes([(k << 3) | 0b100 | w]) + _imm(b.value, w)
+            if w and _fits_imm8(b.value):
+                return bytes([0b10000011]) + _mod_rm(k, a) + _imm(b.value, 0)
+            return bytes([0b10000000 | w]) + _mod_rm(k, a) + _imm(b.value, w)
+        if isinstance(b, Reg):
+            return bytes([(k << 3) | b.w]) + _mod_rm(b.index, a)
+        return bytes([(k << 3) | 0b10 | a.w]) + _mod_rm(a.index, b)
+
+    if mnemonic in OP_GROUP_SHIFT and mnemonic != 'ERR':
+        w = _size_of([a], sizes)
+        v = isinstance(b, Reg)  # Shift by cl, otherwise by 1
+        return bytes([0b11010000 | (v << 1) | w]) + _mod_rm(OP_GROUP_SHIFT.index(mnemonic), a)
+
+    if mnemonic == 'test':
+        if isinstance(b, Imm):
+            w = _size_of(operands, sizes)
+            if isinstance(a, Reg) and a.index == 0:
+                return bytes([0b10101000 | w]) + _imm(b.value, w)
+            return bytes([0b11110110 | w]) + _mod_rm(0, a) + _imm(b.value, w)
+        reg, rm = (b, a) if isinstance(b, Reg) else (a, b)
+        return bytes([0b10000100 | reg.w]) + _mod_rm(reg.index, rm)
+
+    if mnemonic == 'xchg':
+        # Register with accumulator has its own one byte form
+        if isinstance(a, Reg) and isinstance(b, Reg) and a.w and (a.index == 0 or b.index == 0):
+            return bytes([0b10010000 | (a.index or b.index)])
+        reg, rm = (b, a) if isinstance(b, Reg) else (a, b)
+        return bytes([0b10000110 | reg.w]) + _mod_rm(reg.index, rm)
+
+    if mnemonic in CTRL_OPCODES:
+        disp = a.value - 2
+        if not -128 <= disp <= 127:
+            raise ValueError(f'{mnemonic} target out of range')
+        return bytes([CTRL_OPCODES[mnemonic], disp & 0xFF])
+
+    if mnemonic in ('call', 'jmp'):
+        call = mnemonic == 'call'
+        if isinstance(a, Rel):
+            return bytes([0b11101000 if call else 0b11101001]) + _u16(a.value - 3)
+        if isinstance(a, FarAddr):
+            return bytes([0b10011010 if call else 0b11101010]) + _u16(a.offset) + _u16(a.seg)
+        reg = (0b010 if call else 0b100) | fars[0]
+        return bytes([0b11111111]) + _mod_rm(reg, a)
+
+    if mnemonic in ('push', 'pop'):
+        push = mnemonic == 'push'
+        if isinstance(a, Reg):
+            return bytes([(0b01010000 if push else 0b01011000) | a.index])
+        if isinstance(a, SegReg):
+            return bytes([(0b00000110 if push else 0b00000111) | (a.index << 3)])
+        if push:
+            return bytes([0b11111111]) + _mod_rm(0b110, a)
+        return bytes([0b10001111]) + _mod_rm(0, a)
+
+    if mnemonic in ('inc', 'dec'):
+        dec = mnemonic == 'dec'
+        if isinstance(a, Reg) and a.w:
+            return bytes([(0b01001000 if dec else 0b01000000) | a.index])
+        return bytes([0b11111110 | _size_of([a], sizes)]) + _mod_rm(int(dec), a)
+
+    if mnemonic in GROUP_1:
+        return bytes([0b11110110 | _size_of([a], sizes)]) + _mod_rm(GROUP_1[mnemonic], a)
+
+    if mnemonic in LOAD_OPCODES:
+        return bytes([LOAD_OPCODES[mnemonic]]) + _mod_rm(a.index, b)
+
+    if mnemonic in ('in', 'out'):
+        acc, port = (a, b) if mnemonic == 'in' else (b, a)
+        opcode = 0b11100100 | ((mnemonic == 'out') << 1) | acc.w
+        if isinstance(port, Reg):
+            # Port in dx
+            return bytes([opcode | 0b1000])
+        return bytes([opcode, port.value & 0xFF])
+
+    if mnemonic == 'int':
+        return bytes([0b11001101, a.value & 0xFF])
+
+    if mnemonic in ('ret', 'retf'):
+        return bytes([0b11000010 if mnemonic == 'ret' else 0b11001010]) + _u16(a.value)
+
+    raise ValueError(f'unknown instruction {mnemonic!r}')
+
+def assemble_line(line : str) -> bytes:
+    """
+    Assembles one line of the decoder's output
+
+    Where an instruction has several encodings the one nasm picks is used:
+    register to register forms with d = 0, the shortest displacement, sign
+    extended 8-bit immediates, the accumulator and one byte register forms.
+    Overrides are written before the instruction that shows them.
+
+    The decoder writes the unsigned byte of a sign extended immediate, so a
+    negative accumulator immediate such as 'or ax, -31' decodes back as
+    'or ax, 225' once it is assembled to the shorter form.
+
+    :param str line: An instruction, comments after ';' are ignored
+    :return: Machine code, empty for a blank line or 'bits 16'
+    :rtype: bytes
+    """
+    text = line.partition(';')[0].strip()
+    if not text or text == 'bits 16':
+        return b''
+    prefix = b''
+    mnemonic, _, rest = text.partition(' ')
+    if mnemonic == 'db':
+        return bytes(int(value, 0) & 0xFF for value in rest.split(','))
+    if mnemonic == 'lock':
+        prefix = bytes([LOCK_PREFIX])
+        mnemonic, _, rest = rest.strip().partition(' ')
+        if not mnemonic:
+            return prefix
+    if mnemonic == 'rep' and rest:
+        prefix += bytes([REP_PREFIX])
+        mnemonic, _, rest = rest.strip().partition(' ')
+
+    operands, sizes, fars = [], [], []
+    if rest.strip():
+        for operand_text in rest.split(','):
+            operand, size, far = _parse_operand(operand_text.strip())
+            operands.append(operand)
+            sizes.append(size)
+            fars.append(far)
+    for operand in operands:
+        if isinstance(operand, Mem) and operand.seg is not None:
+            prefix += bytes([SEG_PREFIX_BYTES[operand.seg]])
+    return prefix + _encode(mnemonic, operands, sizes, fars)
+
+def assemble(text : str) -> bytes:
+    """
+    Assembles the output of decode_8086() or add_spacing()
+
+    :param str text: Lines of instructions
+    :return: Machine code
+    :rtype: bytes
+    :raises ValueError: A line isn't an instruction the decoder can write
+    """
+    out = bytearray()
+    for number, line in enumerate(text.splitlines(), 1):
+        try:
+            out += assemble_line(line)
+        except (ValueError, IndexError, AttributeError, KeyError) as e:
+            raise ValueError(f'line {number}: {line!r}: {e}') from None
+    return bytes(out)
+
+def round_trips(buf : ByteBuffer) -> bool:
+    """Checks that the records decoded from buf encode back into buf"""
+    records = list(decode_instructions(buf))
+    end = records[-1].offset + records[-1].length if records else 0
+    return encode_instructions(records) == bytes(buf[:end])
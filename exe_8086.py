@@ -0,0 +1,254 @@
+# DOS executables
+# Loads DOS MZ .EXE and .COM files for decoding. The file is memory-mapped
+# and only its load module is decoded, through a memoryview of the mapping,
+# so the header and any overlay after the load module are never copied or
+# decoded. Addresses are segment:offset, with segments relative to the load
+# segment as in the header, and .COM files are loaded at 0000:0100.
+import bisect, mmap, struct, weakref, argparse
+from collections.abc import Iterator
+from typing import NamedTuple
+from decode_8086 import Coverage, Instruction, decode_instructions
+from str_util import iter_spacing
+
+MZ_SIGNATURES = (b'MZ', b'ZM')
+MZ_HEADER = struct.Struct('<2s13H')
+MZ_RELOCATION = struct.Struct('<HH')
+PAGE_SIZE = 512
+PARAGRAPH_SIZE = 16
+COM_ORG = 0x100
+# A .COM file and its PSP have to fit in one segment, with a word of stack
+COM_MAX_SIZE = 0x10000 - COM_ORG - 2
+
+class MZHeader(NamedTuple):
+    """The fixed part of an MZ header"""
+    signature : bytes
+    last_page_size : int        # Bytes used in the last page, 0 if all of it
+    pages : int                 # 512 byte pages in the file, header included
+    relocation_count : int
+    header_paragraphs : int     # Size of the header, relocations included
+    min_alloc : int             # Paragraphs needed after the load module
+    max_alloc : int
+    ss : int                    # Initial stack, relative to the load segment
+    sp : int
+    checksum : int
+    ip : int                    # Entry point, relative to the load segment
+    cs : int
+    relocation_offset : int     # File offset of the relocation table
+    overlay : int               # Overlay number, 0 for the main program
+
+class Image:
+    """
+    A memory-mapped .EXE or .COM file
+
+    Offsets are from the start of the load module. A load module offset is
+    at address segment:offset with segment * 16 + offset = org + offset.
+
+    :ivar str kind: 'exe' or 'com'
+    :ivar MZHeader header: The MZ header, None for a .COM file
+    :ivar list[tuple[int, int]] relocations: (segment, offset) of every
+        segment fixup in the load module
+    :ivar int load_start: File offset of the load module
+    :ivar int load_end: File offset after the load module
+    :ivar int overlay_size: Bytes after the load module
+    :ivar tuple[int, int] entry: Initial cs and ip
+    :ivar int org: Offset of the load module from segment 0
+    """
+    def __init__(self, file_path : str):
+        with open(file_path,'rb') as file:
+            try:
+                self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise ValueError('empty file') from None
+        try:
+            self._load()
+        except Exception:
+            self._mmap.close()
+            raise
+        self._fixups = sorted(segment * PARAGRAPH_SIZE + offset for segment, offset in self.relocations)
+        # Decodes that may still hold a view of the mapping
+        self._decodes = weakref.WeakSet()
+
+    def _load(self):
+        buf = self._mmap
+        size = len(buf)
+        if buf[:2] not in MZ_SIGNATURES:
+            if size > COM_MAX_SIZE:
+                raise ValueError(f'too large for a .COM file ({size} bytes) and no MZ header')
+            self.kind = 'com'
+            self.header = None
+            self.relocations = []
+            self.load_start = 0
+            self.load_end = size
+            self.entry = (0, COM_ORG)
+            self.org = COM_ORG
+        else:
+            if size < MZ_HEADER.size:
+                raise ValueError('MZ header is truncated')
+            header = MZHeader(*MZ_HEADER.unpack_from(buf))
+            end = header.pages * PAGE_SIZE
+            if header.last_page_size:
+                end -= PAGE_SIZE - header.last_page_size
+            self.kind = 'exe'
+            self.header = header
+            self.load_start = header.header_paragraphs * PARAGRAPH_SIZE
+            # A file cut short keeps what is left of the load module
+            self.load_end = min(end, size)
+            if self.load_start > self.load_end:
+                raise ValueError('MZ header is larger than the file')
+            table_end = header.relocation_offset + header.relocation_count * MZ_RELOCATION.size
+            if header.relocation_count and table_end > self.load_start:
+                raise ValueError('relocation table runs past the header')
+            self.relocations = [(segment, offset) for offset, segment in
+                                MZ_RELOCATION.iter_unpack(buf[header.relocation_offset:table_end])]
+            self.entry = (header.cs, header.ip)
+            self.org = 0
+        self.overlay_size = size - self.load_end
+
+    @property
+    def load_size(self) -> int:
+        return self.load_end - self.load_start
+
+    @property
+    def entry_offset(self) -> int:
+        """Load module offset of the entry point"""
+        cs, ip = self.entry
+        return cs * PARAGRAPH_SIZE + ip - self.org
+
+    def address(self, offset : int) -> tuple[int, int]:
+        """
+        segment:offset of a load module offset, in the entry code segment
+        when it is within 64 KB of its start, normalized otherwise
+        """
+        linear = self.org + offset
+        cs = self.entry[0]
+        ip = linear - cs * PARAGRAPH_SIZE
+        if 0 <= ip <= 0xFFFF:
+            return cs, ip
+        return linear // PARAGRAPH_SIZE, linear % PARAGRAPH_SIZE
+
+    def fixups(self, ins : Instruction) -> int:
+        """Segment fixups in the bytes of a decoded instruction"""
+        start = bisect.bisect_left(self._fixups, ins.offset)
+        return bisect.bisect_left(self._fixups, ins.offset + ins.length, start) - start
+
+    def instructions(self, start : int = 0, strict : bool = True, coverage : Coverage = None) -> Iterator[Instruction]:
+        """
+        Decodes the load module, straight from the mapped file
+
+        :param int start: Load module offset to start at, such as entry_offset
+        :param bool strict: Stop at the first byte that can't be decoded, or
+            write it as db and carry on
+        :param Coverage coverage: Counts the bytes written as db
+        :return: Generator of Instruction, with load module offsets. It
+            stops when the image is closed
+        :rtype: Iterator[Instruction]
+        """
+        instructions = self._instructions(start, strict, coverage)
+        self._decodes.add(instructions)
+        return instructions
+
+    def _instructions(self, start : int, strict : bool, coverage : Coverage) -> Iterator[Instruction]:
+        with memoryview(self._mmap) as view, view[self.load_start + start:self.load_end] as module:
+            for ins in decode_instructions(module, strict, coverage):
+                ins.offset += start
+                yield ins
+
+    def close(self):
+        # Decodes left unfinished release their views before the file is unmapped
+        for instructions in list(self._decodes):
+            instructions.close()
+        self._mmap.close()
+
+    def __enter__(self) -> 'Image':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def load_image(file_path : str) -> Image:
+    """
+    Maps a .EXE file, or any file without an MZ header as a .COM file
+
+    :raises ValueError: The header is truncated or inconsistent, or a .COM
+        file is too large
+    :rtype: Image
+    """
+    return Image(file_path)
+
+def _summary(image : Image) -> list[str]:
+    cs, ip = image.entry
+    lines = [f'; {'MZ executable' if image.kind == 'exe' else '.COM file, org 0x100'}',
+             f'; load module: {image.load_size} bytes at file offset {image.load_start:#x}']
+    if image.kind == 'exe':
+        header = image.header
+        lines.append(f'; relocations: {len(image.relocations)}, overlay: {image.overlay_size} bytes')
+        lines.append(f'; stack: {header.ss:04x}:{header.sp:04x}, '
+                     f'memory: {header.min_alloc}-{header.max_alloc} paragraphs after the load module')
+    lines.append(f'; entry point: {cs:04x}:{ip:04x}, segments relative to the '
+                 f'{'load segment' if image.kind == 'exe' else 'PSP'}')
+    return lines
+
+def iter_listing(image : Image, start : int = 0, strict : bool = True, coverage : Coverage = None) -> Iterator[str]:
+    """
+    Lines of disassembly of an image, with the address of each instruction,
+    the entry point and segment fixups in comments after it
+
+    :param Image image: The image to decode
+    :param int start: Load module offset to start decoding at
+    :param bool strict: Stop at the first byte that can't be decoded, or
+        write it as db and carry on
+    :param Coverage coverage: Counts the bytes written as db
+    :return: Generator of str lines, without line endings
+    :rtype: Iterator[str]
+    """
+    entry = image.entry_offset
+    yield from _summary(image)
+    yield 'bits 16'
+    seen_entry = False
+    for ins in image.instructions(start, strict, coverage):
+        segment, offset = image.address(ins.offset)
+        comment = f'; {segment:04x}:{offset:04x}'
+        if ins.offset == entry:
+            comment += ' entry point'
+            seen_entry = True
+        fixups = image.fixups(ins)
+        if fixups:
+            comment += ' segment fixup' if fixups == 1 else f' {fixups} segment fixups'
+        yield f'{ins.text:<32}{comment}'
+    if not seen_entry:
+        yield '; the entry point is not at the start of a decoded instruction'
+
+def main():
+    parser = argparse.ArgumentParser(description='Decodes the load module of a DOS .EXE or .COM file')
+    parser.add_argument('path', help='the executable to decode, files without an MZ header are .COM files')
+    parser.add_argument('-o', '--output', help='write the disassembly to this file instead of printing it')
+    parser.add_argument('--from-entry', action='store_true', help='start decoding at the entry point')
+    parser.add_argument('--strict', action=argparse.BooleanOptionalAction, default=True,
+                        help="stop at the first byte that can't be decoded (default: strict)")
+    args = parser.parse_args()
+
+    coverage = None if args.strict else Coverage()
+    try:
+        image = load_image(args.path)
+    except ValueError as e:
+        parser.exit(1, f'{args.path}: {e}\n')
+    with image:
+        start = 0
+        if args.from_entry:
+            start = image.entry_offset
+            if not 0 <= start < image.load_size:
+                parser.exit(1, f'{args.path}: the entry point is outside the load module\n')
+        lines = iter_spacing(iter_listing(image, start, args.strict, coverage))
+        if args.output:
+            with open(args.output,'w') as file:
+                file.writelines(lines)
+            print(f'Output written to -> {args.output}')
+        else:
+            for line in lines:
+                print(line, end='')
+    if coverage is not None:
+        print(f'{coverage.decoded_percent(image.load_size - start):.2f}% decoded', end='')
+        print(f', unknown opcodes: {coverage.histogram()}' if coverage.data_bytes else '')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+# Instruction lengths and boundaries without formatting any text
+# The length of every instruction the decoder recognizes is fixed by its
+# first two bytes, so one lookup per byte offset gives the length of an
+# instruction starting there. NumPy does the lookups for a whole buffer at
+# once when it is installed.
+import array, functools, itertools
+from typing import NamedTuple
+from decode_8086 import ByteBuffer, LOCK_PREFIX, length_table, LENGTH_STOP as STOP, LENGTH_SEG_PREFIX as SEG_PREFIX, LENGTH_LOCK as LOCK
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+@functools.cache
+def _length_array():
+    return np.frombuffer(length_table(), dtype=np.uint8)
+
+def instruction_lengths(buf : ByteBuffer) -> bytes:
+    """
+    Finds the length of an instruction starting at every byte offset
+
+    :param ByteBuffer buf: The machine code
+    :return: A length, STOP, SEG_PREFIX or LOCK for each byte of buf. A
+        length may run past the end of buf
+    :rtype: bytes
+    """
+    if np is not None:
+        data = np.frombuffer(buf, dtype=np.uint8)
+        index = data.astype(np.uint16) << 8
+        index[:-1] |= data[1:]
+        return _length_array()[index].tobytes()
+    table = length_table()
+    # The last byte has no second byte, 0 stands in for it
+    nexts = itertools.chain(itertools.islice(buf, 1, None), (0,))
+    return bytes([table[(byte1 << 8) | byte2] for byte1, byte2 in zip(buf, nexts)])
+
+class Boundaries(NamedTuple):
+    """Where the instructions of a buffer are, as decode_instructions() finds them"""
+    offsets : array.array   # Offset of each instruction, including its prefixes
+    opcodes : array.array   # First byte after the prefixes (LOCK_PREFIX for a lock on its own)
+    end : int               # Offset after the last instruction, where decoding stopped
+
+def instruction_boundaries(buf : ByteBuffer) -> Boundaries:
+    """
+    Walks the instructions of buf with instruction_lengths()
+
+    :param ByteBuffer buf: The machine code
+    :return: The same offsets as Instruction.offset from decode_instructions()
+    :rtype: Boundaries
+    """
+    lengths = instruction_lengths(buf)
+    end = len(buf)
+    offsets = array.array('L')
+    opcodes = array.array('B')
+    add_offset = offsets.append
+    add_opcode = opcodes.append
+    pos = start = 0
+    lock = False
+
+    while pos < end:
+        n = lengths[pos]
+        if n == SEG_PREFIX:
+            pos += 1
+            continue
+        if n == LOCK:
+            # A repeated lock is kept on its own line
+            if lock:
+                add_offset(start)
+                add_opcode(LOCK_PREFIX)
+                start = pos
+            lock = True
+            pos += 1
+            continue
+        # Not recognized or truncated
+        if n == STOP or pos + n > end:
+            break
+        add_offset(start)
+        add_opcode(buf[pos])
+        pos += n
+        start = pos
+        lock = False
+
+    # A lock with nothing after it
+    if lock:
+        add_offset(start)
+        add_opcode(LOCK_PREFIX)
+        start = pos
+    return Boundaries(offsets, opcodes, start)
+
+def opcode_counts(buf : ByteBuffer) -> list[int]:
+    """
+    Counts the instructions of buf by their first byte after the prefixes
+
+    :param ByteBuffer buf: The machine code
+    :return: Count for each of the 256 opcodes
+    :rtype: list[int]
+    """
+    opcodes = instruction_boundaries(buf).opcodes
+    if np is not None:
+        return np.bincount(np.frombuffer(opcodes, dtype=np.uint8), minlength=256).tolist()
+    counts = [0] * 256
+    for opcode in opcodes:
+        counts[opcode] += 1
+    return counts
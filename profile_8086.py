@@ -0,0 +1,182 @@
+# Profiling for the 8086 decoder
+# Counts instructions, bytes and time for each instruction family, with the
+# time spent in mod_rm_schema(), add_spacing() and I/O kept apart. The timed
+# decoders and mod_rm_schema() are only passed to a profiled decode, in its
+# decoder table and DecodeState, so other decodes are neither timed nor
+# counted.
+import time
+import decode_8086
+from decode_8086 import DECODE_TABLE, LOCK_PREFIX, DecodeState
+from str_util import add_spacing
+
+# Families are the branches of the decoder, named like the comments above
+# each decoder in decode_8086.py
+FAMILY_NAMES = \
+{
+    decode_8086._decode_mov_rm_reg              : 'TEST/XCHG/MOV Register/Memory <-> Register',
+    decode_8086._decode_mov_imm_reg             : 'MOV Immediate to Register',
+    decode_8086._decode_mov_imm_rm              : 'MOV Immediate to Register/Memory',
+    decode_8086._decode_mov_sr                  : 'MOV SR<->REG/MEM',
+    decode_8086._decode_test_acc                : 'TEST Accumulator',
+    decode_8086._decode_mov_mem_acc             : 'Memory to Accumulator / Accumulator to Memory',
+    decode_8086._decode_immed_rm                : 'Immediate with register/memory',
+    decode_8086._decode_arith_rm_reg            : 'OP_GROUP_IMMED REG_MEM <-> REG_MEM',
+    decode_8086._decode_arith_imm_acc           : 'OP_GROUP_IMMED IMM_ACC',
+    decode_8086._decode_shift                   : 'OP_GROUP_SHIFT',
+    decode_8086._decode_ctrl_transfer           : 'CONTROL TRANSFER',
+    decode_8086._decode_str_op                  : 'String ops',
+    decode_8086._decode_group_rm                : 'OP_GROUP_1 and OP_GROUP_2 + pop',
+    decode_8086._decode_inc_dec_push_pop_reg    : 'INC/DEC/PUSH/POP Register',
+    decode_8086._decode_far_direct              : 'CALL/JMP Direct Intersegment',
+    decode_8086._decode_near_direct             : 'CALL/JMP Direct within segment',
+    decode_8086._decode_ret_imm                 : 'RET adding immediate to SP',
+    decode_8086._decode_xchg_acc                : 'XCHG Register with accumulator',
+    decode_8086._decode_in_out                  : 'IN/OUT IMMED8 and IN/OUT DX',
+    decode_8086._decode_load                    : 'LOAD_OPS',
+    decode_8086._decode_ascii_adjust            : 'AAM/AAD',
+    decode_8086._decode_int_imm                 : 'INT IMMED',
+    decode_8086._decode_single_byte             : 'Single byte ops',
+}
+LOCK_FAMILY = 'LOCK on its own'
+
+class FamilyStats:
+    """Totals for one instruction family"""
+    __slots__ = ('count', 'bytes', 'seconds')
+
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0      # Including prefixes
+        self.seconds = 0.0  # Decoding and formatting, mod_rm_schema() included
+
+class DecodeProfile:
+    """
+    Where the time of one or more decodes went
+
+    :ivar dict[str, FamilyStats] families: Totals by family name
+    :ivar int mod_rm_calls: Calls to mod_rm_schema()
+    :ivar float mod_rm_seconds: Time in mod_rm_schema(), also counted in the families
+    :ivar float decode_seconds: Time in the decode loop, prefixes included
+    :ivar float spacing_seconds: Time in add_spacing()
+    :ivar float io_seconds: Time reading input and writing output
+    :ivar int size: Bytes of input
+    """
+    def __init__(self):
+        self.families = {name : FamilyStats() for name in (*dict.fromkeys(FAMILY_NAMES.values()), LOCK_FAMILY)}
+        self.mod_rm_calls = 0
+        self.mod_rm_seconds = 0.0
+        self.decode_seconds = 0.0
+        self.spacing_seconds = 0.0
+        self.io_seconds = 0.0
+        self.size = 0
+
+    @property
+    def total_seconds(self) -> float:
+        return self.decode_seconds + self.spacing_seconds + self.io_seconds
+
+    def to_dict(self) -> dict:
+        """The profile, ready to be written as JSON"""
+        return \
+        {
+            'size'      : self.size,
+            'families'  :
+            {
+                name : {'count' : stats.count, 'bytes' : stats.bytes, 'seconds' : stats.seconds}
+                for name, stats in self.families.items() if stats.count
+            },
+            'mod_rm_schema' : {'calls' : self.mod_rm_calls, 'seconds' : self.mod_rm_seconds},
+            'decode_seconds'    : self.decode_seconds,
+            'spacing_seconds'   : self.spacing_seconds,
+            'io_seconds'        : self.io_seconds,
+            'total_seconds'     : self.total_seconds,
+        }
+
+    def table(self) -> str:
+        """The profile as a table, busiest family first"""
+        width = max(len(name) for name in self.families)
+        decode = self.decode_seconds or 1
+        total = self.total_seconds or 1
+        lines = [f'{'family'.ljust(width)}  {'count':>10}  {'bytes':>10}  {'time (ms)':>10}  {'decode':>7}']
+        for name, stats in sorted(self.families.items(), key=lambda item: -item[1].seconds):
+            if stats.count:
+                lines.append(f'{name.ljust(width)}  {stats.count:>10}  {stats.bytes:>10}  '
+                             f'{stats.seconds * 1000:>10.2f}  {stats.seconds / decode:>7.1%}')
+        lines.append('')
+        for name, seconds, share in (('decode', self.decode_seconds, total),
+                                     ('  mod_rm_schema', self.mod_rm_seconds, total),
+                                     ('add_spacing', self.spacing_seconds, total),
+                                     ('I/O', self.io_seconds, total),
+                                     ('total', self.total_seconds, total)):
+            lines.append(f'{name.ljust(width)}  {'':>10}  {'':>10}  {seconds * 1000:>10.2f}  {seconds / share:>7.1%}')
+        return '\n'.join(lines)
+
+def _timed_decoder(decoder, stats : FamilyStats):
+    def timed(ins, byte1, buf, pos, state):
+        start = time.perf_counter()
+        try:
+            return decoder(ins, byte1, buf, pos, state)
+        finally:
+            stats.seconds += time.perf_counter() - start
+    return timed
+
+def _timed_mod_rm(profile : DecodeProfile):
+    """A mod_rm_schema() that adds its calls and time to profile"""
+    mod_rm_schema = decode_8086.mod_rm_schema
+
+    def timed(ins, buf, pos, state):
+        start = time.perf_counter()
+        try:
+            return mod_rm_schema(ins, buf, pos, state)
+        finally:
+            profile.mod_rm_seconds += time.perf_counter() - start
+            profile.mod_rm_calls += 1
+    return timed
+
+def profile_decode(file_path : str, out_path : str = None, profile : DecodeProfile = None) -> tuple[str, DecodeProfile]:
+    """
+    Decodes and spaces a file like decode_file(), timing every step
+
+    The memo of formatted instructions isn't used, so every instruction is
+    decoded and formatted. Only this decode's state carries the timed
+    mod_rm_schema(), so other decodes running at the same time aren't timed.
+
+    :param str file_path: The binary to decode
+    :param str out_path: Where to write the spaced disassembly, if anywhere
+    :param DecodeProfile profile: Profile to add to, for several files
+    :return: The spaced disassembly and the profile
+    :rtype: tuple[str, DecodeProfile]
+    """
+    profile = DecodeProfile() if profile is None else profile
+    families = profile.families
+    stats = [None if decoder is None else families[FAMILY_NAMES[decoder]] for decoder in DECODE_TABLE]
+    decoders = [None if decoder is None else _timed_decoder(decoder, stats[byte])
+                for byte, decoder in enumerate(DECODE_TABLE)]
+    lock_stats = families[LOCK_FAMILY]
+    timer = time.perf_counter
+
+    start = timer()
+    with open(file_path, 'rb') as file:
+        buf = file.read()
+    profile.io_seconds += timer() - start
+    profile.size += len(buf)
+
+    lines = ['bits 16']
+    start = timer()
+    state = DecodeState(mod_rm=_timed_mod_rm(profile))
+    for ins in decode_8086._iter_buffer(buf, state, decoders=decoders):
+        family = lock_stats if ins.opcode == LOCK_PREFIX else stats[ins.opcode]
+        format_start = timer()
+        lines.append(ins.text)
+        family.seconds += timer() - format_start
+        family.count += 1
+        family.bytes += ins.length
+    profile.decode_seconds += timer() - start
+
+    start = timer()
+    text = add_spacing('\n'.join(lines))
+    profile.spacing_seconds += timer() - start
+
+    if out_path is not None:
+        start = timer()
+        decode_8086.write_to_file(text, out_path)
+        profile.io_seconds += timer() - start
+    return text, profile
@@ -0,0 +1,1005 @@
+# 8086 simulator
+# Executes decoded instructions against register, flag and memory state kept
+# in an array and a bytearray. Each address is decoded once into a handler
+# with its operands already bound, and handlers are thrown away when the
+# bytes they were decoded from are written to.
+import sys, time, array, argparse
+from decode_8086 import (OP_GROUP_IMMED, OP_GROUP_SHIFT, STR_OPS, DECODE_TABLE, LOCK_PREFIX, MNEMONICS, DATA_OP,
+                         REG_TABLE_W0, REG_TABLE_W1, SEG_REG, Coverage, DecodeState, Instruction)
+import decode_8086
+
+# Indexes in CPU.regs
+AX, CX, DX, BX, SP, BP, SI, DI = range(8)
+ES, CS, SS, DS = range(8, 12)
+IP = 12
+FLAGS = 13
+REG_NAMES = [*REG_TABLE_W1, *SEG_REG, 'ip', 'flags']
+
+# Flags
+CF = 0x0001
+PF = 0x0004
+AF = 0x0010
+ZF = 0x0040
+SF = 0x0080
+TF = 0x0100
+IF = 0x0200
+DF = 0x0400
+OF = 0x0800
+FLAG_NAMES = [(CF, 'C'), (PF, 'P'), (AF, 'A'), (ZF, 'Z'), (SF, 'S'), (TF, 'T'), (IF, 'I'), (DF, 'D'), (OF, 'O')]
+ARITH_FLAGS = CF | PF | AF | ZF | SF | OF
+NOT_ARITH = 0xFFFF & ~ARITH_FLAGS
+# Bits of FLAGS that exist, the rest read as 1 when flags are pushed
+FLAGS_MASK = 0x0FD5
+FLAGS_SET = 0xF002
+
+MEMORY_SIZE = 1 << 20
+ADDR_MASK = MEMORY_SIZE - 1
+MASK = (0xFF, 0xFFFF)
+SIGN = (0x80, 0x8000)
+
+def _szp(value : int, w : int) -> int:
+    """SF, ZF and PF for a result, PF is the parity of the low byte"""
+    flags = 0 if bin(value & 0xFF).count('1') & 1 else PF
+    if value == 0:
+        flags |= ZF
+    if value & SIGN[w]:
+        flags |= SF
+    return flags
+
+# SF, ZF and PF for every byte and word result
+SZP = (bytes(_szp(v, 0) for v in range(0x100)), bytes(_szp(v, 1) for v in range(0x10000)))
+SZP_B, SZP_W = SZP
+
+def _add(a : int, b : int, c : int, w : int) -> tuple[int, int]:
+    r = a + b + c
+    res = r & MASK[w]
+    return res, SZP[w][res] | (r > MASK[w]) | ((a ^ b ^ r) & AF) | (OF if (a ^ r) & (b ^ r) & SIGN[w] else 0)
+
+def _sub(a : int, b : int, c : int, w : int) -> tuple[int, int]:
+    r = a - b - c
+    res = r & MASK[w]
+    return res, SZP[w][res] | (r < 0) | ((a ^ b ^ r) & AF) | (OF if (a ^ b) & (a ^ r) & SIGN[w] else 0)
+
+def _alu_add(a : int, b : int, f : int, w : int) -> tuple[int, int]:
+    r = a + b
+    res = r & MASK[w]
+    return res, SZP[w][res] | (r > MASK[w]) | ((a ^ b ^ r) & AF) | (OF if (a ^ r) & (b ^ r) & SIGN[w] else 0)
+
+def _alu_adc(a : int, b : int, f : int, w : int) -> tuple[int, int]:
+    return _add(a, b, f & CF, w)
+
+def _alu_sbb(a : int, b : int, f : int, w : int) -> tuple[int, int]:
+    return _sub(a, b, f & CF, w)
+
+def _alu_sub(a : int, b : int, f : int, w : int) -> tuple[int, int]:
+    r = a - b
+    res = r & MASK[w]
+    return res, SZP[w][res] | (r < 0) | ((a ^ b ^ r) & AF) | (OF if (a ^ b) & (a ^ r) & SIGN[w] else 0)
+
+def _alu_or(a : int, b : int, f : int, w : int) -> tuple[int, int]:
+    return a | b, SZP[w][a | b]
+
+def _alu_and(a : int, b : int, f : int, w : int) -> tuple[int, int]:
+    return a & b, SZP[w][a & b]
+
+def _alu_xor(a : int, b : int, f : int, w : int) -> tuple[int, int]:
+    return a ^ b, SZP[w][a ^ b]
+
+# Arithmetic in OP_GROUP_IMMED order, each takes the operands, the flags
+# and w and returns the result and the new arithmetic flags
+ALU = [_alu_add, _alu_or, _alu_adc, _alu_sbb, _alu_and, _alu_sub, _alu_xor, _alu_sub]
+CMP = OP_GROUP_IMMED.index('cmp')
+
+def _shift(k : int, a : int, n : int, f : int, w : int) -> tuple[int, int]:
+    """
+    Shifts or rotates a by n, k is the index in OP_GROUP_SHIFT
+
+    :return: The result and all of the flags
+    :rtype: tuple[int, int]
+    """
+    if n == 0:
+        return a, f
+    bits = 8 << w
+    mask = MASK[w]
+    sign = SIGN[w]
+    name = OP_GROUP_SHIFT[k]
+    if name == 'shl':
+        r = a << n
+        res = r & mask
+        cf = (r >> bits) & 1
+        of = bool(res & sign) ^ cf
+        return res, (f & NOT_ARITH) | SZP[w][res] | cf | (OF if of else 0)
+    if name == 'shr':
+        res = a >> n
+        cf = (a >> (n - 1)) & 1
+        return res, (f & NOT_ARITH) | SZP[w][res] | cf | (OF if a & sign else 0)
+    if name == 'sar':
+        sa = a - (a & sign) * 2
+        res = (sa >> n) & mask
+        cf = (sa >> (n - 1)) & 1
+        return res, (f & NOT_ARITH) | SZP[w][res] | cf
+    # Rotates only change CF and OF
+    if name in ('rol', 'ror'):
+        n %= bits
+        res = ((a << n) | (a >> (bits - n))) & mask if name == 'rol' else ((a >> n) | (a << (bits - n))) & mask
+        if name == 'rol':
+            cf = res & 1
+            of = bool(res & sign) ^ cf
+        else:
+            cf = int(bool(res & sign))
+            of = bool(res & sign) ^ bool(res & (sign >> 1))
+    else:
+        # Through carry, bits + 1 wide
+        n %= bits + 1
+        wide = a | ((f & CF) << bits)
+        if name == 'rcl':
+            wide = ((wide << n) | (wide >> (bits + 1 - n))) & ((mask << 1) | 1)
+        else:
+            wide = ((wide >> n) | (wide << (bits + 1 - n))) & ((mask << 1) | 1)
+        res = wide & mask
+        cf = wide >> bits
+        of = (bool(res & sign) ^ cf) if name == 'rcl' else bool(res & sign) ^ bool(res & (sign >> 1))
+    return res, (f & ~(CF | OF) & 0xFFFF) | cf | (OF if of else 0)
+
+# Condition of each conditional jump, by the low nibble of its opcode. Odd
+# opcodes are the opposite of the even one before them
+CONDITIONS = \
+[
+    lambda f: f & OF,
+    lambda f: f & CF,
+    lambda f: f & ZF,
+    lambda f: f & (CF | ZF),
+    lambda f: f & SF,
+    lambda f: f & PF,
+    lambda f: bool(f & SF) != bool(f & OF),
+    lambda f: f & ZF or bool(f & SF) != bool(f & OF),
+]
+
+# Flags tested by the conditions above, None when SF and OF are compared
+JUMP_FLAGS = [OF, CF, ZF, CF | ZF, SF, PF, None, None]
+
+# Registers of each r/m effective address, and whether it uses bp
+EA_REGS = [(BX, SI), (BX, DI), (BP, SI), (BP, DI), (SI,), (DI,), (BP,), (BX,)]
+
+class Halt(Exception):
+    """Raised by hlt to stop CPU.run()"""
+
+class CPU:
+    """
+    8086 registers, flags and 1 MB of memory, with a cache of decoded
+    instructions keyed by address
+
+    :ivar array.array regs: ax cx dx bx sp bp si di, es cs ss ds, ip and
+        flags, indexed by AX...FLAGS
+    :ivar bytearray memory: The 1 MB address space
+    :ivar array.array ports: Values read by in and written by out
+    :ivar int stop_ip: run() stops when ip reaches this, None to run until hlt
+    :ivar int executed: Instructions executed so far
+    """
+    def __init__(self):
+        self.regs = array.array('H', bytes(2 * 14))
+        self.memory = bytearray(MEMORY_SIZE)
+        self.ports = array.array('H', bytes(2 * 0x10000))
+        self.stop_ip = None
+        self.executed = 0
+        # Physical address -> (handler, length)
+        self._cache = {}
+        # Non zero for every byte a cached instruction was decoded from
+        self._code = bytearray(MEMORY_SIZE)
+        self._max_length = 1
+        self.decodes = 0
+
+    def load(self, code : bytes, segment : int = 0, offset : int = 0):
+        """
+        Copies code to segment:offset and points cs:ip at it, run() stops at its end
+
+        Code past the top of memory wraps around to address 0, like the
+        20 bit address bus.
+
+        :raises ValueError: code is larger than memory
+        """
+        if len(code) > MEMORY_SIZE:
+            raise ValueError(f'code is {len(code)} bytes, memory is {MEMORY_SIZE}')
+        start = ((segment << 4) + offset) & ADDR_MASK
+        head = min(len(code), MEMORY_SIZE - start)
+        self.memory[start:start+head] = code[:head]
+        self.memory[:len(code)-head] = code[head:]
+        self.invalidate()
+        self.regs[CS] = segment
+        self.regs[IP] = offset
+        self.stop_ip = (offset + len(code)) & 0xFFFF
+
+    def invalidate(self):
+        """Drops every cached instruction"""
+        self._cache.clear()
+        self._code[:] = bytes(MEMORY_SIZE)
+
+    def _invalidate(self, addr : int):
+        """Drops the cached instructions that include the byte at addr"""
+        cache = self._cache
+        for start in range(addr - self._max_length + 1, addr + 1):
+            entry = cache.get(start & ADDR_MASK)
+            if entry is not None and start + entry[1] > addr:
+                del cache[start & ADDR_MASK]
+
+    def __getitem__(self, name : str) -> int:
+        """A register by name, byte registers included"""
+        if name in REG_TABLE_W0:
+            i = REG_TABLE_W0.index(name)
+            return (self.regs[i & 3] >> 8) if i & 4 else self.regs[i & 3] & 0xFF
+        return self.regs[REG_NAMES.index(name)]
+
+    def __setitem__(self, name : str, value : int):
+        if name in REG_TABLE_W0:
+            i = REG_TABLE_W0.index(name)
+            if i & 4:
+                self.regs[i & 3] = (self.regs[i & 3] & 0xFF) | ((value & 0xFF) << 8)
+            else:
+                self.regs[i & 3] = (self.regs[i & 3] & 0xFF00) | (value & 0xFF)
+        else:
+            self.regs[REG_NAMES.index(name)] = value & 0xFFFF
+
+    def flags_text(self) -> str:
+        """Set flags as letters, like 'CPZ'"""
+        return ''.join(letter for flag, letter in FLAG_NAMES if self.regs[FLAGS] & flag)
+
+    @property
+    def cached(self) -> int:
+        """Instructions in the decode cache"""
+        return len(self._cache)
+
+    def run(self, count : int = None) -> int:
+        """
+        Executes instructions until hlt, ip reaching stop_ip or count of them
+
+        :param int count: Most instructions to execute, no limit if None
+        :return: Instructions executed
+        :rtype: int
+        :raises ValueError: An instruction the simulator can't execute
+        """
+        regs = self.regs
+        cache_get = self._cache.get
+        compile = self._compile
+        ip = regs[IP]
+        stop = self.stop_ip
+        limit = sys.maxsize if count is None else count
+        n = 0
+        try:
+            while n < limit and ip != stop:
+                addr = ((regs[CS] << 4) + ip) & ADDR_MASK
+                entry = cache_get(addr) or compile(addr)
+                ip = entry[0]((ip + entry[1]) & 0xFFFF)
+                n += 1
+        except Halt as halt:
+            ip = halt.args[0]
+            n += 1
+        finally:
+            regs[IP] = ip
+            self.executed += n
+        return n
+
+    def step(self) -> int:
+        """Executes one instruction"""
+        stop, self.stop_ip = self.stop_ip, None
+        try:
+            return self.run(1)
+        finally:
+            self.stop_ip = stop
+
+    def _decode(self, addr : int) -> Instruction:
+        """Decodes the instruction at a physical address, with its prefixes"""
+        # Not strict, so a byte that can't be decoded comes back as data with
+        # its opcode in coverage instead of being printed
+        coverage = Coverage()
+        records = decode_8086._iter_buffer(self.memory, DecodeState(), addr, strict=False, coverage=coverage)
+        locks = []
+        for ins in records:
+            # A repeated lock is decoded on its own, it only prefixes the
+            # instruction after it
+            if ins.opcode != LOCK_PREFIX:
+                break
+            locks.append(ins)
+        else:
+            raise ValueError(f'instruction at {addr:#07x} runs past the end of memory')
+        records.close()
+        if ins.op == DATA_OP:
+            opcode, = coverage.opcodes
+            if DECODE_TABLE[opcode] is not None and STR_OPS.get(opcode >> 1) != 'rep':
+                raise ValueError(f'instruction at {addr:#07x} runs past the end of memory')
+            raise ValueError(f'instruction not recognized at {addr:#07x}: {opcode:#04x}')
+        if locks:
+            ins.offset = addr
+            ins.length += sum(lock.length for lock in locks)
+            ins.prefixes = b''.join(lock.prefixes for lock in locks) + (ins.prefixes or b'')
+        return ins
+
+    def _compile(self, addr : int) -> tuple:
+        """Decodes the instruction at addr into a handler and caches it"""
+        ins = self._decode(addr)
+        entry = (self._handler(ins), ins.length)
+        self._cache[addr] = entry
+        self._code[addr:addr+ins.length] = b'\x01' * ins.length
+        self._max_length = max(self._max_length, ins.length)
+        self.decodes += 1
+        return entry
+
+    # Memory access
+    def _memory_ops(self):
+        mem = self.memory
+        code = self._code
+        invalidate = self._invalidate
+
+        def read16(a):
+            return mem[a] | (mem[(a + 1) & ADDR_MASK] << 8)
+
+        def write8(a, v):
+            mem[a] = v
+            if code[a]:
+                invalidate(a)
+
+        def write16(a, v):
+            b = (a + 1) & ADDR_MASK
+            mem[a] = v & 0xFF
+            mem[b] = v >> 8
+            if code[a] or code[b]:
+                invalidate(a)
+                invalidate(b)
+
+        return mem.__getitem__, read16, write8, write16
+
+    def _offset(self, ins : Instruction):
+        """
+        The effective address of a memory operand
+
+        :return: A function giving the 16-bit offset, and the index in regs
+            of its segment
+        """
+        regs = self.regs
+        if ins.mod == 0b00 and ins.rm == 0b110:
+            disp = ins.disp
+            offset = lambda: disp
+            default = DS
+        else:
+            disp = (ins.disp or 0) & 0xFFFF
+            bases = EA_REGS[ins.rm]
+            default = SS if BP in bases else DS
+            if len(bases) == 2:
+                a, b = bases
+                offset = lambda: (regs[a] + regs[b] + disp) & 0xFFFF
+            else:
+                a = bases[0]
+                offset = lambda: (regs[a] + disp) & 0xFFFF
+        return offset, default if ins.seg is None else ES + ins.seg
+
+    def _address(self, ins : Instruction):
+        """A function giving the physical address of a memory operand"""
+        regs = self.regs
+        offset, seg = self._offset(ins)
+        return lambda: ((regs[seg] << 4) + offset()) & ADDR_MASK
+
+    def _reg(self, r : int, w : int):
+        """Getter and setter of a register, byte registers by their number in REG_TABLE_W0"""
+        regs = self.regs
+        if w:
+            def set_word(v):
+                regs[r] = v
+            return (lambda: regs[r]), set_word
+        i = r & 3
+        if r & 4:
+            def set_high(v):
+                regs[i] = (regs[i] & 0xFF) | (v << 8)
+            return (lambda: regs[i] >> 8), set_high
+        def set_low(v):
+            regs[i] = (regs[i] & 0xFF00) | v
+        return (lambda: regs[i] & 0xFF), set_low
+
+    def _rm(self, ins : Instruction, w : int):
+        """Getter and setter of the r/m operand"""
+        if ins.mod == 0b11:
+            return self._reg(ins.rm, w)
+        read8, read16, write8, write16 = self._memory_ops()
+        address = self._address(ins)
+        if w:
+            return (lambda: read16(address())), (lambda v: write16(address(), v))
+        return (lambda: read8(address())), (lambda v: write8(address(), v))
+
+    def _handler(self, ins : Instruction):
+        """
+        Builds the handler of an instruction, a function taking the ip after
+        the instruction and returning the ip to continue at
+        """
+        regs = self.regs
+        read8, read16, write8, write16 = self._memory_ops()
+        mnemonic = MNEMONICS[ins.op]
+        opcode = ins.opcode
+        family = DECODE_TABLE[opcode]
+        w = ins.w
+
+        def push(v):
+            sp = (regs[SP] - 2) & 0xFFFF
+            regs[SP] = sp
+            write16(((regs[SS] << 4) + sp) & ADDR_MASK, v)
+
+        def pop():
+            sp = regs[SP]
+            regs[SP] = (sp + 2) & 0xFFFF
+            return read16(((regs[SS] << 4) + sp) & ADDR_MASK)
+
+        def interrupt(number, ip):
+            push(regs[FLAGS] | FLAGS_SET)
+            regs[FLAGS] &= ~(IF | TF) & 0xFFFF
+            push(regs[CS])
+            push(ip)
+            regs[CS] = read16(number * 4 + 2)
+            return read16(number * 4)
+
+        def set_flags(f):
+            regs[FLAGS] = (regs[FLAGS] & NOT_ARITH) | f
+
+        if mnemonic in ('nop', 'wait'):
+            return lambda ip: ip
+
+        if family is decode_8086._decode_xchg_acc:
+            r = ins.reg
+            def xchg_acc(ip):
+                regs[AX], regs[r] = regs[r], regs[AX]
+                return ip
+            return xchg_acc
+
+        # Two operand arithmetic, mov, test and xchg
+        if mnemonic in OP_GROUP_IMMED or mnemonic in ('mov', 'test', 'xchg'):
+            if family is decode_8086._decode_mov_sr:
+                get_rm, set_rm = self._rm(ins, 1)
+                sr = ES + (ins.reg & 0b11)
+                if ins.d:
+                    def mov_to_sr(ip):
+                        regs[sr] = get_rm()
+                        return ip
+                    return mov_to_sr
+                def mov_from_sr(ip):
+                    set_rm(regs[sr])
+                    return ip
+                return mov_from_sr
+            if family is decode_8086._decode_mov_mem_acc:
+                get_dst, set_dst = self._reg(AX, w)
+                disp = ins.disp
+                seg = DS if ins.seg is None else ES + ins.seg
+                read, write = (read16, write16) if w else (read8, write8)
+                if ins.d:
+                    def mov_to_mem(ip):
+                        write(((regs[seg] << 4) + disp) & ADDR_MASK, get_dst())
+                        return ip
+                    return mov_to_mem
+                def mov_from_mem(ip):
+                    set_dst(read(((regs[seg] << 4) + disp) & ADDR_MASK))
+                    return ip
+                return mov_from_mem
+            # Word registers by index, for the fast paths
+            rm_reg = ins.rm if ins.mod == 0b11 else None
+            src_reg = imm = None
+            if family in (decode_8086._decode_mov_imm_reg, decode_8086._decode_test_acc, decode_8086._decode_arith_imm_acc):
+                # Register, or accumulator, with immediate
+                dst_reg = ins.reg if family is decode_8086._decode_mov_imm_reg else AX
+                get_dst, set_dst = self._reg(dst_reg, w)
+                imm = ins.imm
+                get_src = lambda: imm
+            elif family in (decode_8086._decode_mov_imm_rm, decode_8086._decode_immed_rm, decode_8086._decode_group_rm):
+                dst_reg = rm_reg
+                get_dst, set_dst = self._rm(ins, w)
+                imm = ins.imm
+                if family is decode_8086._decode_immed_rm and ins.s and w:
+                    imm = (imm - ((imm & 0x80) << 1)) & 0xFFFF
+                get_src = lambda: imm
+            else:
+                # Register/memory with register, d picks the destination
+                dst_reg, src_reg = rm_reg, ins.reg
+                get_dst, set_dst = self._rm(ins, w)
+                get_src, set_src = self._reg(ins.reg, w)
+                if ins.d and mnemonic != 'xchg':
+                    get_dst, set_dst, get_src, set_src = get_src, set_src, get_dst, set_dst
+                    dst_reg, src_reg = src_reg, dst_reg
+                if src_reg is None:
+                    dst_reg = None
+            if w and dst_reg is not None and (mnemonic == 'mov' or mnemonic in OP_GROUP_IMMED):
+                return self._word_register_op(mnemonic, dst_reg, src_reg, imm)
+
+            if mnemonic == 'mov':
+                def mov(ip):
+                    set_dst(get_src())
+                    return ip
+                return mov
+            if mnemonic == 'xchg':
+                def xchg(ip):
+                    a, b = get_dst(), get_src()
+                    set_dst(b)
+                    set_src(a)
+                    return ip
+                return xchg
+            if mnemonic == 'test':
+                def test(ip):
+                    set_flags(SZP[w][get_dst() & get_src()])
+                    return ip
+                return test
+            k = OP_GROUP_IMMED.index(mnemonic)
+            alu = ALU[k]
+            if k == CMP:
+                def compare(ip):
+                    set_flags(alu(get_dst(), get_src(), regs[FLAGS], w)[1])
+                    return ip
+                return compare
+            def arith(ip):
+                res, f = alu(get_dst(), get_src(), regs[FLAGS], w)
+                regs[FLAGS] = (regs[FLAGS] & NOT_ARITH) | f
+                set_dst(res)
+                return ip
+            return arith
+
+        if family is decode_8086._decode_ctrl_transfer:
+            disp = ins.disp
+            if mnemonic in ('loop', 'loopz', 'loopnz'):
+                need = {'loop' : None, 'loopz' : ZF, 'loopnz' : 0}[mnemonic]
+                def loop(ip):
+                    cx = (regs[CX] - 1) & 0xFFFF
+                    regs[CX] = cx
+                    if cx and (need is None or (regs[FLAGS] & ZF) == need):
+                        return (ip + disp) & 0xFFFF
+                    return ip
+                return loop
+            if mnemonic == 'jcxz':
+                return lambda ip: (ip + disp) & 0xFFFF if regs[CX] == 0 else ip
+            condition = CONDITIONS[(opcode >> 1) & 0b111]
+            negate = opcode & 1
+            mask = JUMP_FLAGS[(opcode >> 1) & 0b111]
+            if mask is not None:
+                # Decided by a flag mask alone
+                if negate:
+                    return lambda ip: ip if regs[FLAGS] & mask else (ip + disp) & 0xFFFF
+                return lambda ip: (ip + disp) & 0xFFFF if regs[FLAGS] & mask else ip
+            if negate:
+                return lambda ip: ip if condition(regs[FLAGS]) else (ip + disp) & 0xFFFF
+            return lambda ip: (ip + disp) & 0xFFFF if condition(regs[FLAGS]) else ip
+
+        if family is decode_8086._decode_near_direct:
+            disp = ins.disp
+            if mnemonic == 'jmp':
+                return lambda ip: (ip + disp) & 0xFFFF
+            def call_near(ip):
+                push(ip)
+                return (ip + disp) & 0xFFFF
+            return call_near
+
+        if family is decode_8086._decode_far_direct:
+            offset, segment = ins.imm, ins.disp
+            def far(ip):
+                if mnemonic == 'call':
+                    push(regs[CS])
+                    push(ip)
+                regs[CS] = segment
+                return offset
+            return far
+
+        if family is decode_8086._decode_shift:
+            get_dst, set_dst = self._rm(ins, w)
+            k = ins.reg
+            by_cl = ins.d
+            if OP_GROUP_SHIFT[k] == 'ERR':
+                raise ValueError(f'instruction not recognized at {ins.offset:#07x}: {opcode:#04x}')
+            def shift(ip):
+                res, regs[FLAGS] = _shift(k, get_dst(), regs[CX] & 0xFF if by_cl else 1, regs[FLAGS], w)
+                set_dst(res)
+                return ip
+            return shift
+
+        if family is decode_8086._decode_inc_dec_push_pop_reg:
+            r = ins.reg
+            if mnemonic == 'push':
+                def push_reg(ip):
+                    # push sp pushes the value after the decrement on the 8086
+                    push((regs[r] - 2) & 0xFFFF if r == SP else regs[r])
+                    return ip
+                return push_reg
+            if mnemonic == 'pop':
+                def pop_reg(ip):
+                    regs[r] = pop()
+                    return ip
+                return pop_reg
+            get_dst, set_dst = self._reg(r, 1)
+        elif family is decode_8086._decode_group_rm:
+            get_dst, set_dst = self._rm(ins, w)
+
+        if mnemonic in ('inc', 'dec') and family is decode_8086._decode_inc_dec_push_pop_reg:
+            step = 1 if mnemonic == 'inc' else -1
+            def inc_dec_reg(ip):
+                a = regs[r]
+                res = (a + step) & 0xFFFF
+                # Overflow only going to or from 0x8000
+                of = OF if (res if step > 0 else a) == 0x8000 else 0
+                regs[FLAGS] = (regs[FLAGS] & (NOT_ARITH | CF)) | SZP_W[res] | ((a ^ res) & AF) | of
+                regs[r] = res
+                return ip
+            return inc_dec_reg
+
+        if mnemonic in ('inc', 'dec'):
+            op = _add if mnemonic == 'inc' else _sub
+            def inc_dec(ip):
+                res, f = op(get_dst(), 1, 0, w)
+                regs[FLAGS] = (regs[FLAGS] & (NOT_ARITH | CF)) | (f & ~CF)
+                set_dst(res)
+                return ip
+            return inc_dec
+
+        if family is decode_8086._decode_group_rm:
+            reg = ins.reg
+            if mnemonic == 'pop':
+                def pop_rm(ip):
+                    set_dst(pop())
+                    return ip
+                return pop_rm
+            if mnemonic == 'not':
+                mask = MASK[w]
+                def not_rm(ip):
+                    set_dst(~get_dst() & mask)
+                    return ip
+                return not_rm
+            if mnemonic == 'neg':
+                def neg(ip):
+                    res, f = _sub(0, get_dst(), 0, w)
+                    set_flags(f)
+                    set_dst(res)
+                    return ip
+                return neg
+            if mnemonic in ('mul', 'imul', 'div', 'idiv'):
+                return self._multiply(mnemonic, get_dst, w, interrupt)
+            if ins.opcode == 0b11111111 and mnemonic in ('call', 'jmp', 'push'):
+                if mnemonic == 'push':
+                    def push_rm(ip):
+                        push(get_dst())
+                        return ip
+                    return push_rm
+                call = mnemonic == 'call'
+                if reg & 1:
+                    # Far, the offset then the segment in memory
+                    if ins.mod == 0b11:
+                        raise ValueError(f'far {mnemonic} with a register at {ins.offset:#07x}')
+                    address = self._address(ins)
+                    def far_indirect(ip):
+                        a = address()
+                        offset, segment = read16(a), read16((a + 2) & ADDR_MASK)
+                        if call:
+                            push(regs[CS])
+                            push(ip)
+                        regs[CS] = segment
+                        return offset
+                    return far_indirect
+                def near_indirect(ip):
+                    target = get_dst()
+                    if call:
+                        push(ip)
+                    return target
+                return near_indirect
+            raise ValueError(f'instruction not recognized at {ins.offset:#07x}: {opcode:#04x}')
+
+        if family is decode_8086._decode_str_op:
+            return self._string_op(ins, mnemonic)
+
+        if family is decode_8086._decode_load:
+            offset, seg = self._offset(ins)
+            address = self._address(ins)
+            r = ins.reg
+            if mnemonic == 'lea':
+                def lea(ip):
+                    regs[r] = offset()
+                    return ip
+                return lea
+            target = DS if mnemonic == 'lds' else ES
+            def load_far(ip):
+                a = address()
+                regs[r] = read16(a)
+                regs[target] = read16((a + 2) & ADDR_MASK)
+                return ip
+            return load_far
+
+        if family is decode_8086._decode_ret_imm or mnemonic in ('ret', 'retf', 'iret'):
+            release = ins.imm or 0
+            far = mnemonic != 'ret'
+            restore_flags = mnemonic == 'iret'
+            def ret(ip):
+                ip = pop()
+                if far:
+                    regs[CS] = pop()
+                if restore_flags:
+                    regs[FLAGS] = pop() & FLAGS_MASK
+                regs[SP] = (regs[SP] + release) & 0xFFFF
+                return ip
+            return ret
+
+        if family is decode_8086._decode_in_out:
+            get_acc, set_acc = self._reg(AX, w)
+            port_imm = ins.imm
+            ports = self.ports
+            mask = MASK[w]
+            if mnemonic == 'in':
+                def port_in(ip):
+                    set_acc(ports[regs[DX] if port_imm is None else port_imm] & mask)
+                    return ip
+                return port_in
+            def port_out(ip):
+                ports[regs[DX] if port_imm is None else port_imm] = get_acc()
+                return ip
+            return port_out
+
+        if mnemonic in ('int', 'int3', 'into'):
+            number = ins.imm if mnemonic == 'int' else 3 if mnemonic == 'int3' else 4
+            if mnemonic == 'into':
+                return lambda ip: interrupt(number, ip) if regs[FLAGS] & OF else ip
+            return lambda ip: interrupt(number, ip)
+
+        if mnemonic == 'hlt':
+            def hlt(ip):
+                raise Halt(ip)
+            return hlt
+
+        # Single byte ops that only touch registers and flags
+        single = \
+        {
+            'clc'   : lambda: regs.__setitem__(FLAGS, regs[FLAGS] & ~CF & 0xFFFF),
+            'stc'   : lambda: regs.__setitem__(FLAGS, regs[FLAGS] | CF),
+            'cmc'   : lambda: regs.__setitem__(FLAGS, regs[FLAGS] ^ CF),
+            'cld'   : lambda: regs.__setitem__(FLAGS, regs[FLAGS] & ~DF & 0xFFFF),
+            'std'   : lambda: regs.__setitem__(FLAGS, regs[FLAGS] | DF),
+            'cli'   : lambda: regs.__setitem__(FLAGS, regs[FLAGS] & ~IF & 0xFFFF),
+            'sti'   : lambda: regs.__setitem__(FLAGS, regs[FLAGS] | IF),
+            'cbw'   : lambda: regs.__setitem__(AX, (regs[AX] & 0xFF) | (0xFF00 if regs[AX] & 0x80 else 0)),
+            'cwd'   : lambda: regs.__setitem__(DX, 0xFFFF if regs[AX] & 0x8000 else 0),
+            'lahf'  : lambda: regs.__setitem__(AX, (regs[AX] & 0xFF) | (((regs[FLAGS] & 0xD5) | 0x02) << 8)),
+            'sahf'  : lambda: regs.__setitem__(FLAGS, (regs[FLAGS] & 0xFF00) | ((regs[AX] >> 8) & 0xD5)),
+            'pushf' : lambda: push(regs[FLAGS] | FLAGS_SET),
+            'popf'  : lambda: regs.__setitem__(FLAGS, pop() & FLAGS_MASK),
+            'push'  : lambda: push(regs[CS]),   # push cs
+            'pop'   : lambda: regs.__setitem__(DS, pop()),  # pop ds
+            'xlat'  : None,
+        }
+        if mnemonic == 'xlat':
+            seg = DS if ins.seg is None else ES + ins.seg
+            def xlat(ip):
+                a = ((regs[seg] << 4) + ((regs[BX] + (regs[AX] & 0xFF)) & 0xFFFF)) & ADDR_MASK
+                regs[AX] = (regs[AX] & 0xFF00) | read8(a)
+                return ip
+            return xlat
+        if mnemonic in single:
+            action = single[mnemonic]
+            def single_byte(ip):
+                action()
+                return ip
+            return single_byte
+
+        if mnemonic in ('daa', 'das', 'aaa', 'aas', 'aam', 'aad'):
+            return self._adjust(mnemonic, ins.imm, interrupt)
+
+        raise ValueError(f'instruction not recognized at {ins.offset:#07x}: {opcode:#04x}')
+
+    def _word_register_op(self, mnemonic : str, d : int, s : int, imm : int):
+        """mov or arithmetic on word registers, with register s or imm as the source"""
+        regs = self.regs
+        if mnemonic == 'mov':
+            if s is None:
+                def mov_imm(ip):
+                    regs[d] = imm
+                    return ip
+                return mov_imm
+            def mov_reg(ip):
+                regs[d] = regs[s]
+                return ip
+            return mov_reg
+        k = OP_GROUP_IMMED.index(mnemonic)
+        alu = ALU[k]
+        if k == CMP:
+            if s is None:
+                def compare_imm(ip):
+                    regs[FLAGS] = (regs[FLAGS] & NOT_ARITH) | alu(regs[d], imm, 0, 1)[1]
+                    return ip
+                return compare_imm
+            def compare_reg(ip):
+                regs[FLAGS] = (regs[FLAGS] & NOT_ARITH) | alu(regs[d], regs[s], 0, 1)[1]
+                return ip
+            return compare_reg
+        if s is None:
+            def arith_imm(ip):
+                f = regs[FLAGS]
+                regs[d], f = alu(regs[d], imm, f, 1)
+                regs[FLAGS] = (regs[FLAGS] & NOT_ARITH) | f
+                return ip
+            return arith_imm
+        def arith_reg(ip):
+            f = regs[FLAGS]
+            regs[d], f = alu(regs[d], regs[s], f, 1)
+            regs[FLAGS] = (regs[FLAGS] & NOT_ARITH) | f
+            return ip
+        return arith_reg
+
+    def _multiply(self, mnemonic : str, get_src, w : int, interrupt):
+        """mul, imul, div and idiv of the accumulator by get_src()"""
+        regs = self.regs
+        bits = 8 << w
+        mask = MASK[w]
+        sign = SIGN[w]
+
+        def signed(v):
+            return v - ((v & sign) << 1)
+
+        def get_acc():
+            # ax for bytes, dx:ax for words
+            return (regs[DX] << 16) | regs[AX] if w else regs[AX]
+
+        def set_acc(low, high):
+            if w:
+                regs[AX], regs[DX] = low, high
+            else:
+                regs[AX] = low | (high << 8)
+
+        if mnemonic in ('mul', 'imul'):
+            def multiply(ip):
+                a = regs[AX] & mask
+                b = get_src()
+                if mnemonic == 'imul':
+                    r = signed(a) * signed(b)
+                    overflow = r != signed(r & mask)
+                else:
+                    r = a * b
+                    overflow = r > mask
+                r &= (mask << bits) | mask
+                set_acc(r & mask, r >> bits)
+                regs[FLAGS] = (regs[FLAGS] & ~(CF | OF) & 0xFFFF) | ((CF | OF) if overflow else 0)
+                return ip
+            return multiply
+
+        def divide(ip):
+            b = get_src()
+            a = get_acc()
+            if b == 0:
+                return interrupt(0, ip)
+            if mnemonic == 'idiv':
+                sa, sb = a - ((a & (sign << bits)) << 1), signed(b)
+                q = abs(sa) // abs(sb) * (1 if (sa < 0) == (sb < 0) else -1)
+                r = sa - q * sb
+                if not -sign < q < sign:
+                    return interrupt(0, ip)
+            else:
+                q, r = divmod(a, b)
+                if q > mask:
+                    return interrupt(0, ip)
+            set_acc(q & mask, r & mask)
+            return ip
+        return divide
+
+    def _adjust(self, mnemonic : str, base : int, interrupt):
+        """Decimal and ASCII adjusts of al"""
+        regs = self.regs
+
+        def adjust(ip):
+            f = regs[FLAGS]
+            ax = regs[AX]
+            al, ah = ax & 0xFF, ax >> 8
+            cf, af = f & CF, f & AF
+            if mnemonic in ('daa', 'das'):
+                old, old_cf = al, cf
+                sign = 1 if mnemonic == 'daa' else -1
+                if (al & 0xF) > 9 or af:
+                    cf = cf or (al + 6 > 0xFF if sign > 0 else al < 6)
+                    al = (al + sign * 6) & 0xFF
+                    af = AF
+                if old > 0x99 or old_cf:
+                    al = (al + sign * 0x60) & 0xFF
+                    cf = CF
+                regs[AX] = (ah << 8) | al
+                regs[FLAGS] = (f & NOT_ARITH) | SZP_B[al] | (CF if cf else 0) | af
+            elif mnemonic in ('aaa', 'aas'):
+                if (al & 0xF) > 9 or af:
+                    if mnemonic == 'aaa':
+                        al, ah = al + 6, ah + 1
+                    else:
+                        al, ah = al - 6, ah - 1
+                    f = (f | AF | CF)
+                else:
+                    f &= ~(AF | CF) & 0xFFFF
+                regs[AX] = ((ah & 0xFF) << 8) | (al & 0x0F)
+                regs[FLAGS] = f
+            elif mnemonic == 'aam':
+                if base == 0:
+                    return interrupt(0, ip)
+                ah, al = divmod(al, base)
+                regs[AX] = (ah << 8) | al
+                regs[FLAGS] = (f & NOT_ARITH) | SZP_B[al]
+            else:
+                al = (al + ah * base) & 0xFF
+                regs[AX] = al
+                regs[FLAGS] = (f & NOT_ARITH) | SZP_B[al]
+            return ip
+        return adjust
+
+    def _string_op(self, ins : Instruction, mnemonic : str):
+        """movs, cmps, scas, lods and stos, repeated cx times with rep"""
+        regs = self.regs
+        read8, read16, write8, write16 = self._memory_ops()
+        w = ins.w
+        size = w + 1
+        read, write = (read16, write16) if w else (read8, write8)
+        get_acc, set_acc = self._reg(AX, w)
+        src_seg = DS if ins.seg is None else ES + ins.seg
+        rep = STR_OPS.get(ins.opcode >> 1) == 'rep'
+        # F3 repeats while equal for cmps and scas, F2 while not equal
+        while_zf = ins.opcode & 1
+
+        def src():
+            return ((regs[src_seg] << 4) + regs[SI]) & ADDR_MASK
+
+        def dst():
+            return ((regs[ES] << 4) + regs[DI]) & ADDR_MASK
+
+        def once():
+            step = -size if regs[FLAGS] & DF else size
+            if mnemonic == 'movs':
+                write(dst(), read(src()))
+                regs[SI] = (regs[SI] + step) & 0xFFFF
+                regs[DI] = (regs[DI] + step) & 0xFFFF
+            elif mnemonic == 'stos':
+                write(dst(), get_acc())
+                regs[DI] = (regs[DI] + step) & 0xFFFF
+            elif mnemonic == 'lods':
+                set_acc(read(src()))
+                regs[SI] = (regs[SI] + step) & 0xFFFF
+            elif mnemonic == 'cmps':
+                regs[FLAGS] = (regs[FLAGS] & NOT_ARITH) | _sub(read(src()), read(dst()), 0, w)[1]
+                regs[SI] = (regs[SI] + step) & 0xFFFF
+                regs[DI] = (regs[DI] + step) & 0xFFFF
+            else:
+                regs[FLAGS] = (regs[FLAGS] & NOT_ARITH) | _sub(get_acc(), read(dst()), 0, w)[1]
+                regs[DI] = (regs[DI] + step) & 0xFFFF
+
+        if not rep:
+            def string(ip):
+                once()
+                return ip
+            return string
+        compares = mnemonic in ('cmps', 'scas')
+
+        def repeat(ip):
+            while regs[CX]:
+                once()
+                regs[CX] -= 1
+                if compares and bool(regs[FLAGS] & ZF) != bool(while_zf):
+                    break
+            return ip
+        return repeat
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs an 8086 binary, loaded at 0000:0000, and prints the registers it leaves')
+    parser.add_argument('path', help='the binary to run')
+    parser.add_argument('-n', '--count', type=int, help='most instructions to execute')
+    parser.add_argument('--dump', help='write the 1 MB of memory to this file when done')
+    args = parser.parse_args()
+
+    with open(args.path,'rb') as file:
+        code = file.read()
+    cpu = CPU()
+    cpu.load(code)
+    start = time.perf_counter()
+    try:
+        executed = cpu.run(args.count)
+    except ValueError as e:
+        print(f'Stopped: {e}')
+        executed = cpu.executed
+    seconds = time.perf_counter() - start
+
+    print('Final registers:')
+    for i, name in enumerate(REG_NAMES[:FLAGS]):
+        if cpu.regs[i]:
+            print(f'{name.rjust(8)}: {cpu.regs[i]:#06x} ({cpu.regs[i]})')
+    print(f'   flags: {cpu.flags_text()}')
+    print(f'{executed} instructions, {cpu.decodes} decoded, in {seconds:.3f}s ({executed / (seconds or 1e-9):,.0f}/s)')
+    if args.dump:
+        with open(args.dump,'wb') as file:
+            file.write(cpu.memory)
+
+if __name__ == "__main__":
+    main()
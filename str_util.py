@@ -1,45 +1,65 @@
+from collections.abc import Iterable, Iterator
+
 # Adds spacing between lines based on first word
 def add_spacing(str : str) -> str:
-    lines = str.splitlines()
-    prev_word = lines[0].split(' ')[0]
-    out = ''
+    return ''.join(iter_spacing(str.splitlines()))
+
+def iter_spacing(lines : Iterable) -> Iterator[str]:
+    """
+    Adds spacing between lines based on first word, one line at a time
+
+    Consecutive lines starting with the same word are grouped together and
+    separated from the lines around them by an empty line. Only one line
+    is looked ahead, so the output can be written as the input is decoded.
+
+    :param Iterable lines: str lines, or records such as Instruction whose
+        str() is the line
+    :return: Generator of output lines, each ending with '\\n'
+    :rtype: Iterator[str]
+    """
+    lines = iter(lines)
+    line = next(lines, None)
+    if line is None:
+        return
+    line = str(line)
+    first_word = line.partition(' ')[0]
+    prev_word = first_word
 
     # Flag for if a consecutive grouping is currently formed
     is_consecutive_grouping = False
 
-    for i in range(0,len(lines)):
-        first_word = lines[i].split(' ')[0]
+    for next_line in lines:
+        next_line = str(next_line)
+        next_word = next_line.partition(' ')[0]
 
         # If a new first word is encountered...
         if first_word != prev_word:
 
             # and there was already a consecutive grouping
-            if is_consecutive_grouping == True:
+            if is_consecutive_grouping:
 
-                # Break this grouping 
+                # Break this grouping
                 prev_word = first_word
                 is_consecutive_grouping = False
-                out += '\n'
+                yield '\n'
 
             # and there wasn't already a consecutive grouping
-            # Check bounds before looking at next line
-            elif i < len(lines)-1:
-
-                # If the next word is the same as this new word, make a new grouping
-                if lines[i+1].split(' ')[0] == first_word:
-                    prev_word = first_word
-                    out += '\n'
+            # If the next word is the same as this new word, make a new grouping
+            elif next_word == first_word:
+                prev_word = first_word
+                yield '\n'
 
-                # This code path is taken by non-consecutive groups
-                # Doing nothing here allows non-consecutive groups to form
-                else:
-                    #out += ';----------\n'
-                    pass
+            # This code path is taken by non-consecutive groups
+            # Doing nothing here allows non-consecutive groups to form
 
         # Else the lines are a consecutive group
         else:
             is_consecutive_grouping = True
-        out += lines[i] + '\n'
-    
-    return out
+        yield line + '\n'
+        line = next_line
+        first_word = next_word
 
+    # Last line, nothing to look ahead at
+    if first_word != prev_word and is_consecutive_grouping:
+        yield '\n'
+    yield line + '\n'
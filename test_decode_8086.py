@@ -1,36 +1,701 @@
+import io
+import sys
+import struct
 import os
+import time
+import shutil
+import hashlib
 import filecmp
+import asyncio
+import itertools
+import threading
+import tempfile
+import contextlib
 import subprocess
 import unittest
+import unittest.mock
+import concurrent.futures
+from typing import NamedTuple
 import decode_8086
-from str_util import add_spacing
+import encode_8086
+import bench_8086
+import length_8086
+import profile_8086
+import columns_8086
+import sim_8086
+import cycles_8086
+import daemon_8086
+import exe_8086
+from str_util import add_spacing, iter_spacing
+
+TESTS_DIR = 'tests'
+NASM_CACHE_DIR = f'{TESTS_DIR}/nasm_cache'
+NASM_FLAGS = ['-w-prefix-lock-xchg']
+# Worker processes for the listings, LISTING_JOBS=1 checks them one at a time
+LISTING_JOBS = int(os.environ.get('LISTING_JOBS', os.cpu_count() or 1))
+
+class ListingResult(NamedTuple):
+    binary : str
+    error : str         # None if the listing re-assembled to the same bytes
+    seconds : float
+    assembler : str     # 'nasm' or 'cached'
+
+def listing_binaries() -> list[str]:
+    """Listings without an extension in tests/listings, creating the test directories if needed"""
+    for folder in ('listings', 'out', 'recomp', 'nasm_cache'):
+        os.makedirs(f'{TESTS_DIR}/{folder}', exist_ok=True)
+    return sorted(path for path in os.listdir(f'{TESTS_DIR}/listings') if '.' not in path)
+
+def nasm_version() -> str:
+    """The version nasm prints, part of the cache key so a new nasm assembles every listing again"""
+    return subprocess.run(['nasm', '-v'], capture_output=True, text=True).stdout.strip()
+
+def assemble_listing(asm_path : str, out_path : str, version : str) -> str:
+    """
+    Assembles asm_path with nasm, reusing the output for an .asm seen before
+    by the same nasm version
+
+    :return: Where the output came from, 'nasm' or 'cached'
+    :rtype: str
+    """
+    with open(asm_path, 'rb') as file:
+        key = hashlib.sha256(b' '.join([version.encode(), *map(str.encode, NASM_FLAGS), file.read()])).hexdigest()
+    cached = f'{NASM_CACHE_DIR}/{key}'
+    if os.path.exists(cached):
+        shutil.copyfile(cached, out_path)
+        return 'cached'
+    subprocess.run(['nasm', asm_path, '-o', out_path, *NASM_FLAGS], capture_output=True)
+    if os.path.exists(out_path):
+        # Written under a temporary name so a parallel run never reads half a file
+        temp = f'{cached}.{os.getpid()}.tmp'
+        shutil.copyfile(out_path, temp)
+        os.replace(temp, cached)
+    return 'nasm'
+
+def check_listing(binary : str, version : str) -> ListingResult:
+    """Decodes a listing, re-assembles the output and compares it with the listing"""
+    start = time.perf_counter()
+    listing = f'{TESTS_DIR}/listings/{binary}'
+    asm_path = f'{TESTS_DIR}/out/test_{binary}.asm'
+    out_path = f'{TESTS_DIR}/recomp/test_{binary}'
+    error = None
+    assembler = None
+    try:
+        with contextlib.redirect_stdout(io.StringIO()) as messages:
+            asm = add_spacing(decode_8086.decode_8086(listing))
+        decode_8086.write_to_file(asm, asm_path)
+        # Never compare against the output of an earlier run
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        assembler = assemble_listing(asm_path, out_path, version)
+        if not os.path.exists(out_path):
+            error = f'{binary} did not assemble'
+        elif not filecmp.cmp(out_path, listing, False):
+            error = f'{binary} failed check {messages.getvalue().strip()}'.rstrip()
+    except Exception as e:
+        error = f'{binary} raised {e!r}'
+    return ListingResult(binary, error, time.perf_counter() - start, assembler)
+
+@unittest.skipUnless(shutil.which('nasm'), 'nasm is not installed')
+class TestListings(unittest.TestCase):
+    """Every listing, all checked at once in a process pool when the class is set up"""
+    results : dict[str, ListingResult] = {}
+
+    @classmethod
+    def setUpClass(cls):
+        start = time.perf_counter()
+        binaries = listing_binaries()
+        version = nasm_version()
+        if LISTING_JOBS > 1 and len(binaries) > 1:
+            with concurrent.futures.ProcessPoolExecutor(LISTING_JOBS) as pool:
+                results = list(pool.map(check_listing, binaries, itertools.repeat(version)))
+        else:
+            results = [check_listing(binary, version) for binary in binaries]
+        cls.results = {result.binary : result for result in results}
+        cls.seconds = time.perf_counter() - start
+
+    @classmethod
+    def tearDownClass(cls):
+        # Timing report, slowest first
+        print()
+        for result in sorted(cls.results.values(), key=lambda result: -result.seconds):
+            status = 'OK' if result.error is None else 'FAIL'
+            print(f'{result.binary.ljust(40)}\t: {status.ljust(4)} {result.seconds * 1000:8.1f} ms  {result.assembler}')
+        total = sum(result.seconds for result in cls.results.values())
+        print(f'{len(cls.results)} listings in {cls.seconds:.2f}s ({total:.2f}s of work, {LISTING_JOBS} jobs)')
 
-class TestDecode8086(unittest.TestCase):
     def test_listings(self):
-        TESTS_DIR = 'tests'
-        if not os.path.exists(f'{TESTS_DIR}'):
-            os.makedirs(f'{TESTS_DIR}')
-        if not os.path.exists(f'{TESTS_DIR}/listings'):
-            os.makedirs(f'{TESTS_DIR}/listings')
-        if not os.path.exists(f'{TESTS_DIR}/out'):
-            os.makedirs(f'{TESTS_DIR}/out')
-        if not os.path.exists(f'{TESTS_DIR}/recomp'):
-            os.makedirs(f'{TESTS_DIR}/recomp')
-        listings = os.listdir(f'{TESTS_DIR}/listings')
-        binaries : list[str] = []
-        for path in listings:
-            if len(path.split('.')) > 1:
-                pass
-            else:
-                binaries.append(path)
-        binaries.sort()
-        for binary in binaries:
-            asm = add_spacing(decode_8086.decode_8086(f'{TESTS_DIR}/listings/{binary}'))
-            decode_8086.write_to_file(asm,f'{TESTS_DIR}/out/test_{binary}.asm')
-            with subprocess.Popen(f'nasm {TESTS_DIR}/out/test_{binary}.asm -o {TESTS_DIR}/recomp/test_{binary} -w-prefix-lock-xchg', shell=True, stdout=subprocess.PIPE) as proc:
-                proc.stdout.read()
-                self.assertTrue(filecmp.cmp(f'{TESTS_DIR}/recomp/test_{binary}',f'{TESTS_DIR}/listings/{binary}', False),f'{binary} failed check')
-            print(binary.ljust(40), "\t: OK")
+        # A subtest per listing, so one failure doesn't hide the rest
+        for binary, result in self.results.items():
+            with self.subTest(listing=binary):
+                if result.error is not None:
+                    self.fail(result.error)
+
+class TestDecode8086(unittest.TestCase):
+    def test_decode_bytes(self):
+        code = bytes.fromhex('89d9' '8b5600' 'b10c' 'c60307' '268a07' 'f08607' '75fe' 'e80000')
+        expected = 'bits 16\n' \
+            'mov cx, bx\n' \
+            'mov dx, [bp]\n' \
+            'mov cl, 12\n' \
+            'mov [bp + di], byte 7\n' \
+            'mov al, es:[bx]\n' \
+            'lock xchg [bx], al\n' \
+            'jnz $+0\n' \
+            'call $+3'
+        for buf in (code, bytearray(code), memoryview(code)):
+            self.assertEqual(decode_8086.decode_8086_bytes(buf), expected)
+
+    def test_zero_displacement(self):
+        # Immediate forms keep '+ 0' so nasm emits the displacement byte again
+        code = bytes.fromhex('8b4600' 'c6460007' '268b870000' '8c4600')
+        expected = 'bits 16\n' \
+            'mov ax, [bp]\n' \
+            'mov [bp + 0], byte 7\n' \
+            'mov ax, es:[bx]\n' \
+            'mov [bp + 0], es'
+        self.assertEqual(decode_8086.decode_8086_bytes(code), expected)
+
+    def test_iter_instructions(self):
+        code = bytes.fromhex('89d9' '268a07' 'f02e8607' 'e80000')
+        expected = [
+            (0, 2, 'mov cx, bx'),
+            (2, 3, 'mov al, es:[bx]'),
+            (5, 4, 'lock xchg cs:[bx], al'),
+            (9, 3, 'call $+3'),
+        ]
+        self.assertEqual(list(decode_8086.iter_instructions(code)), expected)
+
+    def test_decode_instructions(self):
+        code = bytes.fromhex('2e8b56fe' '9a34120010')
+        mov, call = decode_8086.decode_instructions(code)
+        self.assertEqual((mov.offset, mov.length, mov.mnemonic), (0, 4, 'mov'))
+        self.assertEqual((mov.w, mov.d, mov.mod, mov.reg, mov.rm, mov.disp), (1, 1, 0b01, 0b010, 0b110, -2))
+        self.assertEqual(decode_8086.SEG_REG[mov.seg], 'cs')
+        self.assertEqual(mov.text, 'mov dx, cs:[bp - 2]')
+        self.assertEqual((call.offset, call.length, call.imm, call.disp), (4, 5, 0x1234, 0x1000))
+        self.assertEqual(call.text, 'call 4096:4660')
+
+    def test_output_names(self):
+        with tempfile.TemporaryDirectory() as folder:
+            paths = [os.path.join(folder, *parts) for parts in (('a', 'foo.bin'), ('b', 'foo.bin'), ('b', 'foo.com'), ('b', 'bar'))]
+            self.assertEqual(decode_8086.output_names(paths),
+                             [os.path.join('a', 'foo.asm'), os.path.join('b', 'foo.bin.asm'),
+                              os.path.join('b', 'foo.com.asm'), os.path.join('b', 'bar.asm')])
+            self.assertEqual(decode_8086.output_names(paths[:1]), ['foo.asm'])
+            for path, code in zip(paths, ('90', 'c3', 'cc')):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as file:
+                    file.write(bytes.fromhex(code))
+            out_dir = os.path.join(folder, 'out')
+            results = [decode_8086.decode_file(path, out_dir, out_name=name)
+                       for path, name in zip(paths[:3], decode_8086.output_names(paths[:3]))]
+            self.assertEqual(len({result.out_path for result in results}), 3)
+            for result in results:
+                with open(result.out_path) as file:
+                    self.assertEqual(file.read(), result.text)
+
+    def test_interleaved_decodes(self):
+        # The cs override isn't used by nop, so it is still pending when
+        # the first decode is paused
+        first = decode_8086.iter_instructions(bytes.fromhex('2e90' '8b07'))
+        self.assertEqual(next(first)[2], 'nop ;== xchg ax, ax')
+        self.assertEqual(decode_8086.decode_8086_bytes(bytes.fromhex('8b07')), 'bits 16\nmov ax, [bx]')
+        self.assertEqual(next(first)[2], 'mov ax, cs:[bx]')
+
+    def test_stream_decoder(self):
+        program = bench_8086.generate_program(4096, seed=3)
+        expected = [(ins.offset, ins.length, ins.text) for ins in decode_8086.decode_instructions(program)]
+        # Byte by byte splits every multi-byte instruction and prefix
+        for chunk_sizes in ([1], [3, 5, 7], [4096]):
+            decoder = decode_8086.StreamDecoder()
+            records = []
+            pos = 0
+            for size in itertools.cycle(chunk_sizes):
+                if pos >= len(program):
+                    break
+                records += decoder.feed(program[pos:pos+size])
+                pos += size
+            records += decoder.close()
+            self.assertEqual([(ins.offset, ins.length, ins.text) for ins in records], expected)
+
+        # A far call whose operand arrives in pieces
+        decoder = decode_8086.StreamDecoder()
+        self.assertEqual(decoder.feed(bytes.fromhex('f0269a34')), [])
+        self.assertEqual(decoder.feed(bytes.fromhex('12')), [])
+        self.assertEqual([ins.text for ins in decoder.feed(bytes.fromhex('7856' '90'))], ['lock call 22136:4660', 'nop ;== xchg ax, ax'])
+        self.assertEqual(decoder.close(), [])
+
+    def test_decode_parallel(self):
+        program = bytearray(bench_8086.generate_program(20000, seed=4))
+        # An unrecognized byte stops both decodes at the same place
+        stop = next(ins.offset for ins in decode_8086.decode_instructions(program) if ins.offset >= 15000)
+        program[stop] = 0b01100000
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'program.bin')
+            with open(path,'wb') as file:
+                file.write(program)
+            with contextlib.redirect_stdout(io.StringIO()):
+                expected = decode_8086.decode_8086(path)
+                for chunk_size in (7, 1000):
+                    self.assertEqual(decode_8086.decode_8086_parallel(path, 2, chunk_size), expected)
+
+    def test_decode_range(self):
+        # Prefix heavy, so overrides are still pending at some checkpoints
+        program = bench_8086.generate_program(20000, {'prefix' : 3, 'misc' : 2, 'modrm' : 1}, seed=6)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'program.bin')
+            with open(path,'wb') as file:
+                file.write(program)
+            records = list(decode_8086.decode_instructions(path))
+            index = decode_8086.load_or_build_index(path)
+            self.assertTrue(os.path.exists(path + decode_8086.INDEX_EXTENSION))
+            self.assertEqual(decode_8086.load_or_build_index(path), index)
+            self.assertEqual(list(index.offsets), [ins.offset for ins in records])
+
+            small = decode_8086.build_index(path, 64)
+            for start, end in ((0, 100), (4095, 4400), (12345, 12400), (19990, None)):
+                expected = [ins.text for ins in records if ins.offset >= start and (end is None or ins.offset < end)]
+                self.assertEqual([ins.text for ins in decode_8086.decode_range(path, start, end, index)], expected)
+                self.assertEqual([ins.text for ins in decode_8086.decode_range(path, start, end, small)], expected)
+
+            # Intervals past 16 bits are saved, and the index isn't decoded as a binary
+            large = decode_8086.build_index(path, 1 << 16)
+            decode_8086.save_index(large, os.path.join(tmp, 'large.idx'))
+            self.assertEqual(decode_8086.load_index(os.path.join(tmp, 'large.idx')), large)
+            with self.assertRaises(ValueError):
+                decode_8086.build_index(path, 0)
+            self.assertEqual(decode_8086.expand_paths([tmp, os.path.join(tmp, '*')]), [path])
+
+    def test_redecode(self):
+        old = bench_8086.generate_program(8192, {'prefix' : 3, 'misc' : 2, 'modrm' : 1}, seed=7)
+        old_records = list(decode_8086.decode_instructions(old))
+        patched = bytearray(old)
+        patched[100:103] = bytes.fromhex('2e8b07')
+        patched[5000] = 0b10010000
+        inserted = old[:3000] + bytes.fromhex('9a34127856') + old[3000:]
+        for new in (bytes(patched), inserted, old[:6000]):
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                expected = [(ins.offset, ins.length, ins.text) for ins in decode_8086.decode_instructions(new)]
+                records = decode_8086.redecode(old_records, old, new)
+            self.assertEqual([(ins.offset, ins.length, ins.text) for ins in records], expected)
+            # Cutting the buffer at 6000 cuts an instruction, both decodes stop on it
+            self.assertEqual(output.getvalue().count('Instruction truncated'), 2 if len(new) == 6000 else 0)
+        self.assertEqual(decode_8086.changed_ranges(old, bytes(patched)), [(100, 103, 0), (5000, 5001, 0)])
+
+        # Patches build on the decode before, with offsets from the caller
+        records = decode_8086.redecode(old_records, old, inserted, length_8086.instruction_boundaries(old).offsets)
+        for new in (inserted[:200] + inserted[203:], inserted[:7000] + b'\x90' + inserted[7001:]):
+            records = decode_8086.redecode(records, inserted, new)
+            expected = [(ins.offset, ins.length, ins.text) for ins in decode_8086.decode_instructions(new)]
+            self.assertEqual([(ins.offset, ins.length, ins.text) for ins in records], expected)
+            self.assertEqual(len(records), len(expected))
+            inserted = new
+        # Records before the patches are reused as they are
+        self.assertIs(next(iter(records)), old_records[0])
+
+    def test_decode_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'program.bin')
+            with open(path,'wb') as file:
+                file.write(bench_8086.generate_program(2000, seed=8))
+            cache = decode_8086.DecodeCache(os.path.join(tmp, 'cache'))
+            text = decode_8086.decode_8086(path)
+            records = [(ins.offset, ins.length, ins.text) for ins in decode_8086.decode_instructions(path)]
+            for _ in range(2):
+                self.assertEqual(decode_8086.decode_8086_cached(path, cache), text)
+                self.assertEqual([(ins.offset, ins.length, ins.text) for ins in decode_8086.decode_instructions_cached(path, cache)], records)
+                self.assertEqual(decode_8086.add_spacing_cached(text, cache), add_spacing(text))
+            self.assertEqual((cache.hits, cache.misses), (3, 3))
+
+            # The entry used least recently is evicted first
+            cache.max_size = os.path.getsize(cache._path(cache.file_key(path), 'records')) + 1
+            os.utime(cache._path(cache.file_key(path), 'text'), ns=(0, 0))
+            cache.put('00', 'text', '')
+            self.assertIsNone(cache.get(cache.file_key(path), 'text'))
+            self.assertEqual(cache.get('00', 'text'), '')
+
+    def test_memo(self):
+        # push bp / mov bp, sp / mov ax, [bp - 2] / mov ax, es:[bp - 2], repeated
+        program = bytes.fromhex('55' '8bec' '8b46fe' '268b46fe') * 50
+        before = decode_8086.memo_info()
+        text = decode_8086.decode_8086_bytes(program)
+        after = decode_8086.memo_info()
+        self.assertEqual(text, '\n'.join(['bits 16', *(ins.text for ins in decode_8086.decode_instructions(program))]))
+        self.assertIn('mov ax, es:[bp - 2]', text)
+        self.assertGreaterEqual(after.hits - before.hits, 3 * 49)
+        self.assertLessEqual(after.currsize, decode_8086.MEMO_SIZE)
+
+    def test_not_strict(self):
+        # mov cx, bx / unknown / cs: unknown / rep before nop / mov al, 255 / mov cut off
+        program = bytes.fromhex('89d9' '0f' '2e63' 'f390' 'b0ff' '8b')
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertEqual(decode_8086.decode_8086_bytes(program), 'bits 16\nmov cx, bx')
+        self.assertIn('not recognized', output.getvalue())
+
+        coverage = decode_8086.Coverage()
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            texts = [text for _, _, text in decode_8086.iter_instructions(program, strict=False, coverage=coverage)]
+        self.assertEqual(output.getvalue(), '')
+        self.assertEqual(texts, ['mov cx, bx', 'db 0x0f', 'db 0x2e', 'db 0x63', 'db 0xf3', 'nop ;== xchg ax, ax',
+                                 'mov al, 255', 'db 0x8b'])
+        self.assertEqual(coverage.opcodes, {0x0f : 1, 0x63 : 1, 0xf3 : 1, 0x8b : 1})
+        self.assertEqual(coverage.data_bytes, 5)
+        self.assertEqual(coverage.decoded_percent(len(program)), 50.0)
+
+        records = list(decode_8086.decode_instructions(program, strict=False))
+        self.assertEqual([ins.text for ins in records], texts)
+        self.assertEqual(encode_8086.encode_instructions(records), program)
+        self.assertEqual(encode_8086.assemble('\n'.join(texts)), program)
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'program.bin')
+            with open(path, 'wb') as file:
+                file.write(program)
+            result = decode_8086.decode_file(path, folder, strict=False)
+        self.assertIsNone(result.error)
+        self.assertEqual(result.decoded, 5)
+        self.assertEqual(result.coverage.opcodes, coverage.opcodes)
+
+        # nop / nop / ss: with nothing after it
+        coverage = decode_8086.Coverage()
+        texts = [text for _, _, text in decode_8086.iter_instructions(bytes.fromhex('909036'), False, coverage)]
+        self.assertEqual(texts, ['nop ;== xchg ax, ax', 'nop ;== xchg ax, ax', 'db 0x36'])
+        self.assertEqual(coverage.opcodes, {0x36 : 1})
+        self.assertEqual(coverage.data_bytes, 1)
+
+class TestLength8086(unittest.TestCase):
+    def test_boundaries(self):
+        program = bench_8086.generate_program(4096, seed=5)
+        # Truncated, then a lock on its own
+        for buf in (program, program[:-1], program + bytes.fromhex('f0f02e')):
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                records = list(decode_8086.decode_instructions(buf))
+                boundaries = length_8086.instruction_boundaries(buf)
+            self.assertEqual('Instruction truncated' in output.getvalue(), buf == program[:-1])
+            self.assertEqual(list(boundaries.offsets), [ins.offset for ins in records])
+            self.assertEqual(list(boundaries.opcodes), [ins.opcode for ins in records])
+            self.assertEqual(boundaries.end, records[-1].offset + records[-1].length)
+
+    def test_opcode_counts(self):
+        counts = length_8086.opcode_counts(bytes.fromhex('9090' '2e8b07' '8b07' 'f0'))
+        self.assertEqual(counts[0b10010000], 2)
+        self.assertEqual(counts[0b10001011], 2)
+        self.assertEqual(counts[0b11110000], 1)
+        self.assertEqual(sum(counts), 5)
+
+    @unittest.skipUnless(length_8086.np, 'numpy is not installed')
+    def test_numpy_matches_python(self):
+        program = bench_8086.generate_program(4096, seed=7)
+        for buf in (program, program[:-1], program + bytes.fromhex('f0f02e'), b''):
+            lengths, counts = length_8086.instruction_lengths(buf), length_8086.opcode_counts(buf)
+            with unittest.mock.patch.object(length_8086, 'np', None):
+                self.assertEqual(list(lengths), list(length_8086.instruction_lengths(buf)))
+                self.assertEqual(list(counts), list(length_8086.opcode_counts(buf)))
+
+class TestEncode8086(unittest.TestCase):
+    def test_encode_instructions(self):
+        for seed in range(3):
+            program = bench_8086.generate_program(4096, seed=seed)
+            records = list(decode_8086.decode_instructions(program))
+            end = records[-1].offset + records[-1].length
+            self.assertEqual(encode_8086.encode_instructions(records), program[:end])
+        self.assertTrue(encode_8086.round_trips(bytes.fromhex('2e2e8b07' 'f0f0' 'f3a5' '7400')))
+        # Redundant overrides and a lock between them keep their bytes and order
+        self.assertTrue(encode_8086.round_trips(bytes.fromhex('15d7de' '363e4b' '36f02e8607' '26f036f0')))
+
+    def test_assemble_line(self):
+        # Encodings nasm picks
+        expected = \
+        {
+            'mov cx, bx'                    : '89d9',
+            'mov dx, [bp]'                  : '8b5600',
+            'mov ah, [bx + si + 4]'         : '8a6004',
+            'mov al, [bx + si + 4999]'      : '8a808713',
+            'mov ax, [bx + di - 37]'        : '8b41db',
+            'mov [bp + di], byte 7'         : 'c60307',
+            'mov ax, [2555]'                : 'a1fb09',
+            'mov cl, 12'                    : 'b10c',
+            'mov es:[bx + si + 0], word 0'  : '26c740000000',
+            'add si, 2'                     : '83c602',
+            'add ax, 1000'                  : '05e803',
+            'cmp al, 5'                     : '3c05',
+            'xchg ax, dx'                   : '92',
+            'test [bx], cl'                 : '840f',
+            'shl word [bp + 5], cl'         : 'd36605',
+            'je $+2'                        : '7400',
+            'call $+3'                      : 'e80000',
+            'jmp far [bx]'                  : 'ff2f',
+            'rep movsw'                     : 'f3a5',
+            'lock xchg [bx], al'            : 'f08607',
+            'aam'                           : 'd40a',
+            'nop ;== xchg ax, ax'           : '90',
+            'lock '                         : 'f0',
+        }
+        for line, code in expected.items():
+            with self.subTest(line=line):
+                self.assertEqual(encode_8086.assemble_line(line).hex(), code)
+        with self.assertRaises(ValueError):
+            encode_8086.assemble('bits 16\nERR [bx]')
+
+    def test_assemble_decoded(self):
+        program = bench_8086.generate_program(4096, seed=4)
+        text = decode_8086.decode_8086_bytes(encode_8086.assemble(decode_8086.decode_8086_bytes(program)))
+        self.assertEqual(decode_8086.decode_8086_bytes(encode_8086.assemble(text)), text)
+
+class TestProfile8086(unittest.TestCase):
+    def test_profile_decode(self):
+        program = bench_8086.generate_program(8192, seed=6) + bytes.fromhex('f0f0')
+        mod_rm_schema = decode_8086.mod_rm_schema
+        # Decodes on another thread aren't counted in the profile
+        done = threading.Event()
+        other_end = next(ins.offset for ins in decode_8086.decode_instructions(program) if ins.offset >= 512)
+
+        def decode_until_done():
+            while not done.is_set():
+                decode_8086.decode_8086_bytes(program[:other_end])
+
+        other = threading.Thread(target=decode_until_done)
+        other.start()
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'program')
+            with open(path, 'wb') as file:
+                file.write(program)
+            try:
+                with contextlib.redirect_stdout(io.StringIO()) as output:
+                    text, profile = profile_8086.profile_decode(path, os.path.join(folder, 'program.asm'))
+            finally:
+                done.set()
+                other.join()
+            # Neither decode is cut off, so nothing is reported
+            self.assertEqual(output.getvalue(), '')
+            with open(os.path.join(folder, 'program.asm')) as file:
+                self.assertEqual(file.read(), text)
+        self.assertEqual(text, add_spacing(decode_8086.decode_8086_bytes(program)))
+        self.assertIs(decode_8086.mod_rm_schema, mod_rm_schema)
+
+        records = list(decode_8086.decode_instructions(program))
+        self.assertEqual(sum(stats.count for stats in profile.families.values()), len(records))
+        self.assertEqual(sum(stats.bytes for stats in profile.families.values()), len(program))
+        self.assertEqual(profile.families[profile_8086.LOCK_FAMILY].count, 2)
+        self.assertEqual(profile.mod_rm_calls, sum(ins.mod is not None for ins in records))
+        self.assertEqual(profile.to_dict()['size'], len(program))
+        self.assertIn('OP_GROUP_IMMED IMM_ACC', profile.table())
+
+class TestColumns8086(unittest.TestCase):
+    def test_columns(self):
+        program = bench_8086.generate_program(8192, seed=7) + bytes.fromhex('2e8b07' 'f0')
+        records = list(decode_8086.decode_instructions(program))
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'program.cols')
+            self.assertEqual(columns_8086.export_columns(program, path), len(records))
+            with columns_8086.load_columns(path) as columns:
+                self.assertEqual(len(columns), len(records))
+                self.assertEqual(list(columns.offset), [ins.offset for ins in records])
+                self.assertEqual(columns.mnemonics, decode_8086.MNEMONICS)
+                self.assertEqual([ins.text for ins in columns], [ins.text for ins in records])
+                self.assertEqual(columns.seg[-2], 1)
+                self.assertEqual(columns.disp[-1], columns_8086.NONE_VALUE)
+                # A column still in use keeps the file mapped until it is gone
+                in_use = struct.iter_unpack('I', columns.offset)
+                with self.assertRaises(BufferError):
+                    columns.close()
+                del in_use
+
+            # A big endian host swaps the columns on the way out and back in
+            with unittest.mock.patch.object(sys, 'byteorder', 'big'):
+                columns_8086.export_columns(program, path)
+                with columns_8086.load_columns(path) as columns:
+                    self.assertEqual([ins.text for ins in columns], [ins.text for ins in records])
+                    self.assertEqual(list(columns.disp), [columns_8086.NONE_VALUE if ins.disp is None else ins.disp
+                                                          for ins in records])
+
+            with open(path, 'wb') as file:
+                file.write(b'bits 16\n')
+            with self.assertRaises(ValueError):
+                columns_8086.load_columns(path)
+
+class TestCycles8086(unittest.TestCase):
+    def test_estimate(self):
+        program = encode_8086.assemble('mov ax, [bx]\nadd word [bp + si + 4], 3\nmov [1001], ax\nmov al, [1001]\n'
+                                       'jnz $+2\nrep movsw\ninc word es:[si]\ncall $+3\nret')
+        records = list(decode_8086.decode_instructions(program))
+        cycles = [(t.cycles, t.max_cycles, t.per_count, t.ea, t.penalty) for _, t in cycles_8086.annotate(records)]
+        self.assertEqual(cycles, [(13, 13, 0, 5, 0), (29, 29, 0, 12, 0), (14, 14, 0, 0, 4), (10, 10, 0, 0, 0),
+                                  (4, 16, 0, 0, 0), (9, 9, 17, 0, 0), (22, 22, 0, 5, 0), (19, 19, 0, 0, 0), (8, 8, 0, 0, 0)])
+        # Every word transfer is slow on the 8088
+        self.assertEqual([t.penalty for _, t in cycles_8086.annotate(records, '8088')], [4, 8, 4, 0, 0, 0, 8, 4, 4])
+        self.assertEqual(cycles_8086.estimate(records[0], odd=True).penalty, 4)
+        self.assertEqual(str(cycles_8086.estimate(records[1])), '29 (17 + 12ea)')
+
+        totals = cycles_8086.totals(cycles_8086.annotate(records))
+        self.assertEqual([total.name for total in totals], ['start', f'sub_{records[-1].offset:04x}'])
+        self.assertEqual(totals[0].cycles, sum(cycle[0] for cycle in cycles[:-1]))
+        self.assertEqual(totals[0].max_cycles - totals[0].cycles, 12)
+        self.assertEqual(totals[1].count, 1)
+        # Ranges may overlap and start between instructions
+        ranges = [(0, 4), (2, 12), (12, 12), (records[-1].offset, 0x1000)]
+        self.assertEqual([total.count for total in cycles_8086.totals(cycles_8086.annotate(records), ranges)],
+                         [sum(start <= ins.offset < end for ins in records) for start, end in ranges])
+        with self.assertRaises(ValueError):
+            cycles_8086.estimate(records[0], '80286')
+
+class TestDaemon8086(unittest.TestCase):
+    def test_daemon(self):
+        program = bench_8086.generate_program(4096, seed=11)
+        expected = add_spacing(decode_8086.decode_8086_bytes(program))
+
+        async def scenario(folder : str) -> list:
+            socket_path = os.path.join(folder, 'decode.sock')
+            path = os.path.join(folder, 'program.bin')
+            with open(path, 'wb') as file:
+                file.write(program)
+            ready = asyncio.Event()
+            server = asyncio.create_task(daemon_8086.serve(socket_path, ready))
+            await ready.wait()
+
+            def client(**kwargs) -> str:
+                return ''.join(daemon_8086.decode(socket_path=socket_path, **kwargs))
+
+            def refused(**kwargs) -> str:
+                with self.assertRaises(daemon_8086.DaemonError) as context:
+                    client(**kwargs)
+                return str(context.exception)
+
+            try:
+                return await asyncio.gather(*(asyncio.to_thread(client, path=path) for _ in range(4)),
+                                            asyncio.to_thread(client, data=program),
+                                            asyncio.to_thread(client, data=bytes.fromhex('89d9b0ff01c3'), spacing=False, start=2, end=4),
+                                            asyncio.to_thread(refused, path=os.path.join(folder, 'missing.bin')))
+            finally:
+                server.cancel()
+
+        with tempfile.TemporaryDirectory() as folder:
+            *texts, ranged, error = asyncio.run(scenario(folder))
+            self.assertFalse(os.path.exists(os.path.join(folder, 'decode.sock')))
+        self.assertEqual(texts, [expected] * 5)
+        self.assertEqual(ranged, 'bits 16\nmov al, 255\n')
+        self.assertIn('no such file', error)
+
+class TestExe8086(unittest.TestCase):
+    def test_exe(self):
+        code = encode_8086.assemble('mov ax, 1\nmov dx, 0\nmov ah, 9\nint 33')
+        module = b'Hello$'.ljust(16, b'\0') + code
+        # Header, one relocation for the immediate of mov ax, 1 at 0001:0001, load module, overlay
+        size = 32 + len(module)
+        header = struct.pack('<2s13H', b'MZ', size % 512, -(-size // 512), 1, 2, 0, 0xFFFF, 2, 0x100, 0, 0, 1, 28, 0)
+        image = header + struct.pack('<HH', 1, 1) + module + b'overlay'
+        with tempfile.TemporaryDirectory() as folder:
+            exe_path = os.path.join(folder, 'program.exe')
+            com_path = os.path.join(folder, 'program.com')
+            with open(exe_path, 'wb') as file:
+                file.write(image)
+            with open(com_path, 'wb') as file:
+                file.write(code + bytes.fromhex('c3'))
+
+            with exe_8086.load_image(exe_path) as exe:
+                self.assertEqual((exe.kind, exe.load_start, exe.load_size, exe.overlay_size), ('exe', 32, len(module), 7))
+                self.assertEqual(exe.relocations, [(1, 1)])
+                self.assertEqual(exe.entry_offset, 16)
+                records = list(exe.instructions(exe.entry_offset))
+                self.assertEqual([ins.text for ins in records], ['mov ax, 1', 'mov dx, 0', 'mov ah, 9', 'int 33'])
+                self.assertEqual([exe.address(ins.offset) for ins in records], [(1, 0), (1, 3), (1, 6), (1, 8)])
+                self.assertEqual([exe.fixups(ins) for ins in records], [1, 0, 0, 0])
+                listing = list(exe_8086.iter_listing(exe, exe.entry_offset))
+                self.assertIn(f'{'mov ax, 1':<32}; 0001:0000 entry point segment fixup', listing)
+
+            with exe_8086.load_image(com_path) as com:
+                self.assertEqual((com.kind, com.entry, com.entry_offset), ('com', (0, 0x100), 0))
+                listing = list(exe_8086.iter_listing(com))
+                self.assertEqual(listing[-1], f'{'ret':<32}; 0000:010a')
+                # A decode left unfinished is stopped, and the file unmapped
+                unfinished = com.instructions()
+                next(unfinished)
+            self.assertTrue(com._mmap.closed)
+            self.assertEqual(list(unfinished), [])
+
+            with open(exe_path, 'wb') as file:
+                file.write(header[:20])
+            with self.assertRaises(ValueError):
+                exe_8086.load_image(exe_path)
+
+class TestSim8086(unittest.TestCase):
+    def run_program(self, text : str) -> sim_8086.CPU:
+        cpu = sim_8086.CPU()
+        cpu.load(encode_8086.assemble(text))
+        cpu.run()
+        return cpu
+
+    def test_registers_and_flags(self):
+        cpu = self.run_program('mov bx, 61443\nmov cx, 3841\nsub bx, cx\nmov sp, 998\nmov bp, 999\n'
+                               'cmp bp, sp\nadd bp, 1027\nsub bp, 2026')
+        self.assertEqual(cpu['bx'], 0xe102)
+        self.assertEqual(cpu['cx'], 0x0f01)
+        self.assertEqual(cpu['bp'], 0)
+        self.assertEqual(cpu.flags_text(), 'PZ')
+        cpu = self.run_program('mov al, 200\nadd al, 100\nmov ah, 127\ninc ah')
+        self.assertEqual(cpu['al'], 44)
+        self.assertEqual(cpu.flags_text(), 'CASO')
+
+    def test_loop_is_decoded_once(self):
+        cpu = self.run_program('mov cx, 1000\nmov ax, 0\nadd ax, cx\nloop $-2\nmov bx, ax')
+        self.assertEqual(cpu['bx'], 500500 & 0xFFFF)
+        self.assertEqual(cpu.executed, 2003)
+        self.assertEqual(cpu.decodes, 5)
+
+    def test_memory_and_stack(self):
+        cpu = self.run_program('mov ax, 4660\nmov [1000], ax\nmov di, 2000\nmov si, 1000\nmov cx, 4\nrep movsb\n'
+                               'push word [2000]\npop dx\ncall $+6\njmp $+4\nret\nmov bl, 7\nmul bl\nhlt')
+        self.assertEqual(cpu['dx'], 0x1234)
+        self.assertEqual(cpu['ax'], 0x34 * 7)
+        self.assertEqual(cpu['sp'], 0)
+        self.assertEqual(cpu.memory[2000:2004], bytes.fromhex('34120000'))
+
+    def test_self_modifying_code(self):
+        # Rewrites the immediate of add ax, 1 after its first run
+        cpu = self.run_program('mov cx, 3\nmov ax, 0\nadd ax, 1\nmov byte [8], 5\nloop $-8')
+        self.assertEqual(cpu['ax'], 11)
+        cpu = sim_8086.CPU()
+        cpu.load(bytes.fromhex('40' '60'))
+        with self.assertRaises(ValueError):
+            cpu.run()
+        self.assertEqual(cpu['ip'], 1)
+
+        # Code loaded past the top of memory wraps around to 0
+        cpu = sim_8086.CPU()
+        cpu.load(bytes.fromhex('90' * 16 + '40' * 16), 0xF000, 0xFFF0)
+        self.assertEqual(cpu.memory[-16:] + cpu.memory[:16], bytes.fromhex('90' * 16 + '40' * 16))
+        cpu.load(bytes.fromhex('90' * 32), 0xFFFF, 0xFFF0)
+        self.assertEqual(len(cpu.memory), sim_8086.MEMORY_SIZE)
+        self.assertEqual(cpu.memory[0xFFE0:0x10000], bytes.fromhex('90' * 32))
+        with self.assertRaises(ValueError):
+            cpu.load(bytes(sim_8086.MEMORY_SIZE + 1))
+
+        # Repeated locks and overrides are one instruction with its prefixes
+        cpu = sim_8086.CPU()
+        cpu.load(bytes.fromhex('f0f02e40' '40' 'f4'))
+        self.assertEqual(cpu.run(), 3)
+        self.assertEqual((cpu['ax'], cpu['ip']), (2, 6))
+
+class TestStrUtil(unittest.TestCase):
+    def test_add_spacing(self):
+        text = 'bits 16\nmov a\nmov b\nadd c\nsub d\nsub e\njmp f\nmov g'
+        expected = 'bits 16\n\nmov a\nmov b\n\nadd c\n\nsub d\nsub e\n\njmp f\nmov g\n'
+        self.assertEqual(add_spacing(text), expected)
+
+    def test_iter_spacing_records(self):
+        program = bench_8086.generate_program(5000, seed=1)
+        spaced = ''.join(iter_spacing(['bits 16', *decode_8086.decode_instructions(program)]))
+        self.assertEqual(spaced, add_spacing(decode_8086.decode_8086_bytes(program)))
+
+class TestBench8086(unittest.TestCase):
+    def test_generate_program(self):
+        program = bench_8086.generate_program(20000, seed=3)
+        self.assertEqual(program, bench_8086.generate_program(20000, seed=3))
+        self.assertGreaterEqual(len(program), 20000)
+        # Every generated byte belongs to a decoded instruction
+        decoded = sum(ins.length for ins in decode_8086.decode_instructions(program))
+        self.assertEqual(decoded, len(program))
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file